@@ -1,11 +1,28 @@
 #!/usr/bin/python3
 
-"""Tool to add authors to the admin and static sites."""
+"""Tool to add authors to the admin and static sites.
 
+Run it with no arguments to add authors one at a time, or with --batch and a
+CSV or YAML file to add a whole class at once. A CSV needs a full_name column,
+and can have bio and instagram columns. A YAML file is a list of mappings with
+the same keys. The whole batch is checked first, and nothing is written if any
+author conflicts.
+"""
+
+import argparse
+import csv
 import os
 import sys
 
+import yaml
+
+import storage
+from authors import parse_authors_file
+
 STATIC_SITE_PATH = "../static-site"
+AUTHORS_PATH = "authors.txt"
+DEFAULT_BIO = "Columnist."
+DEFAULT_INSTAGRAM = "https://instagram.com/mcibeacon"
 
 
 def if_in_file_abort(file, *argv):
@@ -19,71 +36,225 @@ def if_in_file_abort(file, *argv):
             line = f.readline()
 
 
-print("This is a tool to add an author to the website.")
-print("Press Ctrl-C to quit at any time. You will need to rebuild the site for changes to appear.")
-
-while True:
-    full_name = input("Type the author's first and last name: ")
+def short_name_for(full_name):
     # First letter of first name + last name
     # Eg. John Smith --> jsmith
-    short_name = full_name.lower()[0] + full_name.lower()[full_name.index(" ") + 1:]
-    bio = input('Type their bio. Press enter to set it to "Columnist."\n> ')
-    if bio == "":
-        bio = "Columnist."
-    ig = input("Enter a full link to their Instagram. Press enter to set it to the MCI Beacon one.\n> ")
-    if ig == "":
-        ig = "https://instagram.com/mcibeacon"
-    
-    # Search config to see if the full name or shortened name is already in there
-    # Checking this file first is IMPORTANT, because they might not be in authors.txt
-    # if there name is the database, but they will definitely be in the config file
-    if_in_file_abort(os.path.join(STATIC_SITE_PATH, "_config.yml"), full_name, short_name)
-    # Check authors.txt too
-    if_in_file_abort("authors.txt", full_name, short_name)
-    # Check if the name already has an author page on the site
-    author_file = "author-" + full_name.lower().replace(" ", "-") + ".html"
-    if author_file in os.listdir(os.path.join(STATIC_SITE_PATH, "_pages")):
-        print(author_file, "already exists. -- Aborting")
+    return full_name.lower()[0] + full_name.lower()[full_name.index(" ") + 1:]
+
+
+def author_file_for(full_name):
+    return "author-" + full_name.lower().replace(" ", "-") + ".html"
+
+
+def authors_txt_line(short_name, full_name):
+    return '\n("' + short_name + '", "' + full_name + '")'  # Write ("jsmith", "John Smith")
+
+
+def config_text(short_name, full_name, bio, ig):
+    # Writes the following:
+    #  short_name:
+    #    name: "full_name"
+    #    bio: "bio"
+    #    instagram: ig
+    lines = [
+        "  " + short_name + ":",
+        '    name: "' + full_name + '"',
+        '    bio: "' + bio + '"',
+        '    instagram: ' + ig
+    ]
+    return "\n" + "".join("\n" + line for line in lines)
+
+
+def author_page_text(short_name, full_name, author_file):
+    lines = [
+        "---",
+        'title: "' + full_name + '"',
+        "layout: default",
+        'permalink: "/' + author_file + '"',
+        "---",
+        "",
+        "{% include author-page.html author=site.authors." + short_name + ' authorname="' + short_name + '" %}'
+    ]
+    return "".join(line + "\n" for line in lines)
+
+
+def interactive():
+    print("This is a tool to add an author to the website.")
+    print("Press Ctrl-C to quit at any time. You will need to rebuild the site for changes to appear.")
+
+    while True:
+        full_name = input("Type the author's first and last name: ")
+        short_name = short_name_for(full_name)
+        bio = input('Type their bio. Press enter to set it to "' + DEFAULT_BIO + '"\n> ')
+        if bio == "":
+            bio = DEFAULT_BIO
+        ig = input("Enter a full link to their Instagram. Press enter to set it to the MCI Beacon one.\n> ")
+        if ig == "":
+            ig = DEFAULT_INSTAGRAM
+
+        # Search config to see if the full name or shortened name is already in there
+        # Checking this file first is IMPORTANT, because they might not be in authors.txt
+        # if there name is the database, but they will definitely be in the config file
+        if_in_file_abort(os.path.join(STATIC_SITE_PATH, "_config.yml"), full_name, short_name)
+        # Check authors.txt too
+        if_in_file_abort(AUTHORS_PATH, full_name, short_name)
+        # Check if the name already has an author page on the site
+        author_file = author_file_for(full_name)
+        if author_file in os.listdir(os.path.join(STATIC_SITE_PATH, "_pages")):
+            print(author_file, "already exists. -- Aborting")
+            sys.exit(1)
+        # Done checks
+
+        # Now write author info to relevant files
+
+        # Add to authors.txt
+        with open(AUTHORS_PATH, "a") as f:
+            f.write(authors_txt_line(short_name, full_name))
+        print("Added to authors.txt")
+        # Add to jekyll config
+        with open(os.path.join(STATIC_SITE_PATH, "_config.yml"), "a") as f:
+            f.write(config_text(short_name, full_name, bio, ig))
+        print("Added to _config.yml")
+        # Add author webpage
+        with open(os.path.join(STATIC_SITE_PATH, "_pages", author_file), "w") as f:
+            f.write(author_page_text(short_name, full_name, author_file))
+        print("Added author webpage", author_file)
+        print()
+
+
+def read_batch(path):
+    """Returns the authors in a CSV or YAML batch file, as a list of dictionaries."""
+
+    with open(path, "r", newline="") as f:
+        if os.path.splitext(path)[1].lower() in (".yml", ".yaml"):
+            rows = yaml.safe_load(f) or []
+        else:
+            rows = list(csv.DictReader(f))
+
+    batch = []
+    for row in rows:
+        batch.append({
+            "full_name": " ".join(str(row.get("full_name") or "").split()),
+            "bio": str(row.get("bio") or "").strip() or DEFAULT_BIO,
+            "instagram": str(row.get("instagram") or "").strip() or DEFAULT_INSTAGRAM,
+        })
+    return batch
+
+
+def existing_names():
+    """Loads every name already in use into sets, once.
+
+    Returns (names, author_files): the short and full names in _config.yml's
+    authors and in authors.txt, and the filenames in _pages.
+    """
+
+    with open(os.path.join(STATIC_SITE_PATH, "_config.yml"), "r") as f:
+        config = yaml.safe_load(f) or {}
+    names = set()
+    for short_name, info in (config.get("authors") or {}).items():
+        names.add(str(short_name).lower())
+        if isinstance(info, dict) and info.get("name"):
+            names.add(str(info["name"]).lower())
+    for short_name, full_name in parse_authors_file(AUTHORS_PATH):
+        names.add(short_name.lower())
+        names.add(full_name.lower())
+
+    author_files = set(os.listdir(os.path.join(STATIC_SITE_PATH, "_pages")))
+    return names, author_files
+
+
+def check_batch(batch, names, author_files):
+    """Returns a list of every problem with the batch, empty if it can be added."""
+
+    problems = []
+    seen = set()
+    for number, author in enumerate(batch, 1):
+        full_name = author["full_name"]
+        where = "Author " + str(number) + " (" + (full_name or "no name") + "): "
+        if " " not in full_name:
+            problems.append(where + "needs a first and last name")
+            continue
+        if any(c in full_name + author["bio"] for c in '"\\'):
+            problems.append(where + "names and bios can't have quotes or backslashes")
+        short_name = short_name_for(full_name)
+        for name in (full_name, short_name):
+            if name.lower() in names:
+                problems.append(where + name + " is already an author")
+            elif name.lower() in seen:
+                problems.append(where + name + " is in the batch twice")
+        if author_file_for(full_name) in author_files:
+            problems.append(where + author_file_for(full_name) + " already exists")
+        seen.update((full_name.lower(), short_name.lower()))
+    return problems
+
+
+def _stage(path, content, append=False):
+    """Writes what path should contain to a temp file next to it, and returns the temp file's path."""
+
+    existing = ""
+    if append:
+        with open(path, "r") as f:
+            existing = f.read()
+    return storage.stage(path, existing + content)
+
+
+def add_batch(batch):
+    """Adds every author in the batch, writing each file once."""
+
+    authors_txt = ""
+    config = ""
+    pages = {}
+    for author in batch:
+        full_name = author["full_name"]
+        short_name = short_name_for(full_name)
+        author_file = author_file_for(full_name)
+        authors_txt += authors_txt_line(short_name, full_name)
+        config += config_text(short_name, full_name, author["bio"], author["instagram"])
+        pages[os.path.join(STATIC_SITE_PATH, "_pages", author_file)] = author_page_text(short_name, full_name, author_file)
+
+    # Everything is written to temp files first, and only swapped in once they all worked
+    staged = []
+    try:
+        staged.append((_stage(AUTHORS_PATH, authors_txt, append=True), AUTHORS_PATH))
+        config_path = os.path.join(STATIC_SITE_PATH, "_config.yml")
+        staged.append((_stage(config_path, config, append=True), config_path))
+        for path, content in pages.items():
+            staged.append((_stage(path, content), path))
+    except BaseException:
+        for tmp_path, _ in staged:
+            os.remove(tmp_path)
+        raise
+    for tmp_path, path in staged:
+        os.replace(tmp_path, path)
+
+
+def batch_mode(path):
+    batch = read_batch(path)
+    names, author_files = existing_names()
+    problems = check_batch(batch, names, author_files)
+    if problems:
+        for problem in problems:
+            print(problem)
+        print(str(len(problems)) + " problem(s), nothing was added. -- Aborting")
         sys.exit(1)
-    # Done checks
-
-    # Now write author info to relevant files
-
-    # Add to authors.txt
-    with open("authors.txt", "a") as f:
-        f.write('\n("' + short_name + '", "' + full_name + '")')  # Write ("jsmith", "John Smith")
-    print("Added to authors.txt")
-    # Add to jekyll config
-    with open(os.path.join(STATIC_SITE_PATH, "_config.yml"), "a") as f:
-        # Writes the following:
-        #  short_name:
-        #    name: "full_name"
-        #    bio: "bio"
-        #    instagram: ig
-        lines = [
-            "  " + short_name + ":",
-            '    name: "' + full_name + '"',
-            '    bio: "' + bio + '"',
-            '    instagram: ' + ig
-        ]
-
-        f.write("\n")
-        for line in lines:
-            f.write("\n" + line)
-    print("Added to _config.yml")
-    # Add author webpage
-    with open(os.path.join(STATIC_SITE_PATH, "_pages", author_file), "w") as f:
-        lines = [
-            "---",
-            'title: "' + full_name + '"',
-            "layout: default",
-            'permalink: "/' + author_file + '"',
-            "---",
-            "",
-            "{% include author-page.html author=site.authors." + short_name + ' authorname="' + short_name + '" %}'
-        ]
-        
-        for line in lines:
-            f.write(line + "\n")
-    print("Added author webpage", author_file)
-    print()
+
+    add_batch(batch)
+    for author in batch:
+        print("Added " + author["full_name"] + " (" + short_name_for(author["full_name"]) + ")")
+    print("Added " + str(len(batch)) + " author(s) to authors.txt, _config.yml and _pages. "
+          "You will need to rebuild the site for changes to appear.")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--batch", metavar="FILE", help="CSV or YAML file of authors to add at once")
+    args = parser.parse_args()
+
+    if args.batch:
+        batch_mode(args.batch)
+    else:
+        interactive()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,62 +1,190 @@
 #!/usr/bin/python3
 
+"""The admin site for the static site, made by create_app().
+
+Importing this module doesn't touch any files or databases. create_app()
+opens everything from its config, and with WARM_START loads the article
+catalog and author list up front, so under gunicorn --preload the workers
+share them copy-on-write instead of each building their own:
+
+    gunicorn --preload --workers 4 'app:create_app({"PROD": True})'
+
+Database connections, threads and process pools are all opened lazily in each
+worker after the fork.
+"""
+
 import flask
 from flask import Flask, redirect, render_template, request, url_for
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.pool import QueuePool
 import flask_login
 from flask_login import LoginManager, current_user
 from flask_wtf import FlaskForm
+from flask_wtf.csrf import validate_csrf
 from flask_wtf.file import FileField, FileAllowed, FileRequired
-from wtforms import StringField, PasswordField, BooleanField, SelectField
-from wtforms.validators import DataRequired
+from wtforms import StringField, PasswordField, BooleanField, SelectField, HiddenField
+from wtforms.validators import DataRequired, ValidationError
 from argon2 import PasswordHasher
 from argon2.exceptions import VerifyMismatchError, InvalidHash
 from urllib.parse import urlparse, urljoin
 from datetime import timedelta
 from werkzeug.utils import secure_filename
+from werkzeug.exceptions import RequestEntityTooLarge
 import os
-import pypandoc
+import ast
 import datetime
+import gc
 import time
-import shutil
-import yaml
 import logging
-from subprocess import Popen
-import platform
-
-
-STATIC_SITE_PATH = os.path.join("..", "static-site")
-UPLOADS_DIR = "uploads"
-DELETED_ARTICLES_PATH = "deletions"
-
-# Only considered in production on my server
-PROD = platform.node() == "jupiter"
-
+import sqlite3
+import json
+import uuid
+
+from catalog import ArticleCatalog, SECTIONS
+from catalog_store import CatalogStore
+import front_matter
+from jobs import JobQueue
+from publisher import PublishScheduler
+import journal
+from journal import ChangeJournal
+import conversion
+import images
+import metrics
+import audit
+import caching
+from caching import StaticFingerprints
+from audit import AuditLog, AuditHandler, AsyncLogging
+import tagging
+from filenames import reserve_filename
+from trash import TrashStore
+from user_cache import UserCache
+from authors import AuthorRegistry
+import passwords
+from passwords import PasswordVerifier
+
+
+# Defaults for create_app(), its config argument overrides them. Paths are relative to the working directory.
+DEFAULT_CONFIG = {
+    "STATIC_SITE_PATH": os.path.join("..", "static-site"),
+    "UPLOADS_DIR": "uploads",
+    # Deleted articles are kept here so they can be restored, see trash.py
+    "DELETED_ARTICLES_PATH": "deletions",
+    # Users, jobs and the audit trail
+    "DATABASE_PATH": "users.db",
+    # The users database for SQLAlchemy, made from DATABASE_PATH if None
+    "SQLALCHEMY_DATABASE_URI": None,
+    "CATALOG_DATABASE_PATH": "catalog.db",
+    # Converted documents kept so the same upload isn't converted twice
+    "CONVERSION_CACHE_DIR": "conversion_cache",
+    "AUTHORS_PATH": "authors.txt",
+    # Git-ignored file with the secret key as a Python string literal, used if SECRET_KEY is None
+    "SECRET_KEY_PATH": "secret_key",
+    "SECRET_KEY": None,
+    # Static site paths changed since the last update, see journal.py
+    "PUBLISH_JOURNAL_PATH": journal.PATH,
+    # Held while update_articles.sh runs, by this and by the script when it's run by hand
+    "PUBLISH_LOCK_PATH": "update_articles.lock",
+    # Lock files for editing posts' front matter, see front_matter.lock
+    "FRONT_MATTER_LOCK_DIR": "front_matter_locks",
+    # Argon2 parameters written by gen_argon_pass.py --calibrate --write
+    "ARGON2_PARAMS_PATH": passwords.PARAMS_PATH,
+    # Largest request in bytes, including the document and photo. Bigger ones are refused before they're read
+    "MAX_CONTENT_LENGTH": 50 * 1024 * 1024,
+    # Metrics added up across every worker, for /metrics (None to keep them per process)
+    "METRICS_DATABASE_PATH": "metrics.db",
+    "LOG_PATH": "app.log",
+    # Also log every request as a JSON line with its id and phase timings, to this file (None to not)
+    "REQUEST_LOG_PATH": None,
+    # Only publishes to the main website when True, on the server
+    "PROD": False,
+    # Load the catalog and authors in create_app(), before gunicorn forks
+    "WARM_START": True,
+}
+# Document conversions at once, each in its own process
+CONVERSION_WORKERS = 2
+# Most converted documents to keep
+CONVERSION_CACHE_MB = 200
+# Seconds to wait for more edits before updating the static site, and the most to wait in total
+PUBLISH_DELAY = 30
+PUBLISH_MAX_DELAY = 300
+# Deleted articles can be restored until they're this old or the trash is this big
+TRASH_MAX_AGE_DAYS = 90
+TRASH_MAX_MB = 1024
+# Deleted articles listed on the dashboard
+TRASH_SHOWN = 10
+# Static files the dashboard links to, part of its ETag
+INDEX_STATIC_FILES = ("styles/style.css", "scripts/article_search.js")
+# How long a loaded user is trusted for in seconds, and how many are kept
+USER_CACHE_TTL = 60
+USER_CACHE_SIZE = 256
+SQLITE_BUSY_TIMEOUT_MS = 5000
+# Accounts that aren't listed as authors
+NON_AUTHOR_USERS = ("admin",)
+# Argon2 verifications at once, each takes a lot of CPU and memory
+LOGIN_VERIFY_CONCURRENCY = 2
+# Responses bigger than this are gzipped, if they're one of these types
+GZIP_MIN_BYTES = 1024
+GZIP_MIMETYPES = ("text/html", "application/json")
+
+
+# The site's parts, shared by every request and made by create_app(), so there's one site per process
+settings = None  # The app's config
+password_verifier = None
+audit_log = None
+static_fingerprints = None
+catalog = None
+change_journal = None
+trash = None
+publisher = None
+jobs = None
+authors = None
+
+# Every page, create_app() registers it on the app
+bp = flask.Blueprint("admin", __name__)
+db = SQLAlchemy()
+
+
+@event.listens_for(Engine, "connect")
+def _tune_sqlite(dbapi_connection, connection_record):
+    """Sets up every new SQLite connection for several workers using the database at once."""
+
+    if not isinstance(dbapi_connection, sqlite3.Connection):
+        return
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")  # Readers don't block writers
+    cursor.execute("PRAGMA busy_timeout=" + str(SQLITE_BUSY_TIMEOUT_MS))  # Wait for locks instead of failing
+    cursor.execute("PRAGMA synchronous=NORMAL")  # Safe with WAL, and much fewer fsyncs
+    cursor.execute("PRAGMA temp_store=MEMORY")
+    cursor.close()
 
-app = Flask(__name__)
-# Read secret key from git-ignored file for security
-with open("secret_key", "r") as f:
-    app.secret_key = eval(f.readlines()[0].strip())
-
-# *** Setup Database ***
-app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///./users.db'
-app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False  # Save memory
-db = SQLAlchemy(app)
 
 # User class is defined lower down
 # ------
 
 # *** Setup login objects ***
 login_manager = LoginManager()
-login_manager.init_app(app)
-login_manager.login_view = "login"
+login_manager.login_view = "admin.login"
 # TODO: Check github thread about this
 flask_login.COOKIE_DURATION = timedelta(days=7)
 
 
+def _load_user_from_db(username):
+    user = User.query.filter_by(username=username).first()
+    if user is not None:
+        # Detach it from this request's session, so the cache can share it between requests
+        db.session.expunge(user)
+    return user
+
+
+# Users are loaded on every request, so keep them around for a bit
+user_cache = UserCache(_load_user_from_db, ttl=USER_CACHE_TTL, max_size=USER_CACHE_SIZE)
+
+
 @login_manager.user_loader
 def load_user(user_id):
-    return User.query.filter_by(username=user_id).first()
+    return user_cache.get(user_id)
 
 
 class LoginForm(FlaskForm):
@@ -70,20 +198,83 @@ class LoginForm(FlaskForm):
 
 # *** Helper functions ***
 
-ph = PasswordHasher()
-
-logging.basicConfig(filename='app.log', level=logging.INFO, format='%(asctime)s: %(levelname)s:%(message)s', datefmt="%x %I:%M:%S %p")
-
+metrics.describe("admin_jobs_total", "counter", "Background jobs finished, by kind and status.")
+metrics.describe("admin_conversion_cache_total", "counter", "Document conversions, by whether they were cached.")
+metrics.describe("admin_logins_total", "counter", "Login attempts, by result.")
+metrics.describe("admin_publishes_total", "counter", "Static site updates, by result.")
+
+request_log = logging.getLogger("requests")
+
+
+@bp.before_app_request
+def start_request_timer():
+    flask.g.request_id = uuid.uuid4().hex[:16]
+    flask.g.request_start = time.perf_counter()
+    metrics.registry.start_request()
+
+
+_resumed_pid = None
+
+
+@bp.before_app_request
+def resume_jobs():
+    # Jobs left queued by a restart are started by each worker's first request, after gunicorn forks
+    global _resumed_pid
+    if _resumed_pid != os.getpid():
+        _resumed_pid = os.getpid()
+        jobs.resume()
+
+
+@bp.app_url_defaults
+def fingerprint_static_urls(endpoint, values):
+    # Every url_for('static', ...) gets ?v=<hash of the file>
+    if endpoint == "static" and "filename" in values and "v" not in values:
+        fingerprint = static_fingerprints.get(values["filename"])
+        if fingerprint is not None:
+            values["v"] = fingerprint
+
+
+@bp.after_app_request
+def cache_and_compress(response):
+    if request.endpoint == "static" and request.args.get("v"):
+        if request.args["v"] == static_fingerprints.get(request.view_args["filename"]):
+            # The URL changes along with the file, so this one never goes stale
+            response.headers["Cache-Control"] = "public, max-age=" + str(caching.STATIC_MAX_AGE) + ", immutable"
+    return caching.gzip_response(response, request.accept_encodings, GZIP_MIN_BYTES, GZIP_MIMETYPES)
+
+
+@bp.after_app_request
+def record_request_timing(response):
+    duration = time.perf_counter() - flask.g.request_start
+    phases = metrics.registry.finish_request()
+    endpoint = request.endpoint or "none"
+    metrics.observe("admin_request_seconds", duration, endpoint=endpoint)
+    metrics.inc("admin_requests_total", endpoint=endpoint, method=request.method, status=response.status_code)
+    response.headers["X-Request-Id"] = flask.g.request_id
+    if settings["REQUEST_LOG_PATH"]:
+        request_log.info(json.dumps({
+            "time": time.time(),
+            "request_id": flask.g.request_id,
+            "user": str(current_user) if current_user.is_authenticated else None,
+            "method": request.method,
+            "endpoint": endpoint,
+            "path": request.path,
+            "status": response.status_code,
+            "seconds": round(duration, 6),
+            "phases": {phase: round(seconds, 6) for phase, seconds in phases.items()},
+        }))
+    return response
+
+
+def user_log(msg, level=logging.INFO, action=None, article=None, detail=None, user=None):
+    """Logs msg as done by user, the current user by default.
+
+    With an action, like "delete", it's also an audit event about article.
+    """
 
-def user_log(msg, level=logging.INFO):
-    if level == logging.INFO:
-        logging.info(str(current_user) + ": " + msg)
-    elif level == logging.WARNING:
-        logging.warning(str(current_user) + ": " + msg)
-    elif level == logging.ERROR:
-        logging.error(str(current_user) + ": " + msg)
-    elif level == logging.CRITICAL:
-        logging.critical(str(current_user) + ": " + msg)
+    user = user or str(current_user)
+    logging.log(level, user + ": " + msg, extra={"user": user, "action": action, "article": article, "detail": detail,
+                                                 "request_id": flask.g.get("request_id")})
 
 
 def is_safe_url(target):
@@ -118,164 +309,161 @@ def iso8601_date():
     return iso8601_datetime()[:-9]
 
 
-def prepend(file, text):
-    """Prepends the provided text to a provided file."""
-
-    with open(file, "r+") as f:
-        lines = f.readlines()
-        f.seek(0)
-        f.write(text)
-        f.writelines(lines)
-
-
 def _find_article_path(file):
     """Finds the path of article, given the full filename.
 
     Looks in the regular articles directory first, then Bear Air.
     """
 
-    filepath = os.path.join(STATIC_SITE_PATH, "articles/_posts/", file)
+    filepath = os.path.join(settings["STATIC_SITE_PATH"], "articles/_posts/", file)
     if not os.path.isfile(filepath):
-        filepath = os.path.join(STATIC_SITE_PATH, "bear_air/_posts/", file)
+        filepath = os.path.join(settings["STATIC_SITE_PATH"], "bear_air/_posts/", file)
         if not os.path.isfile(filepath):
             raise FileNotFoundError
 
     return filepath
 
 
-def _find_article_image_path(file):
-    """Given the full filename of an article, it finds the image for that article, if any.
+def _image_paths(fm):
+    """Returns the paths of the title photo and its resized copies in some front matter."""
+
+    paths = []
+    if fm.get("image"):
+        paths.append(fm["image"])
+    for variant in fm.get("image_variants") or []:
+        if isinstance(variant, dict) and variant.get("path"):
+            paths.append(variant["path"])
+    return [os.path.join(settings["STATIC_SITE_PATH"], path.lstrip("/")) for path in paths]
+
+
+def _find_article_image_paths(file):
+    """Given the full filename of an article, returns the paths of its images that no other article uses.
 
-    Raises FileNotFoundError if the image cannot be found / doesn't exist.
+    Resized copies are shared by articles with the same photo, so those stay.
     """
 
-    print("*** Article", file)
-    front_matter = get_front_matter(file)
-    print("*** Front matter", front_matter)
-    if "image" in front_matter:
-        return os.path.join(STATIC_SITE_PATH, front_matter["image"])
-    else:
-        raise FileNotFoundError
-
-
-def _front_matter_line_indexes(file):
-    filepath = _find_article_path(file)
-    start = None
-    line = None
-    with open(filepath, "r") as f:
-        for i, line in enumerate(f):
-            if line == "":
-                # Unexpected EOF
-                return None, None
-            if line == "---\n":
-                if start is None:
-                    start = i
-                else:
-                    # Second "---""
-                    return start, i
+    try:
+        paths = _image_paths(get_front_matter(file))
+    except ValueError:
+        return []  # Unreadable front matter, so there's no way to tell
+    in_use = set()
+    for article in get_snapshot().articles:
+        if article.filename != file:
+            in_use.update(_image_paths(article.front_matter))
+    return [path for path in dict.fromkeys(paths)
+            if path not in in_use and not os.path.relpath(path, settings["STATIC_SITE_PATH"]).startswith("..")]
 
 
 def get_front_matter(file):
     """Return the article's front matter as a dictionary."""
 
-    # Could raise FileNotFound or TypeError
-    filepath = _find_article_path(file)
-    start, end = _front_matter_line_indexes(file)
-
-    front_matter = ""
-    with open(filepath, "r") as f:
-        for i, line in enumerate(f):
-            if i >= end:  # Skip ending "---"
-                break
-            if i > start:  # Skip starting line "---"
-                front_matter += line
-        
-    return yaml.load(front_matter)
-
-
-def set_front_matter(file, key, value):
-    filepath = _find_article_path(file)
-    front_matter = get_front_matter(file)
-    front_matter[key] = value
-    yaml_front_matter = yaml.dump(front_matter).splitlines(True)  # List of front matter lines as YAML strings
-    start, end = _front_matter_line_indexes(file)
-    with open(filepath, 'r+') as f:
-        lines = f.readlines()
-        # Remove old front matter
-        # Iterate through each front matter line, excluding the "---" lines
-        for i in range(end - (start + 1)):
-            lines.pop(start + 1)  # Index can stay the same because the items move down after the pop
-        # Add in new front matter
-        lines = lines[:start + 1] + yaml_front_matter + lines[start + 1:]
-        # Save
-        f.seek(0)
-        f.writelines(lines)
-
-
-# Global LayoutForm choices
-# Using [(article_file, article_title),...] format
-article_choices = [("", "")]  # Always one choice to prevent errors
-non_featured_choices = [("", "")]
-featured_choices = [("", "")]
-
-
-def populate_layout_choices(form):
-    """Repopulates those global vars, but only actually affects LayoutForm properly."""
-
-    global article_choices, non_featured_choices, featured_choices
-
-    # Reset vars
-    article_choices = [("", "")]  # Always one choice to prevent errors
-    non_featured_choices = [("", "")]
-    featured_choices = [("", "")]
-
-    # List comprehension to generate a formatted, sorted (by date and title), list of articles
-    # Vars for list comprehension, because sorting has to be done before with a variable
-    # Sorting in place won't work
-    sorted_article_posts = os.listdir(os.path.join(STATIC_SITE_PATH, "articles/_posts/"))
-    sorted_article_posts.sort()
-    article_choices.extend([(f, get_front_matter(f)["title"]) for f in sorted_article_posts])
-    # Include Bear Air posts, with a divider that returns nothing if selected
-    sorted_bear_air_posts = os.listdir(os.path.join(STATIC_SITE_PATH, "bear_air/_posts/"))
-    sorted_bear_air_posts.sort()
-    article_choices.extend([("", "--- Bear Air ---")])
-    article_choices.extend([(f, get_front_matter(f)["title"]) for f in sorted_bear_air_posts])
-    
-    # Weed out bad articles
-    for article in article_choices[1:]:  # Skip default empty first option
-        if article[0] != "":  # Skip empty divider options
-            try:
-                # Make sure every front matter has a tags variable, so later code doesn't have to check all the time
-                if "tags" not in get_front_matter(article[0]).keys():
-                    set_front_matter(article[0], "tags", [])
-                    continue
-            except (FileNotFoundError, TypeError):
-                # Remove articles that don't exist or have bad front matter
-                article_choices.remove(article)
-            
-            # We already know tags is in the front matter
-            if type(get_front_matter(article[0])["tags"]) == str:
-                # Some front matter has tags written like: tags: featured
-                # This means tags is a string, but later code relies on it being a list
-                set_front_matter(article[0], "tags", [get_front_matter(article[0])["tags"]])
-    # Sticky choices
-    form.sticky.choices = article_choices
-    # Featured choices
-    # featured_add should only show articles without the featured tag
-    for article in article_choices[1:]:
-        if article[0] == "":  # Add empty divider option
-            non_featured_choices.extend([article])  # Have to use extend on a tuple
-        elif "featured" not in get_front_matter(article[0])["tags"]:
-            non_featured_choices.extend([article])
-    
-    form.featured_add.choices = non_featured_choices
-    # featured_remove should only show articles with the featured tag
-    for article in article_choices[1:]:
-        if article[0] == "":  # Add empty divider options
-            featured_choices.extend([article])
-        elif "featured" in get_front_matter(article[0])["tags"]:
-            featured_choices.extend([article])
-    form.featured_remove.choices = featured_choices
+    # Could raise FileNotFound or ValueError
+    return front_matter.read(_find_article_path(file))
+
+
+def apply_tag_operations(snapshot, operations):
+    """Applies a batch of tag operations (see tagging.py), and returns the filenames of the changed posts.
+
+    Each changed post is written once, and they're all journaled together. The
+    caller still has to update the static site.
+    """
+
+    changed = tagging.apply(snapshot, operations)
+    if changed:
+        change_journal.record("set tags", *[snapshot.get(f).path for f in changed], user=str(current_user))
+        flask.g.pop("snapshot", None)  # It's out of date now
+    user_log("Tag operations " + ", ".join(o["op"] + " " + o["tag"] + " " + o["article"] for o in operations)
+             + " changed: " + (", ".join(changed) or "nothing"))
+    if changed:
+        new_snapshot = get_snapshot()
+        for filename in changed:
+            old_tags, new_tags = set(snapshot.get(filename).tags), set(new_snapshot.get(filename).tags)
+            for tag in sorted(new_tags - old_tags):
+                user_log("Tagged " + filename + " " + tag, action="tag", article=filename, detail=tag)
+            for tag in sorted(old_tags - new_tags):
+                user_log("Untagged " + filename + " " + tag, action="untag", article=filename, detail=tag)
+    return changed
+
+
+def update_static_site(now=False):
+    """Schedules an update of the static site, so changes show up on the website."""
+
+    publisher.request(now=now)
+
+
+# Conversion cache hits and misses since this process started
+conversion_cache_stats = {"hit": 0, "miss": 0}
+
+
+def _job_done(job):
+    """Called in the background when a job finishes or fails for good."""
+
+    metrics.inc("admin_jobs_total", kind=job["kind"], status=job["status"])
+    if job["status"] != "done":
+        logging.error(job["user"] + ": Job " + str(job["id"]) + " failed: " + job["error"])
+        if job["kind"] == "upload":
+            conversion.discard_upload(job["params"])  # It has to be uploaded again
+        return
+
+    result = job["result"]
+    if job["kind"] == "upload":
+        logging.info(job["user"] + ": Uploaded article " + job["params"]["md_filename"] + " (job " + str(job["id"]) + ")")
+        if result.get("seconds") is not None:
+            metrics.observe_phase("conversion", result["seconds"])
+        if result.get("cache"):
+            conversion_cache_stats[result["cache"]] += 1
+            metrics.inc("admin_conversion_cache_total", result=result["cache"])
+            logging.info("Conversion cache " + result["cache"] + " for " + job["params"]["md_filename"] + " ("
+                         + str(conversion_cache_stats["hit"]) + " hits, " + str(conversion_cache_stats["miss"])
+                         + " misses)")
+        change_journal.record("upload", result["post"], result["image"], user=job["user"])
+        update_static_site()
+        if result["image"]:
+            # Made after the article is already up, so it doesn't wait on the photo
+            jobs.submit("image", {"post_path": result["post"], "static_site_path": settings["STATIC_SITE_PATH"]},
+                        job["user"])
+    elif job["kind"] == "image":
+        if result["skipped"]:
+            logging.info("Skipped optimizing the photo of " + result["post"] + ": " + result["skipped"])
+            return
+        metrics.observe_phase("image_optimize", result["seconds"])
+        change_journal.record("optimize image", result["post"], result["removed"], *result["variants"], user=job["user"])
+        update_static_site()
+
+
+def get_snapshot():
+    """Returns the catalog snapshot for this request, refreshing the catalog the first time.
+
+    The snapshot is immutable, so it's safe to keep using it for the rest of the request.
+    Pop "snapshot" from flask.g after changing articles to get a new one.
+    """
+
+    if "snapshot" not in flask.g:
+        flask.g.snapshot = catalog.snapshot()
+    return flask.g.snapshot
+
+
+class ArticleChoice:
+    """Validates that a field is the filename of an article, optionally one with or without a tag.
+
+    An empty field is allowed, it means no article was picked. This replaces
+    SelectField choices, so the dashboard doesn't have to list every article.
+    """
+
+    def __init__(self, tag=None, without_tag=None):
+        self.tag = tag
+        self.without_tag = without_tag
+
+    def __call__(self, form, field):
+        if field.data == "":
+            return
+        article = get_snapshot().get(field.data)
+        if article is None:
+            raise ValidationError("No article with that filename.")
+        if self.tag is not None and self.tag not in article.tags:
+            raise ValidationError("That article isn't " + self.tag + ".")
+        if self.without_tag is not None and self.without_tag in article.tags:
+            raise ValidationError("That article is already " + self.without_tag + ".")
 
 # ------
 
@@ -297,41 +485,49 @@ class User(db.Model, flask_login.UserMixin):
         return self.username
 
 
-# Get names of users (members with accounts) first
-# [(username, fullname), (u2, f2), etc]
-MEMBERS_TUPLES = [("", "")]  # Empty starter to detect if no author was selected
-# Add all authors with accounts in the database
-users = User.query.all()
-for user in range(1, User.query.count()):  # Skip admin account
-    MEMBERS_TUPLES.append((users[user].username, users[user].fullname))
-# Now add all potential authors who don't have accounts, from the authors file
-# TODO: Authors are incomplete
-with open("authors.txt", "r") as f:
-    line = f.readline()
-    while line:
-        if line.strip() != "":
-            MEMBERS_TUPLES.extend([eval(line)])
-        line = f.readline()
+@event.listens_for(User, "after_insert")
+@event.listens_for(User, "after_update")
+@event.listens_for(User, "after_delete")
+def _user_changed(mapper, connection, target):
+    # Changed roles or passwords take effect right away in this process
+    user_cache.invalidate(target.username)
+    authors.invalidate_users()
+
+
+def _load_author_users():
+    """Returns the (username, fullname) of every member with an account who can be an author."""
+
+    return [(u.username, u.fullname) for u in User.query.filter(~User.username.in_(NON_AUTHOR_USERS))]
+
 
 
 class ArticleForm(FlaskForm):
     file = FileField("Document", validators=[FileRequired(), FileAllowed(['doc', 'docx', 'md'], 'Documents only!')])
-    author = SelectField("Author", choices=MEMBERS_TUPLES)
+    author = SelectField("Author")  # Choices set when the form is made
     title = StringField("Article Title", validators=[DataRequired()])
     photo = FileField("Title photo (optional)", validators=[FileAllowed(['png', 'jpg', 'jpeg'], "Pictures only!")])
     bear_air = BooleanField("Bear Air post")
 
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.author.choices = authors.choices()
+
 
 class LayoutForm(FlaskForm):
-    sticky = SelectField("Select Article")  # Choices set when rendered
+    # Article filenames, searched for on the page through /api/articles
+    sticky = StringField("Select Article", validators=[ArticleChoice()])
     replace_current_sticky = BooleanField("Replace the current stickied article(s)")
-    featured_add = SelectField("Add an article")  # Choices set when rendered
-    featured_remove = SelectField("Remove an article")
+    featured_add = StringField("Add an article", validators=[ArticleChoice(without_tag="featured")])
+    featured_remove = StringField("Remove an article", validators=[ArticleChoice(tag="featured")])
     remove_all_featured = BooleanField("Remove all currently Featured articles")
+    # Versions of the chosen articles from the search, so a change made since isn't overwritten
+    sticky_version = HiddenField()
+    featured_add_version = HiddenField()
+    featured_remove_version = HiddenField()
 
 
 class AdminForm(FlaskForm):
-    articles = SelectField("Select Article")
+    articles = StringField("Select Article", validators=[ArticleChoice()])
 
 
 class ForceUpdateForm(FlaskForm):
@@ -341,210 +537,407 @@ class ForceUpdateForm(FlaskForm):
 
 # *** Begin web server code ***
 
-@app.route("/", methods=["GET", "POST"])
+def wants_json():
+    """Returns True if the request should get JSON back instead of a redirect."""
+
+    return request.is_json or request.accept_mimetypes.best == "application/json"
+
+
+def version_conflict_message(conflict):
+    return (os.path.basename(conflict.path) + " was changed by someone else since you picked it,"
+            " nothing was saved. Pick it again and resubmit.")
+
+
+def form_done(form_name, message=None, error=None, errors=None, status=400, **data):
+    """Finishes handling a form's POST.
+
+    JSON requests get data, or the error and each field's errors with status.
+    Everyone else gets the message or error flashed into the form's section
+    of the dashboard, and is redirected back to it.
+    """
+
+    if wants_json():
+        if error:
+            return flask.jsonify(error=error, errors=errors or {}), status
+        return flask.jsonify(message=message, **data)
+    if error:
+        flask.flash(error, form_name + "_error")
+    elif message:
+        flask.flash(message, form_name)
+    return redirect(url_for("admin.index"))
+
+
+@bp.route("/")
 @flask_login.login_required
 def index():
-    # Setup forms and errors
-    article_form = ArticleForm()
+    # Each form posts to its own endpoint, which redirects back here
+    # Uploads that are still converting, or failed
+    recent_jobs = jobs.recent(user=str(current_user)) if current_user.role < 2 else []
+    # Recently deleted articles, for the admin to restore
+    trashed = trash.entries()[:TRASH_SHOWN] if current_user.role == 0 else []
+
+    # The page only changes with the user, their jobs, the trash and the author list, plus the CSRF tokens
+    # in it, which are renewed well before they expire. Articles are searched for by the page itself,
+    # so they're left out. The static files it links to are included, so a deploy shows up right away
+    etag = caching.etag_for(current_user.username, current_user.role,
+                            [(j["id"], j["status"], j["updated"]) for j in recent_jobs], [e["id"] for e in trashed],
+                            authors.choices(), [static_fingerprints.get(f) for f in INDEX_STATIC_FILES],
+                            int(time.time() // (flask.current_app.config["WTF_CSRF_TIME_LIMIT"] // 2)))
+    # Pending flashed messages have to be shown, so those pages are never cached
+    if "_flashes" not in flask.session and request.if_none_match.contains_weak(etag):
+        response = flask.Response(status=304)
+    else:
+        # Role determines what forms are displayed
+        response = flask.make_response(render_template(
+            'index.html', role=current_user.role, layout_form=LayoutForm(), article_form=ArticleForm(),
+            admin_form=AdminForm(), force_update_form=ForceUpdateForm(), recent_jobs=recent_jobs,
+            trashed=trashed))
+    # Weak, since gzip changes the bytes but not the page
+    response.set_etag(etag, weak=True)
+    response.headers["Cache-Control"] = "private, no-cache"
+    return response
+
+
+@bp.route("/layout", methods=["POST"])
+@flask_login.login_required
+def update_layout():
+    """Changes which articles are sticky and featured. JSON gets the new sticky and featured articles."""
+
+    if current_user.role >= 3:
+        return flask.abort(403)
     layout_form = LayoutForm()
+    if not layout_form.validate():
+        user_log("Error with layout form submission: " + str(layout_form.errors))
+        return form_done("layout_form", error="Error with submission.", errors=layout_form.errors)
+
+    # Go through each option in the layout_form and turn it into tag operations
+    # They are all applied at once, so each post is only written once
+    operations = []
+    if layout_form.replace_current_sticky.data:
+        # Remove the sticky tag from all posts
+        operations.append({"op": "remove", "tag": "sticky", "article": tagging.ALL_ARTICLES})
+    if layout_form.sticky.data != "":
+        # They want to sticky a post
+        operations.append({"op": "add", "tag": "sticky", "article": layout_form.sticky.data,
+                           "version": layout_form.sticky_version.data or None})
+    if layout_form.remove_all_featured.data:
+        # Remove the featured tag from all posts
+        operations.append({"op": "remove", "tag": "featured", "article": tagging.ALL_ARTICLES})
+    elif layout_form.featured_remove.data != "":
+        # elif - Only check this if we aren't removing all the featured articles
+        operations.append({"op": "remove", "tag": "featured", "article": layout_form.featured_remove.data,
+                           "version": layout_form.featured_remove_version.data or None})
+    if layout_form.featured_add.data != "":
+        # Add the featured tag to a post
+        operations.append({"op": "add", "tag": "featured", "article": layout_form.featured_add.data,
+                           "version": layout_form.featured_add_version.data or None})
+
+    try:
+        changed = apply_tag_operations(get_snapshot(), operations)
+    except ValueError as e:
+        user_log("Error with layout form tags: " + str(e))
+        return form_done("layout_form", error="Error with submission.")
+    except front_matter.VersionConflict as e:
+        user_log("Layout change conflicted: " + str(e), level=logging.WARNING)
+        return form_done("layout_form", error=version_conflict_message(e), status=409)
+    if changed:
+        update_static_site()
+
+    # Only the tag index is needed for the answer, the snapshot is already up to date
+    snapshot = get_snapshot()
+    message = ("Changed " + str(len(changed)) + " article(s).") if changed else "Nothing needed changing."
+    return form_done("layout_form", message, changed=changed, sticky=list(snapshot.tagged("sticky")),
+                     featured=list(snapshot.tagged("featured")))
+
+
+@bp.route("/articles", methods=["POST"])
+@flask_login.login_required
+def upload_article():
+    """Saves an uploaded article and queues its conversion. JSON gets the job, to poll /jobs/<id>."""
+
+    if current_user.role >= 2:
+        return flask.abort(403)
+    article_form = ArticleForm()
+    if not (article_form.validate() and article_form.author.data != ""):  # The only potential empty field
+        user_log("Error with article form submission: " + str(article_form.errors))
+        return form_done("article_form", error="Error with submission.", errors=article_form.errors)
+
+    # Begin process to change the document into a valid Jekyll post
+
+    # Save file
+    f = article_form.file.data
+    filename = secure_filename(f.filename)
+    # Calculate name and path after all processing to prevent future duplicates
+    # Name format is YYYY-MM-DD-file-name.md
+    # If a file with that name already exists,
+    # give it a name with a higher number
+    # Eg test.docx becomes test-2.docx or test-3.docx if test-2.docx exists
+    # This checks the uploads folder, as well as the folders with already existing articles
+    # It checks without the extension bc the article files will be .md
+    # The .md name is claimed in the uploads folder, so another upload can't take it
+    # while this one is converting
+    final_filename = reserve_filename(iso8601_date() + '-' + os.path.splitext(filename)[0] + ".md",
+                                      settings["UPLOADS_DIR"], taken=get_snapshot().filenames,
+                                      other_dirs=[os.path.join(settings["STATIC_SITE_PATH"], d) for _, d in SECTIONS])
+
+    # Save as upload filetype, but with new name, with date and duplicate number
+    filename = os.path.splitext(final_filename)[0] + os.path.splitext(filename)[1]
+    filepath = os.path.join(settings["UPLOADS_DIR"], filename)
+    with metrics.timed("upload_save"):
+        f.save(filepath, buffer_size=conversion.CHUNK_SIZE)  # Streamed to disk in chunks
+
+    # Process the title photo if it exists
+    p_filepath = None
+    if article_form.photo.data:
+        p = article_form.photo.data
+        # Saves it as article-name_photo.ext
+        # Note that the article name includes the date
+        p_filename = final_filename[:-3] + "_photo" + os.path.splitext(secure_filename(p.filename))[1]
+        p_filepath = os.path.join(settings["UPLOADS_DIR"], p_filename)
+        with metrics.timed("photo_save"):
+            p.save(p_filepath, buffer_size=conversion.CHUNK_SIZE)
+
+    # The article will now be processed and moved into the Static Site directory in the background
+    # The site is updated once the job is done
+    job_id = jobs.submit("upload", {
+        "upload_path": filepath,
+        "md_filename": final_filename,
+        "title": article_form.title.data,
+        "author": article_form.author.data,
+        "bear_air": article_form.bear_air.data,
+        "photo_path": p_filepath,
+        "uploads_dir": settings["UPLOADS_DIR"],
+        "static_site_path": settings["STATIC_SITE_PATH"],
+        "cache_dir": settings["CONVERSION_CACHE_DIR"],
+        "cache_max_bytes": CONVERSION_CACHE_MB * 1024 * 1024,
+    }, user=str(current_user))
+    user_log("Queued article " + final_filename + " as job " + str(job_id), action="upload", article=final_filename,
+             detail="job " + str(job_id))
+    response = form_done("article_form", "Uploaded, the article will appear once it's converted (job " + str(job_id) + ").",
+                         job_id=job_id, article=final_filename, status_url=url_for("admin.job_status", job_id=job_id))
+    if wants_json():
+        response.status_code = 202
+    return response
+
+
+@bp.route("/articles/delete", methods=["POST"])
+@flask_login.login_required
+def delete_article():
+    """Moves an article and its title photo to the deleted articles folder."""
+
+    if current_user.role != 0:
+        return flask.abort(403)
     admin_form = AdminForm()
+    if not (admin_form.validate() and admin_form.articles.data != ""):
+        user_log("Error with admin form submission: " + str(admin_form.errors))
+        return form_done("admin_form", error="Error with submission.", errors=admin_form.errors)
+
+    filename = admin_form.articles.data
+    try:
+        post_path = _find_article_path(filename)
+    except FileNotFoundError:
+        user_log("Tried to delete an article that doesn't exist", level=logging.ERROR)
+        return form_done("admin_form", error="That article is already deleted.", status=404)
+    # Found before the post is moved, since other articles are checked for the same images
+    image_paths = _find_article_image_paths(filename)
+    try:
+        entry = trash.delete(post_path, image_paths, user=str(current_user))
+    except FileNotFoundError:
+        return form_done("admin_form", error="That article is already deleted.", status=404)
+    trashed = [os.path.join(settings["STATIC_SITE_PATH"], path) for path in [entry["post"]] + entry["images"]]
+    change_journal.record("delete", *trashed, user=str(current_user))
+    user_log("Deleted article " + filename + " and " + str(len(entry["images"])) + " images", action="delete",
+             article=filename, detail="trash " + entry["id"])
+    update_static_site()
+    return form_done("admin_form", "Deleted " + filename + ".", deleted=filename, trash_id=entry["id"])
+
+
+@bp.route("/trash")
+@flask_login.login_required
+def trash_entries():
+    """Returns the deleted articles that can still be restored as JSON, newest first."""
+
+    if current_user.role != 0:
+        return flask.abort(403)
+    return flask.jsonify(entries=trash.entries())
+
+
+@bp.route("/trash/<entry_id>/restore", methods=["POST"])
+@flask_login.login_required
+def restore_article(entry_id):
+    """Moves a deleted article and its images back where they were."""
+
+    if current_user.role != 0:
+        return flask.abort(403)
+    form = ForceUpdateForm()  # Just for CSRF
+    if not form.validate():
+        return form_done("admin_form", error="Error with submission.", errors=form.errors)
+    try:
+        entry = trash.restore(entry_id)
+    except KeyError:
+        return form_done("admin_form", error="That article isn't in the trash anymore.", status=404)
+    except FileExistsError as e:
+        user_log("Couldn't restore " + entry_id + ", " + str(e) + " exists", level=logging.WARNING)
+        return form_done("admin_form", error="Couldn't restore it, " + str(e) + " already exists.", status=409)
+    restored = [os.path.join(settings["STATIC_SITE_PATH"], path) for path in [entry["post"]] + entry["images"]]
+    change_journal.record("restore", *restored, user=str(current_user))
+    user_log("Restored article " + entry["filename"], action="restore", article=entry["filename"],
+             detail="trash " + entry_id)
+    update_static_site()
+    return form_done("admin_form", "Restored " + entry["filename"] + ".", restored=entry["filename"])
+
+
+@bp.route("/publish", methods=["POST"])
+@flask_login.login_required
+def publish():
+    """Updates the static site now instead of waiting for more changes. JSON gets the publish status."""
+
+    if current_user.role >= 3:
+        return flask.abort(403)
     force_update_form = ForceUpdateForm()
-    layout_form_error = None
-    article_form_error = None
-    admin_form_error = None
-    change = False  # If an update is needed on the Static Site
-
-    # Populate before page load on GET
-    if current_user.role < 3:
-        populate_layout_choices(layout_form)
-        if current_user.role < 2:
-            admin_form.articles.choices = article_choices
-    
-    # Now check and process each form
-    # Extra checks beyond is_submitted are done, because this page has multiple forms
-    # request.form is used because the extra checks are done through a hidden value in
-    # the HTML.
-    # on the same POST endpoint. The current libs don't support other POST endpoints
-    # AFAIK.
-
-    if layout_form.is_submitted() and request.form["form_name"] == "layout_form":
-        if layout_form.validate():
-            # Go through each option in the layout_form and process it
-
-            if layout_form.replace_current_sticky.data:
-                # Remove the sticky tag from all posts
-                for article in article_choices[1:]:  # Skip empty default first option
-                    tags = get_front_matter(article[0])["tags"]
-                    if "sticky" in tags:
-                        tags.remove("sticky")  # Keep other tags in there
-                        set_front_matter(article[0], "tags", tags)
-                        change = True
-                user_log("Removed the sticky data from all posts")
-            if layout_form.sticky.data != "":
-                # They want to sticky a post
-                tags = get_front_matter(layout_form.sticky.data)["tags"]
-                if "sticky" not in tags:  # This post isn't already stickied
-                    tags.append("sticky")  # Keep other tags
-                    set_front_matter(layout_form.sticky.data, "tags", tags)
-                    change = True
-                    user_log("Stickied post " + layout_form.sticky.data)
-            if layout_form.remove_all_featured.data:
-                # Remove the featured tag from all posts
-                for article in featured_choices[1:]:
-                    tags = get_front_matter(article[0])["tags"]
-                    if "featured" in tags:
-                        tags.remove("featured")
-                        set_front_matter(article[0], "tags", tags)
-                        change = True
-                user_log("Removed the featured tag from all posts")
-            elif layout_form.featured_remove.data != "":
-                # elif - Only check this if we aren't removing all the featured articles
-                tags = get_front_matter(layout_form.featured_remove.data)["tags"]
-                if "featured" in tags:
-                    tags.remove("featured")
-                    set_front_matter(layout_form.featured_remove.data, "tags", tags)
-                    change = True
-                    user_log("Un-featured post " + layout_form.featured_remove.data)
-            if layout_form.featured_add.data != "":
-                # Add the featured tag to a post
-                tags = get_front_matter(layout_form.featured_add.data)["tags"]
-                if "featured" not in tags:  # It should be, this is just in case
-                    tags.append("featured")
-                    set_front_matter(layout_form.featured_add.data, "tags", tags)
-                    change = True
-                    user_log("Featured post " + layout_form.featured_add.data)
-        else:
-            layout_form_error = "Error with submission."
-            user_log("Error with layout form submission: " + str(layout_form.errors))
-        
-    if article_form.is_submitted() and request.form["form_name"] == "article_form":
-        if article_form.validate() and article_form.author.data != "":  # The only potential empty field
-            # Begin process to change the document into a valid Jekyll post
-
-            # Save file
-            f = article_form.file.data
-            filename = secure_filename(f.filename)
-            # Calculate name and path after all processing to prevent future duplicates
-            # Name format is YYYY-MM-DD-file-name.md
-            final_filename = iso8601_date() + '-' + os.path.splitext(filename)[0] + ".md"
-            og_final_filename = final_filename
-            # If a file with that name already exists,
-            # give it a name with a higher number
-            # Eg test.docx becomes test-2.docx or test-3.docx if test-2.docx exists
-            # This checks the uploads folder, as well as the folders with already existing articles
-            # It checks without the extension bc the article files will be .md
-            i = 2
-            while final_filename in os.listdir(UPLOADS_DIR) or \
-                final_filename in os.listdir(os.path.join(STATIC_SITE_PATH, "articles/_posts/")) or \
-                    final_filename in os.listdir(os.path.join(STATIC_SITE_PATH, "bear_air/_posts/")):
-                
-                final_filename = os.path.splitext(og_final_filename)[0] + "-" + str(i) + os.path.splitext(og_final_filename)[1]
-                i += 1
-            
-            # Save as upload filetype, but with new name, with date and duplicate number
-            filename = os.path.splitext(final_filename)[0] + os.path.splitext(filename)[1]
-            filepath = os.path.join(UPLOADS_DIR, filename)
-            f.save(filepath)
-            
-            # The article will now be processed and moved into the Static Site directory
-
-            md_filepath = os.path.join(UPLOADS_DIR, final_filename)
-            # Convert file
-            if filename[-3:] != ".md":
-                # Conversion needed - output file has same name but .md extension
-                pypandoc.convert_file(filepath, 'md', filters=['list_filter.hs'], outputfile=md_filepath)
-                os.remove(filepath)  # Delete original upload
-                # Update vars for converted file
-            # Process the title
-            title = article_form.title.data
-            # Process the title photo if it exists
-            if article_form.photo.data:
-                p = article_form.photo.data
-                # Saves it as article-name_photo.ext
-                # Note that the article name includes the date
-                p_filename = final_filename[:-3] + "_photo" + os.path.splitext(secure_filename(p.filename))[1]
-                p_filepath = os.path.join(UPLOADS_DIR, p_filename)
-                p.save(p_filepath)
-            # Add front matter
-            front_matter = {"layout": "post", "title": title, "author": article_form.author.data}
-            if article_form.photo.data:
-                front_matter["image"] = "assets/images/" + p_filename
-            prepend_text = "---\n" + yaml.dump(front_matter) + "---\n\n"  # Add openers and closers
-            prepend(md_filepath, prepend_text)
-            # Move files to the static site
-            if article_form.bear_air.data:  # It's a Bear Air post
-                shutil.move(md_filepath, os.path.join(STATIC_SITE_PATH, "bear_air/_posts/"))
-            else:
-                shutil.move(md_filepath, os.path.join(STATIC_SITE_PATH, "articles/_posts/"))
-            if article_form.photo.data:
-                shutil.move(p_filepath, os.path.join(STATIC_SITE_PATH, "assets/images/"))
-            
-            # Article processing is done!
-            change = True
-            user_log("Uploaded article " + final_filename)
-        else:
-            article_form_error = "Error with submission."
-            user_log("Error with article form submission: " + str(article_form.errors))
+    if not force_update_form.validate():  # For CSRF
+        return form_done("force_update_form", error="Error with submission.", errors=force_update_form.errors)
+    # Don't wait for more changes
+    update_static_site(now=True)
+    return form_done("force_update_form", "The main website is updating.", **publisher.status())
 
-    if admin_form.is_submitted() and request.form["form_name"] == "admin_form":
-        if admin_form.validate() and admin_form.articles.data != "":
-            # Try to send article to trash
-            try:
-                shutil.move(_find_article_path(admin_form.articles.data), DELETED_ARTICLES_PATH)
-                user_log("Deleted article " + admin_form.articles.data)
-                change = True
-            except FileNotFoundError:
-                admin_form_error = "That article is already deleted."
-                user_log("Tried to delete an article that doesn't exist", level=logging.ERROR)
-            except shutil.Error:
-                # Hopefully a "Destination path X already exists" error
-                # Which means an already deleted file has the same name
-                # XXX: The already-deleted file is permanently deleted
-                os.remove(os.path.join(DELETED_ARTICLES_PATH, admin_form.articles.data))
-                shutil.move(_find_article_path(admin_form.articles.data), DELETED_ARTICLES_PATH)
-                change = True
-                user_log("Permanently deleted, and then temp-deleted article " + admin_form.articles.data)
-            
-            # Now try to delete article photo if it exists
-            try:
-                shutil.move(_find_article_image_path(admin_form.articles.data), DELETED_ARTICLES_PATH)
-                user_log("Deleted article image for" + admin_form.articles.data)
-            except FileNotFoundError:
-                pass  # No article image
-            except shutil.Error:
-                # Hopefully a "Destination path X already exists" error
-                # Which means an already deleted file has the same name
-                # XXX: The already-deleted file is permanently deleted
-                os.remove(os.path.join(DELETED_ARTICLES_PATH, os.path.basename(_find_article_image_path(admin_form.articles.data))))
-                shutil.move(_find_article_path(admin_form.articles.data), DELETED_ARTICLES_PATH)
-                change = True
-                user_log("Permanently deleted, and then temp-deleted article photo for" + admin_form.articles.data)
-        else:
-            admin_form_error = "Error with submission."
-            user_log("Error with admin form submission: " + str(admin_form.errors))
-
-    if force_update_form.is_submitted() and request.form["form_name"] == "force_update_form":
-        if force_update_form.validate():  # For CSRF
-            change = True
-
-    # Repopulate after POST so that options are updated
-    if current_user.role < 3:
-        populate_layout_choices(layout_form)
-        if current_user.role < 2:
-            admin_form.articles.choices = article_choices
-
-    if change:
-        if PROD:
-            Popen("./update_articles.sh")
-        else:
-            user_log("Skipped actually updating because not running in production")
-    # Role determines what forms are displayed
-    return render_template('index.html', role=current_user.role, layout_form=layout_form, article_form=article_form,
-                           admin_form=admin_form, force_update_form=force_update_form, layout_form_error=layout_form_error,
-                           article_form_error=article_form_error, admin_form_error=admin_form_error)
+
+@bp.route("/jobs/<int:job_id>")
+@flask_login.login_required
+def job_status(job_id):
+    """Returns the status of a conversion job as JSON, for polling."""
+
+    job = jobs.get(job_id)
+    if job is None or (job["user"] != str(current_user) and current_user.role > 0):
+        return flask.abort(404)
+    return flask.jsonify(id=job["id"], status=job["status"], error=job["error"], attempts=job["attempts"],
+                         article=job["params"]["md_filename"], result=job["result"])
+
+
+@bp.route("/jobs/<int:job_id>/retry", methods=["POST"])
+@flask_login.login_required
+def job_retry(job_id):
+    """Queues a failed job again. Failed uploads are cleaned up, so they have to be uploaded again instead."""
+
+    form = ForceUpdateForm()  # Just for CSRF
+    job = jobs.get(job_id)
+    if not form.validate_on_submit() or job is None or (job["user"] != str(current_user) and current_user.role > 0):
+        return flask.abort(400)
+    if job["kind"] == "upload" and job["status"] == "failed":
+        return flask.abort(400)
+    if jobs.retry(job_id):
+        user_log("Retried job " + str(job_id), action="retry", article=job["params"].get("md_filename"),
+                 detail="job " + str(job_id))
+    return redirect(url_for("admin.index"))
+
+
+@bp.route("/api/articles")
+@flask_login.login_required
+def api_articles():
+    """Searches articles for the dashboard, and returns a page of them as JSON.
+
+    Query parameters: q (words to search titles, authors and filenames for),
+    section, tag, exclude_tag, page and per_page.
+    """
+
+    if current_user.role >= 3:
+        return flask.abort(403)
+    get_snapshot()  # Brings the shared catalog up to date
+    page = max(request.args.get("page", 1, type=int), 1)
+    per_page = min(max(request.args.get("per_page", 20, type=int), 1), 100)
+    articles, total = catalog.store.search(request.args.get("q", ""), section=request.args.get("section"),
+                                           tag=request.args.get("tag"), exclude_tag=request.args.get("exclude_tag"),
+                                           page=page, per_page=per_page)
+    return flask.jsonify(articles=articles, total=total, page=page, per_page=per_page)
 
 
-@app.route("/login", methods=['GET', 'POST'])
+@bp.route("/api/tags", methods=["POST"])
+@flask_login.login_required
+def api_tags():
+    """Applies a batch of tag operations, and returns the new sticky and featured articles.
+
+    Takes JSON like {"operations": [{"op": "add", "tag": "featured", "article": "2020-01-01-post.md"}]},
+    see tagging.py. The CSRF token goes in the X-CSRFToken header. Operations
+    with the "version" from /api/articles get a 409 and nothing is changed if
+    the article has changed since.
+    """
+
+    if current_user.role >= 3:
+        return flask.abort(403)
+    try:
+        validate_csrf(request.headers.get("X-CSRFToken"))
+    except ValidationError:
+        return flask.jsonify(error="Bad CSRF token"), 400
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict) or not isinstance(data.get("operations"), list):
+        return flask.jsonify(error="Expected a list of operations"), 400
+
+    try:
+        changed = apply_tag_operations(get_snapshot(), data["operations"])
+    except ValueError as e:
+        return flask.jsonify(error=str(e)), 400
+    except front_matter.VersionConflict as e:
+        user_log("Tag operations conflicted: " + str(e), level=logging.WARNING)
+        return flask.jsonify(error=version_conflict_message(e), article=os.path.basename(e.path), version=e.current), 409
+    if changed:
+        update_static_site()
+
+    snapshot = get_snapshot()
+    return flask.jsonify(changed=changed, sticky=list(snapshot.tagged("sticky")), featured=list(snapshot.tagged("featured")))
+
+
+@bp.route("/publish/status")
+@flask_login.login_required
+def publish_status():
+    """Returns when the static site was last updated, how long it took and if more is coming."""
+
+    return flask.jsonify(publisher.status())
+
+
+@bp.route("/metrics")
+@flask_login.login_required
+def metrics_endpoint():
+    """Request and phase timings added up across every worker process (from METRICS_DATABASE_PATH), for Prometheus.
+
+    With METRICS_DATABASE_PATH set to None, only this process's timings.
+    """
+
+    if current_user.role != 0:
+        return flask.abort(403)
+    return metrics.registry.render(), 200, {"Content-Type": "text/plain; version=0.0.4; charset=utf-8"}
+
+
+@bp.route("/audit")
+@flask_login.login_required
+def audit_events():
+    """Searches the audit log, newest first, and returns a page of events as JSON.
+
+    Query parameters: user, action (like upload, delete, tag, untag, login),
+    article (a filename), since and until (Unix times or ISO 8601 dates),
+    page and per_page.
+    """
+
+    if current_user.role != 0:
+        return flask.abort(403)
+    try:
+        since = audit.parse_time(request.args.get("since"))
+        until = audit.parse_time(request.args.get("until"))
+    except ValueError as e:
+        return flask.jsonify(error=str(e)), 400
+    page = max(request.args.get("page", 1, type=int), 1)
+    per_page = min(max(request.args.get("per_page", 50, type=int), 1), 500)
+    events, total = audit_log.search(user=request.args.get("user"), action=request.args.get("action"),
+                                     article=request.args.get("article"), since=since, until=until,
+                                     page=page, per_page=per_page)
+    return flask.jsonify(events=events, total=total, page=page, per_page=per_page)
+
+
+@bp.app_errorhandler(RequestEntityTooLarge)
+def upload_too_large(e):
+    return "That upload is too big, the limit is " + str(settings["MAX_CONTENT_LENGTH"] // (1024 * 1024)) + " MB. Go back and try a smaller file or photo.", 413
+
+
+@bp.route("/login", methods=['GET', 'POST'])
 def login():
     form = LoginForm()
     if form.validate_on_submit():
@@ -552,38 +945,148 @@ def login():
         user = User.query.filter_by(username=form.username.data).first()
         if user is None:
             # Username doesn't exist
+            metrics.inc("admin_logins_total", result="unknown_user")
+            user_log("Failed login, no such user", level=logging.WARNING, action="login_failed", user=form.username.data,
+                     detail="unknown user")
             return render_template('login.html', form=form, error="Username doesn't exist, ask Cole to give you an account.")
         else:
             # Username exists
             try:
-                ph.verify(user.hashpass, form.password.data)
+                needs_rehash = password_verifier.verify(user.hashpass, form.password.data)
+            except passwords.TooBusy:
+                metrics.inc("admin_logins_total", result="busy")
+                return render_template('login.html', form=form, error="Too many people are logging in right now, try again in a few seconds.")
             except VerifyMismatchError:
                 # Incorrect password
+                metrics.inc("admin_logins_total", result="wrong_password")
+                user_log("Failed login", level=logging.WARNING, action="login_failed", user=user.username,
+                         detail="wrong password")
                 return render_template('login.html', form=form, error='Incorrect password')
             except (InvalidHash, AttributeError):
                 # Password isn't setup correctly in the DB
                 return render_template('login.html', form=form, error="Database error, talk to Cole. Maybe your account hasn't been set up.")
 
+            if needs_rehash:
+                # Their hash was made with older parameters, so redo it while we have the password
+                try:
+                    user.hashpass = password_verifier.hash(form.password.data)
+                    db.session.commit()
+                    user_log("Rehashed password for " + user.username)
+                except passwords.TooBusy:
+                    pass  # The old hash still works, it's redone at a later login
+
             # Username and password are correct, so log them in
+            metrics.inc("admin_logins_total", result="ok")
             flask_login.login_user(user, remember=form.remember_me.data)
-            user_log("Logged in")
+            user_log("Logged in", action="login")
 
             next = flask.request.args.get('next')
             if not is_safe_url(next):
                 return flask.abort(400)
 
-            return flask.redirect(next or url_for('index'))
+            return flask.redirect(next or url_for('admin.index'))
     
     return render_template('login.html', form=form)
 
 
-@app.route('/logout')
+@bp.route('/logout')
 @flask_login.login_required
 def logout():
-    user_log("Logged out")
+    user_log("Logged out", action="logout")
     flask_login.logout_user()
-    return redirect(url_for("index"))
+    return redirect(url_for("admin.index"))
+
+
+def create_app(config=None):
+    """Makes the admin site's Flask app, with config overriding DEFAULT_CONFIG.
+
+    The site's parts are module globals used by every request, so this is
+    called once per process, before gunicorn forks if it's preloading.
+    """
+
+    global settings, password_verifier, audit_log, static_fingerprints, catalog, change_journal, trash, publisher, \
+        jobs, authors
+
+    app = Flask(__name__)
+    app.config.update(DEFAULT_CONFIG)
+    app.config.update(config or {})
+    settings = app.config
+    if settings["SECRET_KEY"] is None:
+        # Read secret key from git-ignored file for security
+        with open(settings["SECRET_KEY_PATH"], "r") as f:
+            settings["SECRET_KEY"] = ast.literal_eval(f.readline().strip())
+
+    settings['WTF_CSRF_TIME_LIMIT'] = 3600  # Flask-WTF's default, the dashboard's ETag depends on it
+
+    # *** Setup Database ***
+    if settings['SQLALCHEMY_DATABASE_URI'] is None:
+        # Absolute, since Flask-SQLAlchemy takes relative SQLite paths from this file's directory
+        settings['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + os.path.abspath(settings["DATABASE_PATH"])
+    settings['SQLALCHEMY_TRACK_MODIFICATIONS'] = False  # Save memory
+    # Keep a few connections open and reuse them, instead of reconnecting (and redoing the pragmas) every time
+    settings['SQLALCHEMY_ENGINE_OPTIONS'] = {
+        "poolclass": QueuePool,
+        "pool_size": 5,
+        "max_overflow": 5,
+        "connect_args": {"timeout": SQLITE_BUSY_TIMEOUT_MS / 1000, "check_same_thread": False},
+    }
+    db.init_app(app)
+    login_manager.init_app(app)
+    app.register_blueprint(bp)
+
+    front_matter.LOCK_DIR = settings["FRONT_MATTER_LOCK_DIR"]
+    if settings["METRICS_DATABASE_PATH"]:
+        metrics.registry.share(settings["METRICS_DATABASE_PATH"])
+
+    # Parameters from gen_argon_pass.py --calibrate, verified off the request thread
+    password_verifier = PasswordVerifier(PasswordHasher(**passwords.load_params(settings["ARGON2_PARAMS_PATH"])),
+                                         max_concurrent=LOGIN_VERIFY_CONCURRENCY)
+
+    # Logs are written by a background thread (and rotated by logrotate, see audit.file_handler),
+    # and audit events also go in the audit table for /audit
+    audit_log = AuditLog(settings["DATABASE_PATH"])
+    AsyncLogging([
+        audit.file_handler(settings["LOG_PATH"], format='%(asctime)s: %(levelname)s:%(message)s', datefmt="%x %I:%M:%S %p"),
+        AuditHandler(audit_log),
+    ])
+    if settings["REQUEST_LOG_PATH"]:
+        request_log.propagate = False
+        AsyncLogging([audit.file_handler(settings["REQUEST_LOG_PATH"], format="%(message)s")], logger=request_log)
+
+    static_fingerprints = StaticFingerprints(app.static_folder)
+    # Parses each post once and only re-parses posts that changed
+    # Shared with the other workers through SQLite
+    catalog = ArticleCatalog(settings["STATIC_SITE_PATH"], store=CatalogStore(settings["CATALOG_DATABASE_PATH"]))
+    # Static site paths changed since the last update, so only those are committed
+    change_journal = ChangeJournal(settings["PUBLISH_JOURNAL_PATH"], settings["STATIC_SITE_PATH"])
+    # Deleted articles and their images, purged in the background once they're old
+    trash = TrashStore(settings["DELETED_ARTICLES_PATH"], settings["STATIC_SITE_PATH"],
+                       max_age=TRASH_MAX_AGE_DAYS * 24 * 60 * 60, max_bytes=TRASH_MAX_MB * 1024 * 1024)
+    # Bursts of changes are published together, in the background
+    # The script is found next to this file whatever the working directory is, and is told where the
+    # static site is, see update_articles.sh
+    publisher = PublishScheduler([os.path.join(app.root_path, "update_articles.sh")], settings["PUBLISH_LOCK_PATH"],
+                                 delay=PUBLISH_DELAY, max_delay=PUBLISH_MAX_DELAY, enabled=settings["PROD"], change_journal=change_journal,
+                                 env={"STATIC_SITE_PATH": os.path.abspath(settings["STATIC_SITE_PATH"]),
+                                      "UPDATE_ARTICLES_LOCK": os.path.abspath(settings["PUBLISH_LOCK_PATH"])})
+    # Background document conversion and photo optimization, stored next to the users in the database
+    jobs = JobQueue(settings["DATABASE_PATH"], {"upload": conversion.process_upload, "image": images.process_post_image},
+                    max_workers=CONVERSION_WORKERS, on_done=_job_done)
+    # Members with accounts, then potential authors who don't have accounts from the authors file
+    # Loaded when the upload form is first used, and reloaded when either changes
+    authors = AuthorRegistry(settings["AUTHORS_PATH"], _load_author_users)
+
+    if settings["WARM_START"]:
+        with app.app_context():
+            catalog.snapshot()
+            authors.choices()
+            # Forked workers would share these connections, so they each open their own instead
+            db.get_engine().dispose()
+        # Moves what's loaded so far out of the garbage collector's way, so collections
+        # in the workers don't write to (and so copy) the memory they share with this process
+        gc.freeze()
+    return app
 
 
 if __name__ == "__main__":
-    app.run(debug=True)
+    create_app().run(debug=True)
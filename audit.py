@@ -0,0 +1,189 @@
+"""Logging off the request thread, and an audit trail of who did what to which article.
+
+Log records are put on a queue and written by a listener thread, so a request
+never waits on the disk. The listener writes them to a log file that rotates
+by size, and writes the ones with an audit action (like "upload", "delete" or
+"untag") to the audit table of a SQLite database as well, indexed so they can
+be searched by user, action, article and time.
+
+To make a record an audit event, log it with extra={"action": ..., "article": ...},
+and optionally "user", "detail" and "request_id".
+"""
+
+import atexit
+import logging
+import logging.handlers
+import os
+import queue
+import threading
+from datetime import datetime
+
+import storage
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS audit (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    time REAL NOT NULL,
+    user TEXT,
+    action TEXT NOT NULL,
+    article TEXT,
+    detail TEXT,
+    message TEXT,
+    request_id TEXT
+);
+CREATE INDEX IF NOT EXISTS audit_time ON audit (time);
+CREATE INDEX IF NOT EXISTS audit_user ON audit (user, time);
+CREATE INDEX IF NOT EXISTS audit_action ON audit (action, time);
+CREATE INDEX IF NOT EXISTS audit_article ON audit (article, time);
+"""
+
+
+class AuditLog:
+    """The audit table in the SQLite database at db_path."""
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        with storage.connect(self.db_path) as conn:
+            conn.executescript(_SCHEMA)
+
+    def add(self, events):
+        """Inserts a list of event dictionaries in one transaction."""
+
+        with storage.connect(self.db_path) as conn:
+            conn.executemany("INSERT INTO audit (time, user, action, article, detail, message, request_id)"
+                             " VALUES (:time, :user, :action, :article, :detail, :message, :request_id)", events)
+
+    def search(self, user=None, action=None, article=None, since=None, until=None, page=1, per_page=50):
+        """Returns (events, total) matching every filter given, newest first.
+
+        since and until are Unix times, and article matches a filename exactly.
+        """
+
+        where = []
+        args = []
+        for column, value in (("user", user), ("action", action), ("article", article)):
+            if value:
+                where.append(column + " = ?")
+                args.append(value)
+        if since is not None:
+            where.append("time >= ?")
+            args.append(since)
+        if until is not None:
+            where.append("time < ?")
+            args.append(until)
+        where_sql = (" WHERE " + " AND ".join(where)) if where else ""
+
+        with storage.connect(self.db_path) as conn:
+            total = conn.execute("SELECT COUNT(*) FROM audit" + where_sql, args).fetchone()[0]
+            rows = conn.execute("SELECT * FROM audit" + where_sql + " ORDER BY time DESC, id DESC LIMIT ? OFFSET ?",
+                                args + [per_page, (page - 1) * per_page]).fetchall()
+        return [dict(row) for row in rows], total
+
+
+class AuditHandler(logging.Handler):
+    """Writes records with an audit action to an AuditLog, ignoring the rest."""
+
+    def __init__(self, audit_log):
+        super().__init__()
+        self.audit_log = audit_log
+
+    def emit(self, record):
+        if getattr(record, "action", None) is None:
+            return
+        try:
+            self.audit_log.add([{
+                "time": record.created,
+                "user": getattr(record, "user", None),
+                "action": record.action,
+                "article": getattr(record, "article", None),
+                "detail": getattr(record, "detail", None),
+                "message": record.getMessage(),
+                "request_id": getattr(record, "request_id", None),
+            }])
+        except Exception:
+            self.handleError(record)
+
+
+class _QueueHandler(logging.handlers.QueueHandler):
+    def __init__(self, owner):
+        super().__init__(owner.queue)
+        self.owner = owner
+
+    def enqueue(self, record):
+        self.owner.start()
+        super().enqueue(record)
+
+
+class AsyncLogging:
+    """Sends records from a logger (the root one by default) through a queue to handlers run by a listener thread.
+
+    The listener is started on the first record, and again in a forked child,
+    since threads don't survive a fork.
+    """
+
+    def __init__(self, handlers, logger=None, level=logging.INFO):
+        self.handlers = handlers
+        self.queue = queue.Queue()
+        self.handler = _QueueHandler(self)
+        self._lock = threading.Lock()
+        self._listener = None
+        self._pid = None
+        logger = logger or logging.getLogger()
+        logger.setLevel(level)
+        logger.addHandler(self.handler)
+        atexit.register(self.stop)
+
+    def start(self):
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid != os.getpid():
+                if self._pid is not None:
+                    self.queue = self.handler.queue = queue.Queue()  # The parent's might be mid-use
+                self._listener = logging.handlers.QueueListener(self.queue, *self.handlers, respect_handler_level=True)
+                self._listener.start()
+                self._pid = os.getpid()
+
+    def stop(self):
+        """Writes out everything still queued and stops the listener."""
+
+        with self._lock:
+            if self._listener is not None and self._pid == os.getpid():
+                self._listener.stop()
+                self._listener = None
+                self._pid = None
+
+
+def file_handler(path, format, datefmt=None):
+    """Returns a handler appending to path, which reopens it if it's been moved.
+
+    Every worker process has its own handler on the same file, so none of them
+    rotate it. Rotate it with logrotate instead, which moves the file away and
+    the workers carry on in a new one, e.g. in /etc/logrotate.d/:
+
+        /path/to/admin/app.log {
+            size 10M
+            rotate 5
+            compress
+            missingok
+        }
+    """
+
+    handler = logging.handlers.WatchedFileHandler(path)
+    handler.setFormatter(logging.Formatter(format, datefmt=datefmt))
+    return handler
+
+
+def parse_time(value):
+    """Returns a Unix time from a query string value: a number, or an ISO 8601 date or datetime."""
+
+    if value is None or value == "":
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    try:
+        return datetime.fromisoformat(value).timestamp()  # Local time unless it has an offset
+    except ValueError:
+        raise ValueError("Bad time " + repr(value) + ", use a Unix time or YYYY-MM-DD[THH:MM:SS]")
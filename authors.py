@@ -0,0 +1,88 @@
+"""Registry of everyone who can be picked as the author of an article.
+
+That's the members with accounts, plus the writers in authors.txt who don't
+have one. The list is only built when first needed, and rebuilt when
+authors.txt changes or the users might have, so new authors show up without
+a restart.
+"""
+
+import ast
+import os
+import threading
+import time
+
+
+def parse_authors_file(path):
+    """Returns the (short_name, full_name) tuples in an authors file.
+
+    Each non-empty line is a Python tuple literal like ("jsmith", "John Smith").
+    They're parsed as literals only, never run as code. Raises ValueError
+    naming the line if one isn't a pair of strings.
+    """
+
+    authors = []
+    with open(path, "r") as f:
+        for number, line in enumerate(f, 1):
+            line = line.strip()
+            if line == "" or line.startswith("#"):
+                continue
+            try:
+                author = ast.literal_eval(line)
+            except (ValueError, SyntaxError):
+                author = None
+            if not (isinstance(author, tuple) and len(author) == 2 and all(isinstance(a, str) for a in author)):
+                raise ValueError(path + " line " + str(number) + ": expected (\"short_name\", \"Full Name\")")
+            authors.append((author[0], author[1].strip()))
+    return authors
+
+
+class AuthorRegistry:
+    """Builds and caches the author choices for ArticleForm.
+
+    load_users returns the (username, fullname) of the members with accounts
+    who can be authors. It's called again after invalidate_users(), or every
+    users_interval seconds in case another process changed the users.
+    """
+
+    def __init__(self, authors_path, load_users, users_interval=30):
+        self.authors_path = authors_path
+        self.load_users = load_users
+        self.users_interval = users_interval
+        self._lock = threading.Lock()
+        self._file_mtime = None
+        self._file_authors = []
+        self._users = None
+        self._users_loaded = 0
+        self._choices = None
+
+    def invalidate_users(self):
+        """Makes the next choices() reload the users."""
+
+        with self._lock:
+            self._users = None
+
+    def choices(self):
+        """Returns (("", ""), (short_name, full_name), ...), sorted by full name."""
+
+        with self._lock:
+            changed = False
+
+            mtime = os.stat(self.authors_path).st_mtime_ns
+            if mtime != self._file_mtime:
+                self._file_authors = parse_authors_file(self.authors_path)
+                self._file_mtime = mtime
+                changed = True
+
+            if self._users is None or time.monotonic() - self._users_loaded > self.users_interval:
+                users = sorted(self.load_users())
+                self._users_loaded = time.monotonic()
+                if users != self._users:
+                    self._users = users
+                    changed = True
+
+            if changed or self._choices is None:
+                authors = dict(self._file_authors)
+                authors.update(self._users)  # Their account's name wins
+                # Empty starter to detect if no author was selected
+                self._choices = (("", ""),) + tuple(sorted(authors.items(), key=lambda a: (a[1].lower(), a[0])))
+            return self._choices
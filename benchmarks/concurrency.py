@@ -0,0 +1,187 @@
+#!/usr/bin/python3
+
+"""Stress test for concurrent tag edits from several worker processes.
+
+Builds a throwaway admin site and static site, then forks --workers
+processes that each import the app on their own, like gunicorn workers, and
+hammer the same few posts with /api/tags at once:
+
+- merge: every request adds a new, unique tag to a random post. At the end
+  every one of those tags has to be in its post, or an update was lost.
+- versioned: every request sends the version it got from /api/articles, and
+  retries from a fresh search on a 409. Every accepted tag has to be in its
+  post, and no refused one can be.
+
+    python3 benchmarks/concurrency.py --workers 8 --rounds 200
+
+--no-lock turns off the per-post locks in the workers, to check that the
+test does catch lost updates. It exits with status 1 if anything was lost.
+"""
+
+import argparse
+import collections
+import contextlib
+import multiprocessing
+import os
+import random
+import re
+import shutil
+import sys
+import tempfile
+import time
+
+import yaml
+
+from fixture import check_stub, make_sites, pandoc_available, use_stub
+from suite import percentiles
+
+USERS = [("admin", "Admin", "admin", 0), ("layout", "Lay Out", "password", 2)]
+MAX_RETRIES = 50
+CSRF_PATTERN = re.compile(r'name="csrf_token" type="hidden" value="([^"]+)"')
+
+
+def _csrf_token(client, path):
+    return CSRF_PATTERN.search(client.get(path).get_data(as_text=True)).group(1)
+
+
+def _versions(client):
+    articles = client.get("/api/articles?per_page=100").get_json()["articles"]
+    return {a["filename"]: a["version"] for a in articles}
+
+
+def worker(index, admin_path, args, barrier, results):
+    """Runs in its own process: logs in, waits for the others, then sends both phases of requests."""
+
+    os.chdir(admin_path)
+    if args.stub:
+        use_stub()
+    sys.path.insert(0, admin_path)
+    import app as app_module
+    import front_matter
+    if args.stub:
+        check_stub()
+    if args.no_lock:
+        front_matter.lock = lambda *paths: contextlib.nullcontext()
+
+    client = app_module.create_app().test_client()
+    client.post("/login", data={"username": "layout", "password": "password",
+                                "csrf_token": _csrf_token(client, "/login")})
+    headers = {"X-CSRFToken": _csrf_token(client, "/")}
+    filenames = sorted(_versions(client))[:args.posts]
+    rng = random.Random(args.seed * 1000 + index)
+    result = {"merge": [], "merge_seconds": [], "accepted": [], "refused": [], "conflicts": 0,
+              "versioned_seconds": [], "errors": 0}
+
+    def send(operation):
+        start = time.perf_counter()
+        response = client.post("/api/tags", json={"operations": [operation]}, headers=headers)
+        return response, time.perf_counter() - start
+
+    barrier.wait()
+    for i in range(args.rounds):
+        filename = rng.choice(filenames)
+        tag = "merge-" + str(index) + "-" + str(i)
+        response, seconds = send({"op": "add", "tag": tag, "article": filename})
+        result["merge_seconds"].append(seconds)
+        if response.status_code == 200:
+            result["merge"].append((filename, tag))
+        else:
+            result["errors"] += 1
+
+    barrier.wait()
+    for i in range(args.rounds):
+        filename = rng.choice(filenames)
+        for attempt in range(MAX_RETRIES):
+            # Each attempt adds a different tag, so a refused one showing up later would be noticed
+            tag = "versioned-" + str(index) + "-" + str(i) + "-" + str(attempt)
+            version = _versions(client)[filename]
+            response, seconds = send({"op": "add", "tag": tag, "article": filename, "version": version})
+            result["versioned_seconds"].append(seconds)
+            if response.status_code != 409:
+                break
+            result["conflicts"] += 1
+            result["refused"].append((filename, tag))
+        if response.status_code == 200:
+            result["accepted"].append((filename, tag))
+        else:
+            result["errors"] += 1
+    results.put((index, result))
+
+
+def check(admin_path, results):
+    """Returns the number of lost merge and versioned updates, and refused ones that were applied anyway."""
+
+    sys.path.insert(0, admin_path)
+    import front_matter
+
+    static_path = os.path.join(os.path.dirname(admin_path), "static-site")
+    tags = {}
+    for section in ("articles/_posts", "bear_air/_posts"):
+        for name in os.listdir(os.path.join(static_path, section)):
+            try:
+                tags[name] = set(front_matter.get_tags(front_matter.read(os.path.join(static_path, section, name))))
+            except (ValueError, yaml.YAMLError):
+                pass  # Broken front matter, never edited
+
+    lost_merge = sum(tag not in tags[f] for r in results for f, tag in r["merge"])
+    lost_versioned = sum(tag not in tags[f] for r in results for f, tag in r["accepted"])
+    applied_refused = sum(tag in tags[f] for r in results for f, tag in r["refused"])
+    return lost_merge, lost_versioned, applied_refused
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Stress test concurrent tag edits across worker processes.")
+    parser.add_argument("--workers", type=int, default=4, help="Worker processes (default: %(default)s)")
+    parser.add_argument("--posts", type=int, default=5, help="Posts they all edit (default: %(default)s)")
+    parser.add_argument("--rounds", type=int, default=100, help="Requests per worker per phase (default: %(default)s)")
+    parser.add_argument("--seed", type=int, default=0, help="Seed for the posts and requests (default: %(default)s)")
+    parser.add_argument("--no-lock", action="store_true", help="Turn off the per-post locks, to see updates get lost")
+    parser.add_argument("--keep", action="store_true", help="Keep the temp sites and print where they are")
+    args = parser.parse_args()
+    args.stub = not pandoc_available()
+
+    tmp = tempfile.mkdtemp(prefix="admin-site-stress-")
+    try:
+        # Extra posts, since a few of the synthetic ones have broken front matter
+        admin_path = make_sites(tmp, USERS, posts=args.posts * 2, seed=args.seed)
+        context = multiprocessing.get_context("fork")
+        barrier = context.Barrier(args.workers)
+        results = context.Queue()
+        processes = [context.Process(target=worker, args=(i, admin_path, args, barrier, results))
+                     for i in range(args.workers)]
+        start = time.perf_counter()
+        for process in processes:
+            process.start()
+        collected = dict(results.get() for _ in processes)
+        for process in processes:
+            process.join()
+        seconds = time.perf_counter() - start
+        results = [collected[i] for i in sorted(collected)]
+
+        lost_merge, lost_versioned, applied_refused = check(admin_path, results)
+        totals = collections.Counter()
+        for r in results:
+            totals.update(merge=len(r["merge"]), accepted=len(r["accepted"]), conflicts=r["conflicts"],
+                          errors=r["errors"])
+        print(str(args.workers) + " workers, " + str(args.posts) + " posts, " + str(args.rounds) + " rounds each"
+              + (", without locks" if args.no_lock else "") + ", " + format(seconds, ".1f") + "s")
+        for name, key in (("merge", "merge_seconds"), ("versioned", "versioned_seconds")):
+            latency = percentiles([s for r in results for s in r[key]])
+            print(name.ljust(10) + " p50 " + format(latency["p50"], "7.2f") + " ms  p90 " + format(latency["p90"], "7.2f")
+                  + " ms  p99 " + format(latency["p99"], "7.2f") + " ms")
+        print("merge: " + str(totals["merge"]) + " tags added, " + str(lost_merge) + " lost")
+        print("versioned: " + str(totals["accepted"]) + " tags accepted, " + str(totals["conflicts"]) + " conflicts, "
+              + str(lost_versioned) + " lost, " + str(applied_refused) + " refused but applied")
+        if totals["errors"]:
+            print("errors: " + str(totals["errors"]))
+        failed = lost_merge or lost_versioned or applied_refused or totals["errors"]
+    finally:
+        if args.keep:
+            print("Kept the sites in " + tmp)
+        else:
+            shutil.rmtree(tmp, ignore_errors=True)
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,165 @@
+"""Throwaway admin and static sites for the benchmarks.
+
+make_sites() copies the admin site's code into a temp directory next to a
+synthetic static site, the same layout as on the server, so the app finds
+../static-site and its databases without touching the real ones. Point repo
+at another checkout (like a git worktree of an older commit) to benchmark
+that version instead.
+"""
+
+import importlib.util
+import os
+import random
+import shutil
+import sqlite3
+import sys
+
+from argon2 import PasswordHasher
+
+REPO_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# Put on sys.path by use_stub() to use the pandoc stub instead of pypandoc
+STUB_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "pandoc_stub")
+
+# What the admin site needs to run, everything else (databases, logs, uploads) starts empty
+CODE_PATTERNS = (".py", ".sh", ".hs")
+CODE_FILES = ("authors.txt", "argon2_params.json")
+CODE_DIRS = ("templates", "static")
+
+WORDS = ("school", "board", "budget", "team", "wins", "final", "music", "night", "review", "club", "debate",
+         "teachers", "strike", "robotics", "season", "opener", "art", "show", "prom", "dress", "code", "café",
+         "élève", "lunch", "line", "exam", "week", "survival", "guide", "bears", "hockey", "parking", "lot")
+SECTIONS = (("articles/_posts", 0.8), ("bear_air/_posts", 0.2))
+
+
+def pandoc_available():
+    """Returns True if pypandoc and pandoc are both installed.
+
+    pypandoc isn't imported, or it would stay in sys.modules and the stub
+    would never be used.
+    """
+
+    return importlib.util.find_spec("pypandoc") is not None and shutil.which("pandoc") is not None
+
+
+def use_stub():
+    """Makes the app's pypandoc imports get the stub, even if the real pypandoc was already imported."""
+
+    sys.modules.pop("pypandoc", None)
+    sys.path.insert(0, STUB_PATH)
+
+
+def check_stub():
+    """Raises RuntimeError if the pypandoc the app imported isn't the stub."""
+
+    if not getattr(sys.modules.get("pypandoc"), "STUB", False):
+        raise RuntimeError("The app imported the real pypandoc instead of the pandoc stub")
+
+
+def copy_code(repo, admin_path):
+    for name in os.listdir(repo):
+        src = os.path.join(repo, name)
+        if os.path.isfile(src) and (name.endswith(CODE_PATTERNS) or name in CODE_FILES):
+            shutil.copy(src, admin_path)
+    for name in CODE_DIRS:
+        shutil.copytree(os.path.join(repo, name), os.path.join(admin_path, name))
+
+
+def make_sites(tmp, users, posts=0, seed=0, repo=REPO_PATH):
+    """Makes an admin site and static site in tmp, and returns the admin site's path.
+
+    users is a list of (username, fullname, password, role). The first one
+    should be the admin, since it isn't listed as an author. posts is how many
+    synthetic posts to write, see write_posts().
+    """
+
+    admin_path = os.path.join(tmp, "admin-site")
+    static_path = os.path.join(tmp, "static-site")
+    for path in ("uploads", "deletions"):
+        os.makedirs(os.path.join(admin_path, path))
+    for path in ("articles/_posts", "bear_air/_posts", "assets/images", "_pages"):
+        os.makedirs(os.path.join(static_path, path))
+    copy_code(repo, admin_path)
+
+    with open(os.path.join(admin_path, "secret_key"), "w") as f:
+        f.write("'benchmark'\n")
+    with open(os.path.join(static_path, "_config.yml"), "w") as f:
+        f.write("title: Benchmark\nauthors:\n")
+
+    ph = PasswordHasher()
+    conn = sqlite3.connect(os.path.join(admin_path, "users.db"))
+    with conn:
+        conn.execute("CREATE TABLE user (username VARCHAR(40) NOT NULL PRIMARY KEY, fullname VARCHAR(40) NOT NULL,"
+                     " hashpass VARCHAR(77), role INTEGER)")
+        conn.executemany("INSERT INTO user VALUES (?, ?, ?, ?)",
+                         [(u, f, ph.hash(p), r) for u, f, p, r in users])
+    conn.close()
+
+    if posts:
+        write_posts(static_path, posts, [u for u, _, _, _ in users[1:]], seed=seed)
+    return admin_path
+
+
+def _front_matter(rng, i, title, author):
+    """Returns the front matter of a post, written the many ways old posts are."""
+
+    style = i % 10
+    quoted = '"' + title.replace('"', '') + '"'
+    lines = ["layout: post", "title: " + (quoted if style % 2 else "'" + title.replace("'", "''") + "'"),
+             "author: " + author]
+    if style == 0:
+        lines.append("tags: [" + ", ".join(rng.sample(("news", "sports", "arts", "opinion"), 2)) + "]")
+    elif style == 1:
+        lines.append("tags: featured")  # A string instead of a list
+    elif style == 2:
+        lines += ["tags:", "  - sticky", "  - news"]
+    elif style == 3:
+        lines.append("tags:")  # null
+    elif style == 4:
+        lines.append("image: assets/images/post-" + str(i) + "_photo.jpg")
+    elif style == 5:
+        lines.append("date: 20" + str(10 + i % 10) + "-0" + str(1 + i % 9) + "-1" + str(i % 10) + " 08:00:00 -0500")
+    elif style == 6:
+        lines += ["categories: [news]", "excerpt: >", "  A folded excerpt that goes", "  over a few lines."]
+    # 7 to 9 have no tags at all
+    return lines
+
+
+def write_posts(static_path, count, authors, seed=0):
+    """Writes count posts split across both sections, with messy legacy front matter.
+
+    About 1 in 10 have a title photo, some use CRLF line endings or have text
+    before the front matter, and a few have broken or missing front matter.
+    The same seed always gives the same posts.
+    """
+
+    rng = random.Random(seed)
+    for i in range(count):
+        section = SECTIONS[0][0] if rng.random() < SECTIONS[0][1] else SECTIONS[1][0]
+        words = rng.sample(WORDS, rng.randint(2, 6))
+        title = " ".join(words).capitalize()
+        date = "20" + str(10 + i % 10) + "-" + format(1 + i % 12, "02") + "-" + format(1 + i % 28, "02")
+        filename = date + "-" + "-".join(words) + "-" + str(i) + ".md"
+
+        header = _front_matter(rng, i, title, rng.choice(authors) if authors else "staff")
+        body = []
+        for _ in range(rng.randint(3, 30)):
+            body.append(" ".join(rng.choice(WORDS) for _ in range(rng.randint(10, 60))).capitalize() + ".")
+            if rng.random() < 0.2:
+                body.append("\n".join("- " + rng.choice(WORDS) for _ in range(rng.randint(2, 5))))
+        text = "---\n" + "\n".join(header) + "\n---\n\n" + "\n\n".join(body) + "\n"
+
+        damage = rng.random()
+        if damage < 0.01:
+            text = text.replace("layout: post", "layout: [post", 1)  # Broken YAML
+        elif damage < 0.02:
+            text = text.split("---\n", 2)[2]  # No front matter at all
+        elif damage < 0.1:
+            text = "\n" + text  # Something before the opening ---
+        newline = "\r\n" if i % 7 == 0 else "\n"
+        with open(os.path.join(static_path, section, filename), "w", newline=newline) as f:
+            f.write(text)
+
+        if i % 10 == 4:
+            with open(os.path.join(static_path, "assets/images", "post-" + str(i) + "_photo.jpg"), "wb") as f:
+                size = rng.randint(20, 200) * 1024
+                f.write(rng.getrandbits(size * 8).to_bytes(size, "little"))
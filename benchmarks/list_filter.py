@@ -0,0 +1,183 @@
+#!/usr/bin/python3
+
+"""Checks that list_filter.py gives the same output as list_filter.hs, and times both.
+
+Run from the repo root:
+    python3 benchmarks/list_filter.py
+    python3 benchmarks/list_filter.py samples/*.docx
+
+First compactify_lists is checked on hand-built ASTs, which doesn't need
+pandoc. Then each document is converted with list_filter.py and compared to
+what list_filter.hs gives: its .expected.md file in list_samples/ for the
+sample documents, or by running list_filter.hs for the ones given (which
+needs runhaskell). With no documents, the samples in list_samples/ are used.
+
+--write-expected redoes the samples' .expected.md files with list_filter.hs,
+after a pandoc upgrade for example, since pandoc's Markdown output changes
+between versions. The version they were made with is in PANDOC_VERSION.
+Exits with 1 if anything is different.
+"""
+
+import argparse
+import copy
+import glob
+import os
+import shutil
+import sys
+import time
+
+import pypandoc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import list_filter  # noqa: E402
+
+SAMPLES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "list_samples")
+HASKELL_FILTER = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "list_filter.hs")
+
+
+def _text(words):
+    inlines = []
+    for word in words.split():
+        if inlines:
+            inlines.append({"t": "Space"})
+        inlines.append({"t": "Str", "c": word})
+    return inlines
+
+
+def para(words):
+    return {"t": "Para", "c": _text(words)}
+
+
+def plain(words):
+    return {"t": "Plain", "c": _text(words)}
+
+
+def bullets(*items):
+    return {"t": "BulletList", "c": list(items)}
+
+
+def numbered(*items, start=1):
+    return {"t": "OrderedList", "c": [[start, {"t": "Decimal"}, {"t": "Period"}], list(items)]}
+
+
+def note(*blocks):
+    return {"t": "Note", "c": list(blocks)}
+
+
+# (name, AST before, AST after), following compactifyItem in list_filter.hs:
+# an item that's exactly one Para becomes a Plain, any other item is left alone
+AST_CASES = [
+    ("bullet list", bullets([para("one")], [para("two")]), bullets([plain("one")], [plain("two")])),
+    ("ordered list keeps its numbering", numbered([para("one")], [para("two")], start=4),
+     numbered([plain("one")], [plain("two")], start=4)),
+    ("tight list", bullets([plain("one")], [plain("two")]), bullets([plain("one")], [plain("two")])),
+    ("empty and code items", bullets([], [{"t": "CodeBlock", "c": [["", [], []], "x = 1"]}]),
+     bullets([], [{"t": "CodeBlock", "c": [["", [], []], "x = 1"]}])),
+    ("multi-paragraph item", bullets([para("first"), para("second")], [para("single")]),
+     bullets([para("first"), para("second")], [plain("single")])),
+    ("nested lists", bullets([para("outer"), numbered([para("inner")], [para("inner two")])], [para("next")]),
+     bullets([para("outer"), numbered([plain("inner")], [plain("inner two")])], [plain("next")])),
+    ("deeply nested", bullets([bullets([bullets([para("deep")])])]), bullets([bullets([bullets([plain("deep")])])])),
+    ("list in a footnote",
+     [{"t": "Para", "c": _text("motions") + [note(para("They were:"), bullets([para("lunch")], [para("vending")]))]}],
+     [{"t": "Para", "c": _text("motions") + [note(para("They were:"), bullets([plain("lunch")], [plain("vending")]))]}]),
+    ("footnote in a list item",
+     bullets([{"t": "Para", "c": _text("item") + [note(numbered([para("a")], [para("b")]))]}]),
+     bullets([{"t": "Plain", "c": _text("item") + [note(numbered([plain("a")], [plain("b")]))]}])),
+    ("list in a quote", {"t": "BlockQuote", "c": [bullets([para("quoted")])]},
+     {"t": "BlockQuote", "c": [bullets([plain("quoted")])]}),
+]
+
+
+def check_ast():
+    """Runs compactify_lists on AST_CASES, and returns the number that came out different."""
+
+    different = 0
+    for name, before, after in AST_CASES:
+        document = {"pandoc-api-version": [1, 23], "meta": {}, "blocks": copy.deepcopy(before)}
+        result = list_filter.compactify_lists(document)["blocks"]
+        if result != after:
+            different += 1
+            print("AST " + name + ": DIFFERENT, got " + repr(result))
+    print("AST: " + str(len(AST_CASES) - different) + " of " + str(len(AST_CASES)) + " cases the same")
+    return different
+
+
+def timed(func, *args, **kwargs):
+    start = time.perf_counter()
+    result = func(*args, **kwargs)
+    return result, time.perf_counter() - start
+
+
+def haskell_convert(path):
+    return pypandoc.convert_file(path, "md", filters=[HASKELL_FILTER])
+
+
+def samples():
+    return sorted(p for p in glob.glob(os.path.join(SAMPLES_DIR, "*.md")) if not p.endswith(".expected.md"))
+
+
+def expected_path(path):
+    return os.path.splitext(path)[0] + ".expected.md"
+
+
+def write_expected():
+    if shutil.which("runhaskell") is None:
+        print("The expected outputs are made with list_filter.hs, which needs runhaskell")
+        sys.exit(2)
+    for path in samples():
+        with open(expected_path(path), "w") as f:
+            f.write(haskell_convert(path))
+        print("Wrote " + expected_path(path))
+    with open(os.path.join(SAMPLES_DIR, "PANDOC_VERSION"), "w") as f:
+        f.write(pypandoc.get_pandoc_version() + "\n")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare list_filter.py to list_filter.hs.")
+    parser.add_argument("documents", nargs="*", help="Documents to convert with both (default: the samples)")
+    parser.add_argument("--write-expected", action="store_true", help="Redo the samples' expected outputs")
+    parser.add_argument("--ast-only", action="store_true", help="Only check the hand-built ASTs, without pandoc")
+    args = parser.parse_args()
+
+    if args.write_expected:
+        write_expected()
+        return
+
+    different = check_ast()
+    if args.ast_only:
+        sys.exit(1 if different else 0)
+
+    if not args.documents:
+        with open(os.path.join(SAMPLES_DIR, "PANDOC_VERSION"), "r") as f:
+            made_with = f.read().strip()
+        if made_with != pypandoc.get_pandoc_version():
+            print("The expected outputs were made with pandoc " + made_with + ", this is "
+                  + pypandoc.get_pandoc_version() + ", so some differences may just be pandoc's")
+
+    total_hs = total_py = 0
+    for path in args.documents or samples():
+        if args.documents:
+            expected, hs_time = timed(haskell_convert, path)
+            total_hs += hs_time
+        else:
+            with open(expected_path(path), "r") as f:
+                expected = f.read()
+        actual, py_time = timed(list_filter.convert_file, path)
+        total_py += py_time
+        same = expected == actual
+        if not same:
+            different += 1
+        print(os.path.relpath(path) + ": " + ("same" if same else "DIFFERENT")
+              + (", haskell " + format(hs_time, ".3f") + "s" if args.documents else "")
+              + ", python " + format(py_time, ".3f") + "s")
+
+    print("Total: " + ("haskell " + format(total_hs, ".3f") + "s, " if args.documents else "")
+          + "python " + format(total_py, ".3f") + "s")
+    if different:
+        print(str(different) + " check(s) came out different")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,61 @@
+"""Stands in for pypandoc in the benchmarks when pandoc isn't installed.
+
+It only handles what list_filter.convert_file uses: reading a document into
+pandoc's JSON AST (every run of printable text becomes a paragraph, lines
+starting with "- " become a list) and writing that AST back out as Markdown.
+It's nowhere near as slow as pandoc, so upload timings with it only measure
+the admin site's own work. suite.py says which one was used in its results.
+"""
+
+import json
+import re
+
+STUB = True
+
+
+def get_pandoc_version():
+    return "stub"
+
+
+def _inlines(text):
+    inlines = []
+    for word in text.split():
+        if inlines:
+            inlines.append({"t": "Space"})
+        inlines.append({"t": "Str", "c": word})
+    return inlines
+
+
+def convert_file(source_file, to, format=None, extra_args=(), filters=None):
+    if to != "json":
+        raise RuntimeError("The pandoc stub can only convert to json")
+    with open(source_file, "rb") as f:
+        text = f.read().decode("utf-8", "ignore")
+    blocks = []
+    for chunk in re.split(r"\n\s*\n", text):
+        lines = [line.strip() for line in chunk.splitlines() if line.strip()]
+        if not lines:
+            continue
+        if all(line.startswith("- ") for line in lines):
+            blocks.append({"t": "BulletList", "c": [[{"t": "Para", "c": _inlines(line[2:])}] for line in lines]})
+        else:
+            blocks.append({"t": "Para", "c": _inlines(" ".join(lines))})
+    return json.dumps({"pandoc-api-version": [1, 22], "meta": {}, "blocks": blocks})
+
+
+def _text(inlines):
+    return "".join(" " if i["t"] == "Space" else i["c"] for i in inlines)
+
+
+def convert_text(source, to, format=None, extra_args=(), filters=None):
+    if format != "json":
+        raise RuntimeError("The pandoc stub can only convert from json")
+    out = []
+    for block in json.loads(source)["blocks"]:
+        if block["t"] == "BulletList":
+            # A Para item gets a blank line after it, like pandoc's loose lists
+            out.append("\n".join("-   " + _text(item[0]["c"]) + ("\n" if item[0]["t"] == "Para" else "")
+                                 for item in block["c"]).rstrip("\n"))
+        else:
+            out.append(_text(block["c"]))
+    return "\n\n".join(out) + "\n"
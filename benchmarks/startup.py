@@ -0,0 +1,118 @@
+#!/usr/bin/python3
+
+"""Measures how long the admin site takes to start, and how soon a forked worker can answer.
+
+Each run is a fresh Python process that imports app.py, calls create_app()
+and then forks a worker, like gunicorn --preload does. The worker times its
+first page (the login form) and its first article search after logging in.
+This is done three ways:
+
+- first start: no catalog.db yet, so create_app() parses every post
+- restart: catalog.db is already there, so the posts are loaded from it
+- no warm start: WARM_START is off, so the worker loads the catalog itself
+
+    python3 benchmarks/startup.py --posts 5000 --runs 5
+"""
+
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from fixture import check_stub, make_sites, pandoc_available, use_stub
+from suite import percentiles
+
+USERS = [("admin", "Admin", "admin", 0), ("bench", "Bench Mark", "password", 1)]
+MODES = (("first start", True, True), ("restart", True, False), ("no warm start", False, False))
+MEASURES = ("import", "create_app", "worker_first_page", "worker_first_search")
+
+
+def child(admin_path, warm, stub):
+    """Runs in a fresh process: starts the app, forks a worker and prints the timings as JSON."""
+
+    os.chdir(admin_path)
+    if stub:
+        use_stub()
+    sys.path.insert(0, admin_path)
+    timings = {}
+    start = time.perf_counter()
+    import app as app_module
+    timings["import"] = time.perf_counter() - start
+    if stub:
+        check_stub()
+    start = time.perf_counter()
+    flask_app = app_module.create_app({"WARM_START": warm, "WTF_CSRF_ENABLED": False})
+    timings["create_app"] = time.perf_counter() - start
+
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(read_fd)
+        client = flask_app.test_client()
+        start = time.perf_counter()
+        ok = client.get("/login").status_code == 200
+        timings["worker_first_page"] = time.perf_counter() - start
+        ok = ok and client.post("/login", data={"username": "bench", "password": "password"}).status_code == 302
+        start = time.perf_counter()
+        ok = ok and client.get("/api/articles?q=school").status_code == 200
+        timings["worker_first_search"] = time.perf_counter() - start
+        with os.fdopen(write_fd, "w") as f:
+            json.dump(timings if ok else {}, f)
+        os._exit(0)
+    os.close(write_fd)
+    with os.fdopen(read_fd, "r") as f:
+        worker_timings = json.load(f)
+    os.waitpid(pid, 0)
+    print(json.dumps(worker_timings))
+
+
+def run(admin_path, warm, stub):
+    output = subprocess.run([sys.executable, os.path.abspath(__file__), "--child", admin_path, "--warm", str(int(warm))]
+                            + (["--stub-pandoc"] if stub else []), stdout=subprocess.PIPE, check=True).stdout
+    timings = json.loads(output.decode().strip().splitlines()[-1])
+    if not timings:
+        raise RuntimeError("The worker's requests failed")
+    return timings
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure the admin site's startup time.")
+    parser.add_argument("--posts", type=int, default=1000, help="Posts in the static site (default: %(default)s)")
+    parser.add_argument("--runs", type=int, default=3, help="Fresh starts to time each way (default: %(default)s)")
+    parser.add_argument("--seed", type=int, default=0, help="Seed for the posts (default: %(default)s)")
+    parser.add_argument("--stub-pandoc", action="store_true", help="Use the pandoc stub even if pandoc is installed")
+    parser.add_argument("--child", help=argparse.SUPPRESS)
+    parser.add_argument("--warm", type=int, default=1, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    stub = args.stub_pandoc or not pandoc_available()
+
+    if args.child:
+        child(args.child, bool(args.warm), stub)
+        return
+
+    tmp = tempfile.mkdtemp(prefix="admin-site-startup-")
+    try:
+        admin_path = make_sites(tmp, USERS, posts=args.posts, seed=args.seed)
+        print(str(args.posts) + " posts, " + str(args.runs) + " runs each" + (", using the pandoc stub" if stub else ""))
+        print("".ljust(15) + "".join((m + " ms").rjust(24) for m in MEASURES))
+        for label, warm, fresh_catalog in MODES:
+            samples = {m: [] for m in MEASURES}
+            for _ in range(args.runs):
+                if fresh_catalog:
+                    for suffix in ("", "-wal", "-shm"):
+                        if os.path.exists(os.path.join(admin_path, "catalog.db" + suffix)):
+                            os.remove(os.path.join(admin_path, "catalog.db" + suffix))
+                timings = run(admin_path, warm, stub)
+                for m in MEASURES:
+                    samples[m].append(timings[m])
+            print(label.ljust(15) + "".join(format(percentiles(samples[m])["p50"], ".1f").rjust(24) for m in MEASURES))
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
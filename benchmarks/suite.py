@@ -0,0 +1,326 @@
+#!/usr/bin/python3
+
+"""Benchmarks the admin site end to end on a synthetic static site.
+
+Builds a throwaway admin site and a static site with --posts posts of messy
+legacy front matter (see fixture.py), then drives the Flask test client
+through logging in, the dashboard, article search, layout changes, uploads
+(and how long until their conversion job is done) and deletes. For each it reports latency
+percentiles and how many file operations a request does, and can save them
+as JSON to compare between commits:
+
+    python3 benchmarks/suite.py --posts 1000 --output after.json
+    git worktree add /tmp/before HEAD~1
+    python3 benchmarks/suite.py --posts 1000 --repo /tmp/before --output before.json
+    python3 benchmarks/suite.py --compare before.json after.json
+
+--repo has to be a checkout that builds the app with create_app() and has the
+per-form dashboard endpoints (/layout, /articles, ...), so from the commit
+that added create_app() on. Older ones are refused.
+
+Without pandoc, or with --stub-pandoc, a stub stands in for it (see
+pandoc_stub/pypandoc.py), so uploads only measure the admin site's own work.
+It exits with 1 if any upload job doesn't get to done, since then the upload
+timings don't measure anything.
+File operations are counted with audit hooks, so they need Python 3.8, and
+only count the web process, not the job processes.
+"""
+
+import argparse
+import collections
+import io
+import json
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from fixture import REPO_PATH, WORDS, check_stub, make_sites, pandoc_available, use_stub
+
+USERS = [("admin", "Admin", "admin", 0), ("bench", "Bench Mark", "password", 1), ("layout", "Lay Out", "password", 2)]
+# Audit events counted as file operations
+FILE_EVENTS = ("open", "os.listdir", "os.scandir", "os.rename", "os.remove", "os.mkdir", "os.chmod", "os.utime",
+               "os.truncate", "shutil.copyfile", "shutil.move")
+JOB_TIMEOUT = 120
+# Form posts get JSON back, so errors can be told apart without following the redirect
+JSON = {"Accept": "application/json"}
+
+
+class FileOps:
+    """Counts file operations by audit event, while counting is on."""
+
+    def __init__(self):
+        self.counts = collections.Counter()
+        self.counting = False
+        if hasattr(sys, "addaudithook"):
+            sys.addaudithook(self._hook)
+
+    def _hook(self, event, args):
+        if self.counting and event in FILE_EVENTS:
+            self.counts[event] += 1
+
+    def start(self):
+        self.counts.clear()
+        self.counting = True
+
+    def stop(self):
+        self.counting = False
+        return dict(self.counts)
+
+
+def percentiles(samples):
+    """Returns the p50, p90, p99, max and mean of some latencies in seconds, in milliseconds."""
+
+    ordered = sorted(samples)
+    if not ordered:
+        return {}
+
+    def rank(p):
+        return ordered[min(len(ordered) - 1, max(0, int(round(p / 100 * len(ordered) + 0.5)) - 1))] * 1000
+
+    return {"n": len(ordered), "p50": rank(50), "p90": rank(90), "p99": rank(99), "max": ordered[-1] * 1000,
+            "mean": sum(ordered) / len(ordered) * 1000}
+
+
+class Runner:
+    def __init__(self, app_module, client, file_ops):
+        self.app = app_module
+        self.client = client
+        self.file_ops = file_ops
+        self.results = {}
+
+    def run(self, name, requests, send):
+        """Times send(i) for i in range(requests), which makes a request and returns whether it worked."""
+
+        samples = []
+        ops = collections.Counter()
+        errors = 0
+        for i in range(requests):
+            self.file_ops.start()
+            start = time.perf_counter()
+            ok = send(i)
+            samples.append(time.perf_counter() - start)
+            ops.update(self.file_ops.stop())
+            if not ok:
+                errors += 1
+        self.record(name, samples, ops, errors)
+
+    def record(self, name, samples, ops=None, errors=0):
+        result = {"latency_ms": percentiles(samples), "errors": errors}
+        if ops is not None and samples:
+            result["file_ops_per_request"] = {event: count / len(samples) for event, count in sorted(ops.items())}
+        self.results[name] = result
+        print(format_result(name, result))
+
+
+def format_result(name, result):
+    latency = result["latency_ms"]
+    line = (name.ljust(14) + " n=" + str(latency.get("n", 0)).ljust(5) + " p50 " + format(latency.get("p50", 0), "8.2f")
+            + " ms  p90 " + format(latency.get("p90", 0), "8.2f") + " ms  p99 " + format(latency.get("p99", 0), "8.2f")
+            + " ms")
+    if "file_ops_per_request" in result:
+        line += "  file ops/request " + format(sum(result["file_ops_per_request"].values()), ".1f")
+    if result["errors"]:
+        line += "  ERRORS " + str(result["errors"])
+    return line
+
+
+def wait_for_job(app_module, job_id):
+    deadline = time.monotonic() + JOB_TIMEOUT
+    while time.monotonic() < deadline:
+        job = app_module.jobs.get(job_id)
+        if job["status"] in ("done", "failed"):
+            return job["status"] == "done"
+        time.sleep(0.005)
+    return False
+
+
+def benchmark(args, admin_path, stub):
+    os.chdir(admin_path)
+    if stub:
+        use_stub()
+    sys.path.insert(0, admin_path)
+    start = time.perf_counter()
+    import app as app_module
+    import_seconds = time.perf_counter() - start
+    if stub:
+        check_stub()
+    if not hasattr(app_module, "create_app"):
+        print(args.repo + " is too old to benchmark, its app.py has no create_app()", file=sys.stderr)
+        sys.exit(2)
+    start = time.perf_counter()
+    flask_app = app_module.create_app({"WTF_CSRF_ENABLED": False})
+    create_seconds = time.perf_counter() - start
+
+    client = flask_app.test_client()
+    runner = Runner(app_module, client, FileOps())
+    runner.record("import", [import_seconds])
+    runner.record("create_app", [create_seconds])
+    rng = random.Random(args.seed)
+
+    def login(i):
+        client.get("/logout")
+        return client.post("/login", data={"username": "admin", "password": "admin"}).status_code == 302
+
+    runner.run("login", args.login_requests, login)
+
+    # The first search, with the catalog already loaded by create_app()
+    runner.run("first_search", 1, lambda i: client.get("/api/articles").status_code == 200)
+    runner.run("dashboard", args.requests, lambda i: client.get("/").status_code == 200)
+    runner.run("search", args.requests,
+               lambda i: client.get("/api/articles?q=" + rng.choice(WORDS)).status_code == 200)
+
+    snapshot = app_module.catalog.snapshot()
+    filenames = sorted(a.filename for a in snapshot.articles)
+    rng.shuffle(filenames)
+
+    def layout(i):
+        # Features an article, then unfeatures it again (or the other way around)
+        filename = filenames[i // 2 % len(filenames)]
+        featured = "featured" in app_module.catalog.snapshot().get(filename).tags
+        field = "featured_remove" if featured else "featured_add"
+        return client.post("/layout", data={field: filename}, headers=JSON).status_code == 200
+
+    runner.run("layout", args.requests, layout)
+
+    with flask_app.app_context():
+        authors = [short_name for short_name, _ in app_module.authors.choices() if short_name]
+    job_ids = []
+
+    def upload(i):
+        paragraphs = [" ".join(rng.choice(WORDS) for _ in range(rng.randint(20, 80))) for _ in range(rng.randint(5, 40))]
+        # Different every time, so the conversion cache doesn't hide the conversion
+        document = ("Upload " + str(i) + " " + str(time.time()) + "\n\n" + "\n\n".join(paragraphs)).encode()
+        response = client.post("/articles", content_type="multipart/form-data", headers=JSON, data={
+            "file": (io.BytesIO(document), "benchmark upload " + str(i) + ".docx"),
+            "title": "Benchmark upload " + str(i),
+            "author": rng.choice(authors),
+        })
+        if response.status_code != 202:
+            return False
+        job_ids.append(response.get_json()["job_id"])
+        return True
+
+    runner.run("upload", args.upload_requests, upload)
+    # Then how long each upload took from being queued until its job was done
+    job_samples = []
+    failed = 0
+    for job_id in job_ids:
+        if wait_for_job(app_module, job_id):
+            job = app_module.jobs.get(job_id)
+            job_samples.append(job["updated"] - job["created"])
+        else:
+            failed += 1
+    runner.record("upload_job", job_samples, errors=failed)
+
+    to_delete = filenames[-min(args.requests, len(filenames) // 4):] if filenames else []
+
+    def delete(i):
+        return client.post("/articles/delete", data={"articles": to_delete[i]}, headers=JSON).status_code == 200
+
+    runner.run("delete", len(to_delete), delete)
+    return runner.results
+
+
+def git_commit(repo):
+    try:
+        return subprocess.run(["git", "-C", repo, "rev-parse", "--short", "HEAD"], stdout=subprocess.PIPE,
+                              stderr=subprocess.DEVNULL, check=True).stdout.decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(old_path, new_path):
+    with open(old_path, "r") as f:
+        old = json.load(f)
+    with open(new_path, "r") as f:
+        new = json.load(f)
+
+    for label, results in (("old", old), ("new", new)):
+        meta = results["meta"]
+        print(label + ": " + str(meta["commit"]) + ", " + str(meta["posts"]) + " posts, pandoc " + meta["pandoc"]
+              + ", Python " + meta["python"])
+    print()
+    print("scenario".ljust(14) + "".join(s.rjust(24) for s in ("p50 ms", "p90 ms", "p99 ms", "file ops/request")))
+    for name in new["scenarios"]:
+        if name not in old["scenarios"]:
+            continue
+        before, after = old["scenarios"][name], new["scenarios"][name]
+        cells = []
+        for stat in ("p50", "p90", "p99"):
+            cells.append(_change(before["latency_ms"].get(stat), after["latency_ms"].get(stat)))
+        cells.append(_change(sum(before.get("file_ops_per_request", {}).values()),
+                             sum(after.get("file_ops_per_request", {}).values())))
+        print(name.ljust(14) + "".join(c.rjust(24) for c in cells))
+
+
+def _change(before, after):
+    if before is None or after is None:
+        return "-"
+    text = format(before, ".1f") + " -> " + format(after, ".1f")
+    if before:
+        text += " (" + format((after - before) / before * 100, "+.0f") + "%)"
+    return text
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the admin site on a synthetic static site.")
+    parser.add_argument("--posts", type=int, default=1000, help="Posts in the static site (default: %(default)s)")
+    parser.add_argument("--requests", type=int, default=50, help="Requests per scenario (default: %(default)s)")
+    parser.add_argument("--login-requests", type=int, default=10, help="Logins to time (default: %(default)s)")
+    parser.add_argument("--upload-requests", type=int, default=10, help="Uploads to time (default: %(default)s)")
+    parser.add_argument("--seed", type=int, default=0, help="Seed for the posts and requests (default: %(default)s)")
+    parser.add_argument("--repo", default=REPO_PATH, help="Admin site checkout to benchmark (default: this one)")
+    parser.add_argument("--stub-pandoc", action="store_true", help="Use the pandoc stub even if pandoc is installed")
+    parser.add_argument("--output", help="Save the results to this JSON file")
+    parser.add_argument("--keep", action="store_true", help="Keep the temp sites and print where they are")
+    parser.add_argument("--compare", nargs=2, metavar=("OLD", "NEW"), help="Compare two saved results instead")
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+        return
+
+    stub = args.stub_pandoc or not pandoc_available()
+    repo = os.path.abspath(args.repo)
+    output = os.path.abspath(args.output) if args.output else None
+    tmp = tempfile.mkdtemp(prefix="admin-site-bench-")
+    try:
+        start = time.perf_counter()
+        admin_path = make_sites(tmp, USERS, posts=args.posts, seed=args.seed, repo=repo)
+        print("Made " + str(args.posts) + " posts in " + format(time.perf_counter() - start, ".1f") + "s"
+              + (", using the pandoc stub" if stub else ""))
+        results = {
+            "meta": {
+                "commit": git_commit(repo),
+                "posts": args.posts,
+                "seed": args.seed,
+                "requests": args.requests,
+                "pandoc": "stub" if stub else "real",
+                "python": platform.python_version(),
+                "time": time.time(),
+            },
+            "scenarios": benchmark(args, admin_path, stub),
+        }
+    finally:
+        if args.keep:
+            print("Kept the sites in " + tmp)
+        else:
+            shutil.rmtree(tmp, ignore_errors=True)
+
+    if output:
+        with open(output, "w") as f:
+            json.dump(results, f, indent=4)
+            f.write("\n")
+        print("Saved to " + output)
+    if results["scenarios"]["upload_job"]["errors"]:
+        print(str(results["scenarios"]["upload_job"]["errors"]) + " upload job(s) failed, see app.log (--keep to look)")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,57 @@
+#!/usr/bin/python3
+
+"""Measures authenticated request throughput with and without the user cache.
+
+Builds a throwaway admin site and static site in a temp directory, logs in
+with the Flask test client and times a cheap authenticated endpoint, so the
+time is mostly flask_login loading the user:
+    python3 benchmarks/user_cache.py --requests 2000
+"""
+
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from fixture import make_sites, pandoc_available, use_stub
+
+
+def measure(client, requests):
+    start = time.perf_counter()
+    for _ in range(requests):
+        response = client.get("/publish/status")
+        assert response.status_code == 200, response.status_code
+    return requests / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the flask_login user cache.")
+    parser.add_argument("--requests", type=int, default=1000, help="Requests to time each way (default: %(default)s)")
+    args = parser.parse_args()
+
+    tmp = tempfile.mkdtemp(prefix="admin-site-bench-")
+    try:
+        os.chdir(make_sites(tmp, [("admin", "Admin", "admin", 0), ("bench", "Bench Mark", "password", 1)]))
+        if not pandoc_available():
+            use_stub()  # Only needed to import the app
+        sys.path.insert(0, os.getcwd())
+        import app as admin_app
+
+        client = admin_app.create_app({"WTF_CSRF_ENABLED": False}).test_client()
+        response = client.post("/login", data={"username": "bench", "password": "password"})
+        assert response.status_code == 302, "Login failed"
+
+        ttl = admin_app.user_cache.ttl
+        for label, cache_ttl in (("without cache", 0), ("with cache", ttl)):
+            admin_app.user_cache.ttl = cache_ttl
+            admin_app.user_cache.invalidate()
+            measure(client, min(args.requests, 100))  # Warm up
+            print(label + ": " + format(measure(client, args.requests), ".0f") + " requests/s")
+    finally:
+        shutil.rmtree(tmp)
+
+
+if __name__ == "__main__":
+    main()
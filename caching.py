@@ -0,0 +1,66 @@
+"""HTTP caching helpers: ETags, fingerprinted static files and gzip.
+
+Static files are linked with a hash of their contents in the URL (?v=...), so
+browsers can keep them for a year and still get a new version as soon as the
+file changes.
+"""
+
+import gzip
+import hashlib
+import os
+import threading
+
+# How long browsers keep fingerprinted static files
+STATIC_MAX_AGE = 365 * 24 * 60 * 60
+
+
+def etag_for(*parts):
+    """Returns an ETag value made from some strings or numbers."""
+
+    return hashlib.sha1("\0".join(str(p) for p in parts).encode()).hexdigest()[:20]
+
+
+class StaticFingerprints:
+    """Content hashes of the files in a static folder, redone when a file's mtime changes."""
+
+    def __init__(self, static_folder):
+        self.static_folder = static_folder
+        self._lock = threading.Lock()
+        self._hashes = {}  # filename -> (mtime_ns, hash)
+
+    def get(self, filename):
+        """Returns the fingerprint of a static file, or None if it doesn't exist."""
+
+        path = os.path.join(self.static_folder, filename)
+        try:
+            mtime = os.stat(path).st_mtime_ns
+        except OSError:
+            return None
+        with self._lock:
+            cached = self._hashes.get(filename)
+        if cached is not None and cached[0] == mtime:
+            return cached[1]
+
+        h = hashlib.sha1()
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(64 * 1024), b""):
+                h.update(chunk)
+        fingerprint = h.hexdigest()[:12]
+        with self._lock:
+            self._hashes[filename] = (mtime, fingerprint)
+        return fingerprint
+
+
+def gzip_response(response, accept_encodings, min_size, mimetypes, level=6):
+    """Compresses a response in place if the client accepts gzip and it's big enough and worth it."""
+
+    if (response.status_code != 200 or response.direct_passthrough or "Content-Encoding" in response.headers
+            or response.mimetype not in mimetypes or "gzip" not in accept_encodings):
+        return response
+    response.vary.add("Accept-Encoding")
+    data = response.get_data()
+    if len(data) < min_size:
+        return response
+    response.set_data(gzip.compress(data, level))
+    response.headers["Content-Encoding"] = "gzip"
+    return response
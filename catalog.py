@@ -0,0 +1,167 @@
+"""In-process catalog of the articles in the static site.
+
+Each post is parsed once and cached by (path, mtime, size). A refresh only
+stats the _posts directories and re-parses the files that changed, and every
+caller gets an immutable snapshot, so requests never see a half-built list.
+
+With a CatalogStore, parsed posts are shared with every other worker through
+SQLite, and the store is kept in sync by each refresh.
+"""
+
+import os
+import threading
+from collections import namedtuple
+
+import yaml
+
+import front_matter
+import metrics
+
+
+# (section name, posts directory relative to the static site)
+# Order matters: articles are looked up in the regular section first, then Bear Air.
+SECTIONS = (
+    ("articles", "articles/_posts/"),
+    ("bear_air", "bear_air/_posts/"),
+)
+
+Article = namedtuple("Article", ["filename", "section", "path", "title", "author", "date", "tags", "front_matter",
+                                 "mtime", "size"])
+
+
+class CatalogSnapshot:
+    """An immutable view of every valid article at one point in time."""
+
+    def __init__(self, articles, version):
+        self.articles = tuple(articles)
+        self.version = version
+        self._by_filename = {}
+        for article in self.articles:
+            # Same lookup order as the sections
+            self._by_filename.setdefault(article.filename, article)
+        self.filenames = frozenset(self._by_filename)
+
+        # Inverted index of tag -> filenames, like "sticky" -> ("2020-01-01-post.md",)
+        by_tag = {}
+        for article in self._by_filename.values():
+            for tag in article.tags:
+                by_tag.setdefault(tag, []).append(article.filename)
+        self._by_tag = {tag: tuple(filenames) for tag, filenames in by_tag.items()}
+
+    def get(self, filename):
+        """Returns the Article with that filename, or None."""
+
+        return self._by_filename.get(filename)
+
+    def tagged(self, tag):
+        """Returns the filenames of the articles with that tag."""
+
+        return self._by_tag.get(tag, ())
+
+    def __contains__(self, filename):
+        return filename in self._by_filename
+
+    def __len__(self):
+        return len(self.articles)
+
+
+class ArticleCatalog:
+    """Keeps a cached CatalogSnapshot of the static site's posts up to date.
+
+    store is an optional CatalogStore to share parsed posts through.
+    """
+
+    def __init__(self, static_site_path, store=None):
+        self.static_site_path = static_site_path
+        self.store = store
+        self._lock = threading.Lock()
+        # path -> ((mtime, size), Article or None for a bad post)
+        self._entries = {}
+        self._snapshot = CatalogSnapshot((), 0)
+
+    def snapshot(self):
+        """Rescans the posts directories and returns an up to date snapshot."""
+
+        with self._lock, metrics.timed("catalog_refresh"):
+            self._refresh()
+            return self._snapshot
+
+    def _refresh(self):
+        changed = False
+        seen = set()
+        articles = []
+        to_store = []
+        # On the first refresh, start from everything the store already has
+        stored = self.store.load() if self.store is not None and not self._entries else {}
+
+        for section, posts_dir in SECTIONS:
+            directory = os.path.join(self.static_site_path, posts_dir)
+            try:
+                entries = sorted(os.scandir(directory), key=lambda e: e.name)
+            except FileNotFoundError:
+                entries = []
+            for entry in entries:
+                try:
+                    if not entry.is_file():
+                        continue
+                    st = entry.stat()
+                except FileNotFoundError:
+                    continue  # Deleted while scanning
+                key = (st.st_mtime_ns, st.st_size)
+                seen.add(entry.path)
+                cached = self._entries.get(entry.path)
+                if cached is None or cached[0] != key:
+                    parsed = self._load(entry.path, key, stored)
+                    if parsed is False:
+                        parsed = self._parse(entry.name, entry.path)
+                        to_store.append((entry.path, entry.name, section, key, parsed))
+                    article = None
+                    if parsed is not None:
+                        article = Article(entry.name, section, entry.path, parsed["title"], parsed["author"],
+                                          parsed["date"], tuple(parsed["tags"]), parsed["front_matter"], key[0], key[1])
+                    cached = (key, article)
+                    self._entries[entry.path] = cached
+                    changed = True
+                if cached[1] is not None:
+                    articles.append(cached[1])
+
+        removed = [path for path in set(self._entries) | set(stored) if path not in seen]
+        for path in removed:
+            self._entries.pop(path, None)
+            changed = True
+        if self.store is not None:
+            self.store.save(to_store, removed)
+
+        if changed:
+            self._snapshot = CatalogSnapshot(articles, self._snapshot.version + 1)
+
+    def _load(self, path, key, stored):
+        """Returns a post already parsed by any worker (None if it was bad), or False if it needs parsing."""
+
+        if self.store is None:
+            return False
+        if path in stored:
+            if stored[path][0] == key:
+                return stored[path][1]
+            return False
+        found, parsed = self.store.get(path, key)
+        return parsed if found else False
+
+    @staticmethod
+    def _parse(filename, path):
+        """Returns a dictionary describing the post, or None if it has bad front matter."""
+
+        try:
+            fm = front_matter.read(path)
+        except (OSError, ValueError, yaml.YAMLError):
+            return None
+        if not isinstance(fm, dict) or "title" not in fm:
+            return None
+        return {
+            "title": str(fm["title"]),
+            "author": str(fm.get("author", "")),
+            # Posts are named YYYY-MM-DD-name.md, unless the front matter says otherwise
+            "date": str(fm.get("date", filename[:10])),
+            "tags": front_matter.get_tags(fm),
+            "front_matter": fm,
+        }
@@ -0,0 +1,174 @@
+"""SQLite copy of the article catalog, shared by every worker process.
+
+Parsed posts are stored with the (mtime, size) they were parsed at, so a post
+is parsed once no matter how many workers need it, or how often they restart.
+The titles, authors and filenames are indexed with FTS5 for the dashboard's
+article search. If this SQLite wasn't built with FTS5, search falls back to LIKE.
+"""
+
+import json
+import sqlite3
+
+import front_matter
+import storage
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS articles (
+    id INTEGER PRIMARY KEY,
+    path TEXT UNIQUE NOT NULL,
+    filename TEXT NOT NULL,
+    section TEXT NOT NULL,
+    valid INTEGER NOT NULL,
+    title TEXT,
+    author TEXT,
+    date TEXT,
+    tags TEXT,
+    front_matter TEXT,
+    mtime INTEGER NOT NULL,
+    size INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS articles_filename ON articles (filename);
+CREATE INDEX IF NOT EXISTS articles_order ON articles (section, filename);
+CREATE TABLE IF NOT EXISTS article_tags (
+    article_id INTEGER NOT NULL REFERENCES articles (id) ON DELETE CASCADE,
+    tag TEXT NOT NULL,
+    PRIMARY KEY (tag, article_id)
+);
+"""
+
+_FTS_SCHEMA = """
+CREATE VIRTUAL TABLE IF NOT EXISTS articles_fts USING fts5(title, author, filename, content='articles', content_rowid='id');
+CREATE TRIGGER IF NOT EXISTS articles_fts_insert AFTER INSERT ON articles BEGIN
+    INSERT INTO articles_fts (rowid, title, author, filename) VALUES (new.id, new.title, new.author, new.filename);
+END;
+CREATE TRIGGER IF NOT EXISTS articles_fts_delete AFTER DELETE ON articles BEGIN
+    INSERT INTO articles_fts (articles_fts, rowid, title, author, filename) VALUES ('delete', old.id, old.title, old.author, old.filename);
+END;
+CREATE TRIGGER IF NOT EXISTS articles_fts_update AFTER UPDATE ON articles BEGIN
+    INSERT INTO articles_fts (articles_fts, rowid, title, author, filename) VALUES ('delete', old.id, old.title, old.author, old.filename);
+    INSERT INTO articles_fts (rowid, title, author, filename) VALUES (new.id, new.title, new.author, new.filename);
+END;
+"""
+
+# Same order as the dashboard lists: regular articles, then Bear Air
+_SECTION_ORDER = "CASE articles.section WHEN 'articles' THEN 0 ELSE 1 END, articles.filename"
+
+
+class CatalogStore:
+    """Stores parsed articles in the SQLite database at db_path."""
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        with storage.connect(self.db_path, foreign_keys=True) as conn:
+            conn.execute("PRAGMA journal_mode=WAL")  # Readers don't block the worker that's writing
+            conn.executescript(_SCHEMA)
+            try:
+                conn.executescript(_FTS_SCHEMA)
+                self.fts = True
+            except sqlite3.OperationalError:
+                self.fts = False
+
+    def load(self):
+        """Returns every stored post as {path: ((mtime, size), row)}, where row is None for a bad post."""
+
+        with storage.connect(self.db_path, foreign_keys=True) as conn:
+            rows = conn.execute("SELECT * FROM articles").fetchall()
+        return {row["path"]: ((row["mtime"], row["size"]), _row_dict(row)) for row in rows}
+
+    def get(self, path, key):
+        """Returns (True, row) if the post at path was stored at that (mtime, size), else (False, None)."""
+
+        with storage.connect(self.db_path, foreign_keys=True) as conn:
+            row = conn.execute("SELECT * FROM articles WHERE path = ? AND mtime = ? AND size = ?",
+                               (path, key[0], key[1])).fetchone()
+        if row is None:
+            return False, None
+        return True, _row_dict(row)
+
+    def save(self, changed, removed):
+        """Stores changed posts and forgets removed ones, in one transaction.
+
+        changed is a list of (path, filename, section, key, article), where article
+        is a dictionary with title, author, date, tags and front_matter, or None
+        for a bad post. removed is a list of paths.
+        """
+
+        if not changed and not removed:
+            return
+        with storage.connect(self.db_path, foreign_keys=True) as conn:
+            for path in removed:
+                conn.execute("DELETE FROM articles WHERE path = ?", (path,))
+            for path, filename, section, key, article in changed:
+                conn.execute("DELETE FROM articles WHERE path = ?", (path,))
+                if article is None:
+                    conn.execute("INSERT INTO articles (path, filename, section, valid, mtime, size) VALUES (?, ?, ?, 0, ?, ?)",
+                                 (path, filename, section, key[0], key[1]))
+                    continue
+                cur = conn.execute(
+                    "INSERT INTO articles (path, filename, section, valid, title, author, date, tags, front_matter, mtime, size)"
+                    " VALUES (?, ?, ?, 1, ?, ?, ?, ?, ?, ?, ?)",
+                    (path, filename, section, article["title"], article["author"], article["date"],
+                     json.dumps(article["tags"]), json.dumps(article["front_matter"], default=str), key[0], key[1]))
+                conn.executemany("INSERT OR IGNORE INTO article_tags (article_id, tag) VALUES (?, ?)",
+                                 [(cur.lastrowid, tag) for tag in article["tags"]])
+
+    def search(self, query="", section=None, tag=None, exclude_tag=None, page=1, per_page=20):
+        """Searches valid articles by title, author and filename.
+
+        Every word in query has to match the start of a word. Returns (articles, total),
+        where articles is a list of dictionaries for the requested page.
+        """
+
+        where = ["articles.valid = 1"]
+        params = []
+        words = query.split()
+        if words:
+            if self.fts:
+                where.append("articles.id IN (SELECT rowid FROM articles_fts WHERE articles_fts MATCH ?)")
+                # Quote every word so FTS syntax in the query is searched for literally
+                params.append(" ".join('"' + w.replace('"', '""') + '"*' for w in words))
+            else:
+                for w in words:
+                    where.append("(articles.title LIKE ? OR articles.author LIKE ? OR articles.filename LIKE ?)")
+                    params.extend(["%" + w + "%"] * 3)
+        if section is not None:
+            where.append("articles.section = ?")
+            params.append(section)
+        if tag is not None:
+            where.append("articles.id IN (SELECT article_id FROM article_tags WHERE tag = ?)")
+            params.append(tag)
+        if exclude_tag is not None:
+            where.append("articles.id NOT IN (SELECT article_id FROM article_tags WHERE tag = ?)")
+            params.append(exclude_tag)
+
+        where_sql = " WHERE " + " AND ".join(where)
+        with storage.connect(self.db_path, foreign_keys=True) as conn:
+            total = conn.execute("SELECT COUNT(*) FROM articles" + where_sql, params).fetchone()[0]
+            rows = conn.execute("SELECT * FROM articles" + where_sql + " ORDER BY " + _SECTION_ORDER + " LIMIT ? OFFSET ?",
+                                params + [per_page, (page - 1) * per_page]).fetchall()
+        return [_public_dict(row) for row in rows], total
+
+
+def _row_dict(row):
+    if not row["valid"]:
+        return None
+    return {
+        "title": row["title"],
+        "author": row["author"],
+        "date": row["date"],
+        "tags": json.loads(row["tags"]),
+        "front_matter": json.loads(row["front_matter"]),
+    }
+
+
+def _public_dict(row):
+    return {
+        "filename": row["filename"],
+        "section": row["section"],
+        "title": row["title"],
+        "author": row["author"],
+        "date": row["date"],
+        "tags": json.loads(row["tags"]),
+        # Sent back with edits, see front_matter.VersionConflict
+        "version": front_matter.make_version(row["mtime"], row["size"]),
+    }
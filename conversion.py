@@ -0,0 +1,212 @@
+"""Turning uploaded documents into Jekyll posts.
+
+This runs in the background job processes, not in the web server, so it must
+not import app.py or rely on anything from a request.
+
+Each post is written exactly once: the front matter and then the body are
+streamed into a temp file in the post's final directory (so it's on the same
+filesystem), which is then published with a single os.replace.
+
+Converted Markdown is kept in a ConversionCache, keyed by the uploaded bytes
+and the pandoc and filter versions, so uploading the same document again
+skips pandoc entirely.
+"""
+
+import errno
+import fcntl
+import hashlib
+import os
+import shutil
+import time
+
+import pypandoc
+
+import front_matter
+import list_filter
+import storage
+
+# Bytes copied at a time when streaming files
+CHUNK_SIZE = 1024 * 1024
+
+
+def process_upload(params):
+    """Converts an upload, adds its front matter and publishes it into the static site.
+
+    params is a dictionary with:
+        upload_path: the uploaded document, in any format pandoc can read, or .md
+        md_filename: the final filename of the post, reserved in uploads_dir
+        title, author: for the front matter
+        bear_air: True if it's a Bear Air post
+        photo_path: the uploaded title photo, or None
+        uploads_dir, static_site_path: where things are
+        cache_dir, cache_max_bytes: the conversion cache, optional
+
+    The original upload is only removed once everything else worked, so a failed
+    attempt can be retried. Once the job fails for good, discard_upload cleans up. Returns the paths of the new post and image, and
+    whether the conversion was a cache "hit" or "miss" (None if not converted)
+    and how many seconds it took, for the web process' metrics.
+    """
+
+    upload_path = params["upload_path"]
+    reserved_path = os.path.join(params["uploads_dir"], params["md_filename"])
+    static_site_path = params["static_site_path"]
+
+    header = {"layout": "post", "title": params["title"], "author": params["author"]}
+    photo_path = params.get("photo_path")
+    if photo_path:
+        header["image"] = "assets/images/" + os.path.basename(photo_path)
+
+    if params["bear_air"]:  # It's a Bear Air post
+        posts_dir = os.path.join(static_site_path, "bear_air/_posts/")
+    else:
+        posts_dir = os.path.join(static_site_path, "articles/_posts/")
+    post_path = os.path.join(posts_dir, params["md_filename"])
+
+    cache_result = None
+    start = time.perf_counter()
+    if os.path.splitext(upload_path)[1] != ".md":
+        # Conversion needed
+        cache = None
+        if params.get("cache_dir"):
+            cache = ConversionCache(params["cache_dir"], params["cache_max_bytes"])
+            key = cache.key(upload_path)
+            cached = cache.open(key)
+            if cached is not None:
+                cache_result = "hit"
+                with cached as body:
+                    write_post(post_path, header, body)
+        if cache_result is None:
+            # The list filter removes extra lines that pandoc generates in Markdown lists
+            body = list_filter.convert_file(upload_path)
+            if cache is not None:
+                cache_result = "miss"
+                cache.put(key, body)
+            write_post(post_path, header, body)
+    else:
+        with open(upload_path, "r") as body:
+            write_post(post_path, header, body)
+
+    conversion_seconds = time.perf_counter() - start
+
+    image_path = None
+    if photo_path:
+        image_path = move(photo_path, os.path.join(static_site_path, "assets/images/"))
+
+    # Delete original upload, and the empty file that reserved the name
+    for path in {upload_path, reserved_path}:
+        if os.path.exists(path):
+            os.remove(path)
+
+    return {"post": post_path, "image": image_path, "cache": cache_result, "seconds": conversion_seconds}
+
+
+def discard_upload(params):
+    """Removes what's left of a failed upload job from the uploads folder.
+
+    That's the uploaded document and title photo, and the empty file that
+    reserved the post's name, so the name can be used again.
+    """
+
+    reserved_path = os.path.join(params["uploads_dir"], params["md_filename"])
+    for path in (params["upload_path"], params.get("photo_path"), reserved_path):
+        if path and os.path.exists(path):
+            os.remove(path)
+
+
+def write_post(path, header, body):
+    """Writes a post's front matter and body to a temp file next to path, then swaps it in.
+
+    body is a string, or a text file that's copied across in chunks.
+    """
+
+    with storage.replacing(path) as f:
+        f.write(front_matter.dumps(header) + "\n")  # Add openers and closers
+        if isinstance(body, str):
+            f.write(body)
+        else:
+            shutil.copyfileobj(body, f, CHUNK_SIZE)
+
+
+def move(src, directory):
+    """Moves src into directory, with a rename if they're on the same filesystem. Returns the new path."""
+
+    dst = os.path.join(directory, os.path.basename(src))
+    try:
+        os.replace(src, dst)
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+        shutil.move(src, dst)  # Has to copy it
+    return dst
+
+
+class ConversionCache:
+    """Converted Markdown on disk, one file per key, least recently used removed past max_bytes.
+
+    Shared by every job process: entries are written to a temp file and
+    renamed into place, a hit bumps the entry's mtime, and evictions are done
+    under an fcntl lock.
+    """
+
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+
+    def key(self, upload_path):
+        """Returns the key for converting upload_path with this pandoc and list filter."""
+
+        h = hashlib.sha256()
+        # The extension is part of it since pandoc picks the input format from it
+        h.update((os.path.splitext(upload_path)[1].lower() + "\0" + pypandoc.get_pandoc_version() + "\0"
+                  + str(list_filter.VERSION) + "\0").encode())
+        with open(upload_path, "rb") as f:
+            for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+                h.update(chunk)
+        return h.hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + ".md")
+
+    def open(self, key):
+        """Returns the cached Markdown for key as an open text file, or None."""
+
+        path = self._path(key)
+        try:
+            f = open(path, "r")
+        except FileNotFoundError:
+            return None
+        try:
+            os.utime(path)  # Recently used
+        except FileNotFoundError:
+            pass  # Evicted meanwhile, the open file is still fine
+        return f
+
+    def put(self, key, text):
+        """Stores text for key, then evicts the least recently used entries past max_bytes."""
+
+        with storage.replacing(self._path(key), permissions=0o600) as f:  # Only the app reads these
+            f.write(text)
+        self.evict()
+
+    def evict(self):
+        with open(os.path.join(self.directory, ".lock"), "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            entries = []
+            total = 0
+            with os.scandir(self.directory) as it:
+                for entry in it:
+                    if not entry.name.endswith(".md") or not entry.is_file():
+                        continue
+                    st = entry.stat()
+                    entries.append((st.st_mtime, entry.path, st.st_size))
+                    total += st.st_size
+            entries.sort()
+            for _, path, size in entries:
+                if total <= self.max_bytes:
+                    break
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+                total -= size
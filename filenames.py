@@ -0,0 +1,31 @@
+"""Reserving unique filenames for uploads, safely across processes."""
+
+import os
+
+
+def reserve_filename(filename, directory, taken=frozenset(), other_dirs=()):
+    """Claims a free name based on filename in directory, and returns it.
+
+    If filename is in use, it gets a higher number, like test.md becoming
+    test-2.md, or test-3.md if test-2.md is in use too. A name is in use if it's
+    in the set taken, exists in one of other_dirs, or exists in directory.
+
+    The name is claimed by creating an empty file with O_CREAT | O_EXCL, so two
+    processes can never get the same one. Each name checked costs a set lookup
+    and a few stats, instead of listing every directory.
+    """
+
+    base, ext = os.path.splitext(filename)
+    name = filename
+    i = 2
+    while True:
+        if name not in taken and not any(os.path.lexists(os.path.join(d, name)) for d in other_dirs):
+            try:
+                fd = os.open(os.path.join(directory, name), os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644)
+            except FileExistsError:
+                pass  # Someone else just claimed it, or an older upload is still in there
+            else:
+                os.close(fd)
+                return name
+        name = base + "-" + str(i) + ext
+        i += 1
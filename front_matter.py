@@ -0,0 +1,224 @@
+"""Reading and writing the YAML front matter of Jekyll posts.
+
+Reads stop at the closing "---", so the body of a post is never read just to
+get its front matter. Writes stream the new header and the untouched body into
+a temp file in the same directory and then swap it in with os.replace, so a
+post is never left half written or with stale bytes at the end.
+
+Writes hold an fcntl lock on the post, shared by every worker and job process,
+so two edits of the same post can't both read the old front matter and then
+overwrite each other. A post's version is its (mtime, size), the same thing
+the catalog checks, and a write can be made conditional on it to turn a stale
+form into a VersionConflict instead of a lost update.
+"""
+
+import fcntl
+import hashlib
+import os
+import shutil
+import tempfile
+import threading
+from contextlib import contextmanager
+
+import yaml
+
+import metrics
+
+# Use the C implementations (libyaml) when PyYAML was built with them
+try:
+    from yaml import CSafeLoader as Loader, CSafeDumper as Dumper
+except ImportError:
+    from yaml import SafeLoader as Loader, SafeDumper as Dumper
+
+
+DELIMITER = b"---"
+# Lock files of the posts being written, relative to the working directory (the admin site)
+# Set from the admin site's FRONT_MATTER_LOCK_DIR by create_app()
+LOCK_DIR = "front_matter_locks"
+
+# Lock files held by this thread, so update() can be called while lock() is held
+_held = threading.local()
+
+
+class VersionConflict(Exception):
+    """A post changed since the version an edit was based on."""
+
+    def __init__(self, path, expected, current):
+        super().__init__(os.path.basename(path) + " is at version " + current + ", not " + expected)
+        self.path = path
+        self.expected = expected
+        self.current = current
+
+
+def make_version(mtime_ns, size):
+    """Returns the version token of a post with that mtime (in nanoseconds) and size."""
+
+    return str(mtime_ns) + "-" + str(size)
+
+
+def version(path):
+    """Returns the current version token of the post at path."""
+
+    st = os.stat(path)
+    return make_version(st.st_mtime_ns, st.st_size)
+
+
+def _lock_name(path):
+    return hashlib.sha1(os.path.realpath(path).encode("utf-8")).hexdigest()[:20] + ".lock"
+
+
+@contextmanager
+def lock(*paths):
+    """Holds the write locks of the posts at paths, waiting for other processes to finish with them.
+
+    Locks are taken in a fixed order, so two callers locking overlapping posts
+    can't deadlock. Ones this thread already holds are skipped. Lock files are
+    removed when they're released, so LOCK_DIR only has the ones in use.
+    """
+
+    held = _held.__dict__.setdefault("names", set())
+    names = sorted({_lock_name(p) for p in paths} - held)
+    files = []
+    try:
+        if names:
+            os.makedirs(LOCK_DIR, exist_ok=True)
+        with metrics.timed("front_matter_lock"):
+            for name in names:
+                files.append(_acquire(os.path.join(LOCK_DIR, name)))
+                held.add(name)
+        yield
+    finally:
+        for f in files:
+            # Removed while still held, anyone waiting on it notices and makes a new one
+            try:
+                os.remove(f.name)
+            except FileNotFoundError:
+                pass
+            f.close()  # Releases the lock
+        held.difference_update(names)
+
+
+def _acquire(lock_path):
+    """Opens and locks the lock file at lock_path, and returns it."""
+
+    while True:
+        f = open(lock_path, "a")
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            if os.stat(lock_path).st_ino == os.fstat(f.fileno()).st_ino:
+                return f
+        except FileNotFoundError:
+            pass
+        f.close()  # Its holder removed it while this was waiting, so it doesn't lock anything anymore
+
+
+def loads(text):
+    """Parses front matter YAML text into a dictionary."""
+
+    return yaml.load(text, Loader=Loader)
+
+
+def dumps(front_matter):
+    """Returns the front matter as YAML, with the opening and closing "---" lines."""
+
+    return "---\n" + yaml.dump(front_matter, Dumper=Dumper) + "---\n"
+
+
+def get_tags(front_matter):
+    """Returns the tags of some front matter as a new list, however they were written.
+
+    Some front matter has tags written like "tags: featured", or has no tags at
+    all. This only fixes that in memory, normalize_front_matter.py fixes the files.
+    """
+
+    tags = front_matter.get("tags")
+    if tags is None:
+        return []
+    if isinstance(tags, str):
+        return [tags]
+    return list(tags)
+
+
+def _read_header(f):
+    """Reads up to and including the closing "---" of an open binary file.
+
+    Returns (prefix, yaml_bytes), where prefix is everything before the opening
+    "---". The file is left positioned at the start of the body.
+    Raises ValueError if the file has no complete front matter.
+    """
+
+    prefix = []
+    lines = None
+    for line in iter(f.readline, b""):
+        if line.rstrip(b"\r\n") == DELIMITER:
+            if lines is None:
+                lines = []
+                continue
+            return b"".join(prefix), b"".join(lines)
+        if lines is None:
+            prefix.append(line)
+        else:
+            lines.append(line)
+    raise ValueError("No front matter in " + str(f.name))
+
+
+def read(path):
+    """Returns the front matter of the post at path as a dictionary."""
+
+    with metrics.timed("front_matter_read"), open(path, "rb") as f:
+        _, header = _read_header(f)
+        return loads(header.decode("utf-8"))
+
+
+def update(path, mutate, version=None):
+    """Rewrites the front matter of the post at path, holding its lock.
+
+    mutate is called with the current front matter dictionary, and can change
+    it in place or return a new one. The body of the post is copied across
+    without being loaded into memory. Returns the new front matter.
+
+    With a version, raises VersionConflict without writing anything if the
+    post isn't at that version anymore.
+    """
+
+    with lock(path), metrics.timed("front_matter_write"), open(path, "rb") as src:
+        before = os.fstat(src.fileno())
+        current = make_version(before.st_mtime_ns, before.st_size)
+        if version is not None and version != current:
+            raise VersionConflict(path, version, current)
+        prefix, header = _read_header(src)
+        front_matter = loads(header.decode("utf-8"))
+        if front_matter is None:
+            front_matter = {}
+        result = mutate(front_matter)
+        if result is not None:
+            front_matter = result
+
+        directory = os.path.dirname(path) or "."
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".", suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as dst:
+                dst.write(prefix)
+                dst.write(dumps(front_matter).encode("utf-8"))
+                shutil.copyfileobj(src, dst)
+            # mkstemp creates the file as 0600, keep the post's permissions
+            os.chmod(tmp_path, os.stat(path).st_mode & 0o777)
+            after = os.stat(tmp_path)
+            if after.st_mtime_ns <= before.st_mtime_ns:
+                # Two writes within one clock tick could leave the same size and mtime, so the same version
+                os.utime(tmp_path, ns=(after.st_atime_ns, before.st_mtime_ns + 1000))
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+
+    return front_matter
+
+
+def set_key(path, key, value):
+    """Sets one front matter key of the post at path."""
+
+    def _set(front_matter):
+        front_matter[key] = value
+
+    return update(path, _set)
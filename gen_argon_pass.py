@@ -1,3 +1,88 @@
+"""Tool to hash a password for the users database, or to pick Argon2 parameters for this server.
+
+With --calibrate, it measures this machine and picks the most memory (up to
+--max-memory) and time cost that still verify within --target-ms, and saves them
+to argon2_params.json with --write. The admin site hashes with those from then
+on, and rehashes old passwords as people log in.
+"""
+
+import argparse
+import json
+import os
+import statistics
+import time
+
 from argon2 import PasswordHasher
 
-print(PasswordHasher().hash(input("Enter your password. This will not be stored.\n> ")))
+import passwords
+
+MIN_MEMORY_KIB = 8 * 1024
+
+
+def measure(time_cost, memory_cost, parallelism, runs=3):
+    """Returns the median seconds to verify a password with those parameters."""
+
+    ph = PasswordHasher(time_cost=time_cost, memory_cost=memory_cost, parallelism=parallelism)
+    hashed = ph.hash("calibration")
+    times = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        ph.verify(hashed, "calibration")
+        times.append(time.perf_counter() - start)
+    return statistics.median(times)
+
+
+def calibrate(target, max_memory_kib, parallelism):
+    """Returns the parameters and verify time for the strongest hashing within target seconds."""
+
+    # Use as much memory as possible with one pass, since memory is what makes attacks costly
+    memory_cost = max_memory_kib
+    elapsed = measure(1, memory_cost, parallelism)
+    print("time_cost=1 memory_cost=" + str(memory_cost) + " KiB: " + format(elapsed * 1000, ".0f") + " ms")
+    while elapsed > target and memory_cost // 2 >= MIN_MEMORY_KIB:
+        memory_cost //= 2
+        elapsed = measure(1, memory_cost, parallelism)
+        print("time_cost=1 memory_cost=" + str(memory_cost) + " KiB: " + format(elapsed * 1000, ".0f") + " ms")
+
+    # Then add passes while they still fit in the target
+    best = {"time_cost": 1, "memory_cost": memory_cost, "parallelism": parallelism}, elapsed
+    time_cost = 2
+    while True:
+        elapsed = measure(time_cost, memory_cost, parallelism)
+        print("time_cost=" + str(time_cost) + " memory_cost=" + str(memory_cost) + " KiB: "
+              + format(elapsed * 1000, ".0f") + " ms")
+        if elapsed > target:
+            break
+        best = {"time_cost": time_cost, "memory_cost": memory_cost, "parallelism": parallelism}, elapsed
+        time_cost += 1
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--calibrate", action="store_true", help="Pick parameters instead of hashing a password")
+    parser.add_argument("--target-ms", type=float, default=250, help="Target verify time (default: %(default)s)")
+    parser.add_argument("--max-memory", type=int, default=64, help="Most memory to use in MiB (default: %(default)s)")
+    parser.add_argument("--parallelism", type=int, default=min(os.cpu_count() or 1, 4),
+                        help="Lanes, at most the CPUs to use per verify (default: %(default)s)")
+    parser.add_argument("--write", action="store_true", help="Save the parameters to --params-path")
+    parser.add_argument("--params-path", default=passwords.PARAMS_PATH,
+                        help="The admin site's ARGON2_PARAMS_PATH (default: %(default)s)")
+    args = parser.parse_args()
+
+    if not args.calibrate:
+        ph = PasswordHasher(**passwords.load_params(args.params_path))
+        print(ph.hash(input("Enter your password. This will not be stored.\n> ")))
+        return
+
+    params, elapsed = calibrate(args.target_ms / 1000, args.max_memory * 1024, args.parallelism)
+    print("Picked " + json.dumps(params) + ", verifying takes " + format(elapsed * 1000, ".0f") + " ms")
+    if args.write:
+        with open(args.params_path, "w") as f:
+            json.dump(params, f, indent=4)
+            f.write("\n")
+        print("Saved to " + args.params_path + ", restart the admin site to use them.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,189 @@
+#!/usr/bin/python3
+
+"""Title photo optimization: resized, recompressed variants for srcset.
+
+Each post's title photo becomes a few widths in its original format (JPEG or
+PNG) plus WebP, with EXIF stripped (after applying its rotation). Variants are
+named by a hash of the original's contents, so the same photo uploaded twice
+is only stored once. The variants are recorded in the post's front matter as
+image_variants, and image points at the largest fallback, so Jekyll can build
+a srcset:
+
+    image_variants:
+    - path: assets/images/photo-0123456789abcdef-480.webp
+      type: image/webp
+      width: 480
+    ...
+
+This runs as a background job after each upload. Run this file with
+--backfill to do the posts that were uploaded before, which records them in
+the admin site's publish journal so they go out with its next update. Needs
+Pillow, posts are left alone without it.
+"""
+
+import argparse
+import hashlib
+import os
+import sys
+import time
+
+import front_matter
+import journal
+import storage
+from catalog import SECTIONS
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:
+    Image = None
+
+STATIC_SITE_PATH = os.path.join("..", "static-site")
+IMAGES_DIR = "assets/images/"
+WIDTHS = (480, 960, 1600)
+JPEG_QUALITY = 82
+WEBP_QUALITY = 80
+
+
+def content_hash(path):
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            h.update(chunk)
+    return h.hexdigest()[:16]
+
+
+def _save(image, path, format, **options):
+    # Temp file and swap, so a half-written variant never exists under its real name
+    with storage.replacing(path, "wb") as f:
+        image.save(f, format, **options)
+
+
+def make_variants(src_path, static_site_path):
+    """Makes the variants of an image, unless they exist already, and returns them.
+
+    Returns a list of {"path", "width", "type"} dictionaries, with paths relative
+    to the static site, smallest first and fallback format before WebP.
+    """
+
+    name = "photo-" + content_hash(src_path)
+    with Image.open(src_path) as original:
+        image = ImageOps.exif_transpose(original)  # Keep the rotation, then EXIF is left behind
+        png = original.format == "PNG"
+        if not png and image.mode != "RGB":
+            image = image.convert("RGB")
+        fallback_ext, fallback_type = (".png", "image/png") if png else (".jpg", "image/jpeg")
+
+        widths = sorted({min(w, image.width) for w in WIDTHS})
+        variants = []
+        for width in widths:
+            height = max(round(image.height * width / image.width), 1)
+            resized = None
+            for ext, mime in ((fallback_ext, fallback_type), (".webp", "image/webp")):
+                rel_path = IMAGES_DIR + name + "-" + str(width) + ext
+                path = os.path.join(static_site_path, rel_path)
+                if not os.path.exists(path):  # Same photo done before
+                    if resized is None:
+                        resized = image if width == image.width else image.resize((width, height), Image.LANCZOS)
+                    if ext == ".webp":
+                        _save(resized, path, "WEBP", quality=WEBP_QUALITY, method=6)
+                    elif png:
+                        _save(resized, path, "PNG", optimize=True)
+                    else:
+                        _save(resized, path, "JPEG", quality=JPEG_QUALITY, optimize=True, progressive=True)
+                variants.append({"path": rel_path, "width": width, "type": mime})
+    return variants
+
+
+def process_post_image(params):
+    """Replaces a post's title photo with optimized variants. Runs as a background job.
+
+    params is a dictionary with post_path and static_site_path. Returns the
+    post's path, the variants' paths, the removed original's path and the
+    seconds it took, or why it was skipped.
+    """
+
+    post_path = params["post_path"]
+    static_site_path = params["static_site_path"]
+    result = {"post": post_path, "variants": [], "removed": None, "skipped": None, "seconds": 0.0}
+    if Image is None:
+        result["skipped"] = "Pillow isn't installed"
+        return result
+
+    fm = front_matter.read(post_path)
+    if not fm.get("image") or fm.get("image_variants"):
+        result["skipped"] = "No image, or already done"
+        return result
+    src_path = os.path.join(static_site_path, fm["image"])
+    start = time.perf_counter()
+    variants = make_variants(src_path, static_site_path)
+
+    def _set_variants(fm):
+        fm["image"] = [v for v in variants if v["type"] != "image/webp"][-1]["path"]
+        fm["image_variants"] = variants
+
+    front_matter.update(post_path, _set_variants)
+
+    # The original still has its EXIF, so remove it if it only belonged to this post
+    post_name = os.path.splitext(os.path.basename(post_path))[0]
+    if os.path.basename(src_path).startswith(post_name + "_photo"):
+        os.remove(src_path)
+        result["removed"] = src_path
+    result["seconds"] = time.perf_counter() - start
+    result["variants"] = [os.path.join(static_site_path, v["path"]) for v in variants]
+    return result
+
+
+def backfill(static_site_path, dry_run=False, change_journal=None):
+    """Optimizes the title photo of every post that doesn't have variants yet. Returns how many.
+
+    The changed files are recorded in change_journal, like after an upload.
+    """
+
+    done = 0
+    for _, posts_dir in SECTIONS:
+        directory = os.path.join(static_site_path, posts_dir)
+        for filename in sorted(os.listdir(directory)):
+            post_path = os.path.join(directory, filename)
+            try:
+                fm = front_matter.read(post_path)
+            except (OSError, ValueError):
+                continue
+            if not isinstance(fm, dict) or not fm.get("image") or fm.get("image_variants"):
+                continue
+            if not os.path.isfile(os.path.join(static_site_path, fm["image"])):
+                print(post_path + ": image " + fm["image"] + " is missing", file=sys.stderr)
+                continue
+            print(post_path + ": " + fm["image"])
+            if not dry_run:
+                result = process_post_image({"post_path": post_path, "static_site_path": static_site_path})
+                if change_journal is not None and not result["skipped"]:
+                    change_journal.record("optimize image", result["post"], result["removed"], *result["variants"])
+            done += 1
+    return done
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Optimize the title photos of existing posts.")
+    parser.add_argument("--backfill", action="store_true", help="Do every post without image variants")
+    parser.add_argument("--static-site", default=STATIC_SITE_PATH, help="Path to the static site (default: %(default)s)")
+    parser.add_argument("--journal", default=journal.PATH, help="The admin site's publish journal (default: %(default)s)")
+    parser.add_argument("-n", "--dry-run", action="store_true", help="Only list the posts that would be done")
+    args = parser.parse_args()
+
+    if not args.backfill:
+        parser.print_help()
+        sys.exit(2)
+    if Image is None:
+        print("Pillow isn't installed. -- Aborting")
+        sys.exit(1)
+    done = backfill(args.static_site, dry_run=args.dry_run,
+                    change_journal=journal.ChangeJournal(args.journal, args.static_site))
+    if args.dry_run:
+        print(str(done) + " post(s) would be done.")
+    else:
+        print(str(done) + " post(s) done. They'll be published with the admin site's next update, "
+              "or run ./update_articles.sh to publish them now.")
+
+
+if __name__ == "__main__":
+    main()
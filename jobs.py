@@ -0,0 +1,239 @@
+"""Persistent background jobs, worked through by a bounded process pool.
+
+Jobs are rows in a SQLite table, so their status survives restarts and can be
+polled from any worker. Each job kind has a handler: a module level function
+that takes the job's params dictionary, runs in a separate process and returns
+a JSON-able result. Failed jobs are retried automatically up to max_attempts,
+and can be retried by hand after that.
+
+A running job is leased to the process that started it. If that process dies
+(a restart, the OOM killer) or the job runs past the lease, resume() queues it
+again, so nothing is stuck as running forever.
+"""
+
+import json
+import os
+import threading
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import storage
+
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    kind TEXT NOT NULL,
+    status TEXT NOT NULL,
+    params TEXT NOT NULL,
+    result TEXT,
+    error TEXT,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    user TEXT,
+    created REAL NOT NULL,
+    updated REAL NOT NULL,
+    owner INTEGER
+);
+CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status);
+CREATE INDEX IF NOT EXISTS jobs_user ON jobs (user, id);
+"""
+
+
+class JobQueue:
+    """Queues jobs in the jobs table of a SQLite database and runs them in a process pool.
+
+    handlers maps each job kind to the function that runs it. on_done is called
+    in this process with the job dictionary whenever a job finishes, whether it
+    succeeded or failed for the last time.
+    """
+
+    def __init__(self, db_path, handlers, max_workers=2, max_attempts=3, on_done=None, lease=30 * 60):
+        self.db_path = db_path
+        self.handlers = handlers
+        self.max_workers = max_workers
+        self.max_attempts = max_attempts
+        self.on_done = on_done
+        self.lease = lease
+        self._lock = threading.Lock()
+        self._executor = None
+        self._pid = None
+        with storage.connect(self.db_path) as conn:
+            conn.executescript(_SCHEMA)
+            if "owner" not in [row["name"] for row in conn.execute("PRAGMA table_info(jobs)")]:
+                conn.execute("ALTER TABLE jobs ADD COLUMN owner INTEGER")  # Tables from before leases
+
+    def _get_executor(self):
+        # Created lazily, and again after a fork, so each process has its own pool
+        with self._lock:
+            if self._executor is None or self._pid != os.getpid():
+                self._executor = ProcessPoolExecutor(max_workers=self.max_workers)
+                self._pid = os.getpid()
+            return self._executor
+
+    def _drop_executor(self, executor):
+        # A broken pool never works again, so the next job gets a new one
+        with self._lock:
+            if self._executor is executor:
+                self._executor = None
+        executor.shutdown(wait=False)
+
+    def submit(self, kind, params, user=None):
+        """Queues a job and starts it right away if there's room. Returns the job id."""
+
+        if kind not in self.handlers:
+            raise ValueError("Unknown job kind " + kind)
+        now = time.time()
+        with storage.connect(self.db_path) as conn:
+            cur = conn.execute("INSERT INTO jobs (kind, status, params, user, created, updated) VALUES (?, ?, ?, ?, ?, ?)",
+                               (kind, QUEUED, json.dumps(params), user, now, now))
+            job_id = cur.lastrowid
+        self._start(job_id)
+        return job_id
+
+    def get(self, job_id):
+        """Returns the job as a dictionary, or None if it doesn't exist."""
+
+        with storage.connect(self.db_path) as conn:
+            row = conn.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return _to_dict(row)
+
+    def recent(self, user=None, limit=10):
+        """Returns the latest jobs, newest first, optionally only the ones from one user."""
+
+        with storage.connect(self.db_path) as conn:
+            if user is None:
+                rows = conn.execute("SELECT * FROM jobs ORDER BY id DESC LIMIT ?", (limit,)).fetchall()
+            else:
+                rows = conn.execute("SELECT * FROM jobs WHERE user = ? ORDER BY id DESC LIMIT ?", (user, limit)).fetchall()
+        return [_to_dict(row) for row in rows]
+
+    def retry(self, job_id):
+        """Requeues a failed job, or a running one whose lease ran out. Returns False if it's neither."""
+
+        if self._requeue_expired(job_id):
+            self._start(job_id)
+            return True
+        with storage.connect(self.db_path) as conn:
+            cur = conn.execute("UPDATE jobs SET status = ?, error = NULL, attempts = 0, updated = ? WHERE id = ? AND status = ?",
+                               (QUEUED, time.time(), job_id, FAILED))
+            if cur.rowcount == 0:
+                return False
+        self._start(job_id)
+        return True
+
+    def resume(self):
+        """Starts any jobs still queued, and ones left running by a process that's gone, like after a restart."""
+
+        self._requeue_expired()
+        with storage.connect(self.db_path) as conn:
+            rows = conn.execute("SELECT id FROM jobs WHERE status = ? ORDER BY id", (QUEUED,)).fetchall()
+        for row in rows:
+            self._start(row["id"])
+
+    def _requeue_expired(self, job_id=None):
+        """Queues running jobs whose process is gone or whose lease ran out. Returns their ids.
+
+        Ones that have used up their attempts fail instead, since they might be
+        what's killing the process.
+        """
+
+        now = time.time()
+        with storage.connect(self.db_path) as conn:
+            if job_id is None:
+                rows = conn.execute("SELECT id, owner, updated, attempts FROM jobs WHERE status = ?", (RUNNING,)).fetchall()
+            else:
+                rows = conn.execute("SELECT id, owner, updated, attempts FROM jobs WHERE id = ? AND status = ?",
+                                    (job_id, RUNNING)).fetchall()
+        requeued = []
+        for row in rows:
+            if now - row["updated"] <= self.lease and _alive(row["owner"]):
+                continue
+            retry = row["attempts"] < self.max_attempts
+            with storage.connect(self.db_path) as conn:
+                # Only if nobody else requeued and claimed it in the meantime
+                cur = conn.execute("UPDATE jobs SET status = ?, error = ?, updated = ? WHERE id = ? AND status = ?"
+                                   " AND owner IS ? AND updated = ?",
+                                   (QUEUED if retry else FAILED, "Interrupted, the process running it stopped",
+                                    now, row["id"], RUNNING, row["owner"], row["updated"]))
+            if cur.rowcount == 0:
+                continue
+            if retry:
+                requeued.append(row["id"])
+            elif self.on_done is not None:
+                self.on_done(self.get(row["id"]))
+        return requeued
+
+    def _start(self, job_id):
+        # Claiming is a single UPDATE, so only one process can ever run a job
+        with storage.connect(self.db_path) as conn:
+            cur = conn.execute("UPDATE jobs SET status = ?, attempts = attempts + 1, updated = ?, owner = ?"
+                               " WHERE id = ? AND status = ?", (RUNNING, time.time(), os.getpid(), job_id, QUEUED))
+            if cur.rowcount == 0:
+                return
+            row = conn.execute("SELECT kind, params FROM jobs WHERE id = ?", (job_id,)).fetchone()
+
+        executor = self._get_executor()
+        try:
+            future = executor.submit(self.handlers[row["kind"]], json.loads(row["params"]))
+        except Exception as e:  # A broken or shut down pool
+            self._drop_executor(executor)
+            self._failed(job_id, e)
+            return
+        future.add_done_callback(lambda f: self._finished(job_id, f, executor))
+
+    def _finished(self, job_id, future, executor):
+        error = future.exception()
+        if error is not None:
+            if isinstance(error, BrokenProcessPool):
+                self._drop_executor(executor)
+            self._failed(job_id, error)
+            return
+        with storage.connect(self.db_path) as conn:
+            conn.execute("UPDATE jobs SET status = ?, result = ?, updated = ? WHERE id = ?",
+                         (DONE, json.dumps(future.result()), time.time(), job_id))
+        if self.on_done is not None:
+            self.on_done(self.get(job_id))
+
+    def _failed(self, job_id, error):
+        # Queued again if it has attempts left, otherwise failed for good
+        message = "".join(traceback.format_exception_only(type(error), error)).strip()
+        with storage.connect(self.db_path) as conn:
+            attempts = conn.execute("SELECT attempts FROM jobs WHERE id = ?", (job_id,)).fetchone()["attempts"]
+            retry = attempts < self.max_attempts
+            conn.execute("UPDATE jobs SET status = ?, error = ?, updated = ? WHERE id = ?",
+                         (QUEUED if retry else FAILED, message, time.time(), job_id))
+
+        if retry:
+            self._start(job_id)
+        elif self.on_done is not None:
+            self.on_done(self.get(job_id))
+
+
+def _alive(pid):
+    """Returns True if a process with that pid is running on this machine."""
+
+    if pid is None:
+        return False
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass  # Someone else's, but it exists
+    return True
+
+
+def _to_dict(row):
+    if row is None:
+        return None
+    job = dict(row)
+    job["params"] = json.loads(job["params"])
+    if job["result"] is not None:
+        job["result"] = json.loads(job["result"])
+    return job
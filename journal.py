@@ -0,0 +1,89 @@
+"""Journal of the static site paths the admin site has changed since the last publish.
+
+Every process appends to the same JSON lines file under an fcntl lock, and the
+publisher takes everything in it when it runs, so only those paths have to be
+staged instead of scanning the whole static site.
+"""
+
+import fcntl
+import json
+import os
+import time
+
+PATH = "publish_journal.jsonl"
+
+
+class ChangeJournal:
+    """Records operations on paths inside static_site_path, in the file at path."""
+
+    def __init__(self, path, static_site_path):
+        self.path = path
+        self.static_site_path = static_site_path
+
+    def record(self, operation, *paths, user=None):
+        """Records that operation changed (or removed) paths. None paths are skipped."""
+
+        entry = {
+            "time": time.time(),
+            "op": operation,
+            "paths": [os.path.relpath(p, self.static_site_path) for p in paths if p],
+            "user": user,
+        }
+        with open(self.path, "a") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                f.write(json.dumps(entry) + "\n")
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def take(self):
+        """Removes and returns every entry in the journal, oldest first."""
+
+        try:
+            f = open(self.path, "r+")
+        except FileNotFoundError:
+            return []
+        with f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                entries = [json.loads(line) for line in f if line.strip()]
+                f.seek(0)
+                f.truncate()
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+        return entries
+
+    def put_back(self, entries):
+        """Returns entries taken by take(), like after a failed publish."""
+
+        if not entries:
+            return
+        with open(self.path, "a") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                for entry in entries:
+                    f.write(json.dumps(entry) + "\n")
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def paths(entries):
+    """Returns the unique paths in some entries, in the order they were first changed."""
+
+    seen = {}
+    for entry in entries:
+        for path in entry["paths"]:
+            seen.setdefault(path, None)
+    return list(seen)
+
+
+def commit_message(entries):
+    """Returns a commit message listing the operations in some entries."""
+
+    lines = ["Admin site update", ""]
+    for entry in entries:
+        line = "- " + entry["op"] + ": " + ", ".join(entry["paths"])
+        if entry.get("user"):
+            line += " (" + entry["user"] + ")"
+        lines.append(line)
+    return "\n".join(lines) + "\n"
@@ -1,5 +1,6 @@
 -- https://stackoverflow.com/a/39623296
 -- Used to remove extra lines that pandoc generates in Markdown lists
+-- No longer used by the app, see list_filter.py. Kept to compare against with benchmarks/list_filter.py
 
 import Text.Pandoc.JSON
 
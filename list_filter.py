@@ -0,0 +1,49 @@
+"""Python version of list_filter.hs, run in-process on pandoc's JSON AST.
+
+Removes the extra lines that pandoc generates in Markdown lists, by turning
+list items that are a single Para into a Plain, exactly like compactifyList.
+This saves pandoc from running the Haskell filter through runhaskell on every
+conversion, so the server doesn't need GHC.
+"""
+
+import json
+
+import pypandoc
+
+# Bump when the output changes, so cached conversions are redone
+VERSION = 1
+
+
+def _compactify_item(item):
+    # compactifyItem [Para bs] = [Plain bs]
+    if len(item) == 1 and item[0].get("t") == "Para":
+        return [{"t": "Plain", "c": item[0]["c"]}]
+    return item
+
+
+def compactify_lists(node):
+    """Compactifies every list in a pandoc JSON AST, in place. Returns the node.
+
+    Like pandoc's walk, children are done before their parents.
+    """
+
+    if isinstance(node, list):
+        for child in node:
+            compactify_lists(child)
+    elif isinstance(node, dict):
+        for child in node.values():
+            compactify_lists(child)
+        if node.get("t") == "BulletList":
+            node["c"] = [_compactify_item(item) for item in node["c"]]
+        elif node.get("t") == "OrderedList":
+            attrs, items = node["c"]
+            node["c"] = [attrs, [_compactify_item(item) for item in items]]
+    return node
+
+
+def convert_file(path, to="md"):
+    """Converts a document with pandoc and the list filter, and returns the output."""
+
+    ast = json.loads(pypandoc.convert_file(path, "json"))
+    compactify_lists(ast)
+    return pypandoc.convert_text(json.dumps(ast), to, format="json")
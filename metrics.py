@@ -0,0 +1,243 @@
+"""Timings and counts of the slow parts of the admin site, in Prometheus' text format.
+
+Code times a phase with:
+
+    with metrics.timed("front_matter_read"):
+        ...
+
+which adds to the admin_phase_seconds histogram, and to the phases of the
+request being handled, if any, so they can be logged together with its
+request id. Everything is recorded per process, in the module level registry,
+which /metrics renders. Phases timed in the job processes (like conversions)
+are returned with the job's result and observed by the web process instead.
+
+With share(), each process adds what it recorded to totals in a SQLite
+database every few seconds and before rendering, so /metrics shows the same
+counts whichever worker answers, and they don't go back down when a worker
+restarts, which would break Prometheus' rate().
+"""
+
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+import storage
+
+# Upper bounds in seconds, from a YAML parse up to a pandoc run
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+# field is "" for a counter, and "sum", "count" or a bucket's "le=..." for a histogram
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS metrics (
+    name TEXT NOT NULL,
+    labels TEXT NOT NULL,
+    field TEXT NOT NULL,
+    value REAL NOT NULL,
+    PRIMARY KEY (name, labels, field)
+);
+"""
+
+
+def _label_text(labels):
+    if not labels:
+        return ""
+    escaped = (str(v).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"') for _, v in labels)
+    return "{" + ",".join(k + '="' + v + '"' for (k, _), v in zip(labels, escaped)) + "}"
+
+
+def _number(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metrics:
+    """Thread safe histograms and counters, each with labels."""
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets) + (float("inf"),)
+        self._lock = threading.Lock()
+        self._help = {}  # name -> (type, help)
+        self._histograms = {}  # name -> {labels: [bucket counts, sum, count]}
+        self._counters = {}  # name -> {labels: value}
+        self._request = threading.local()  # Green thread local under eventlet
+        self.db_path = None
+        self.flush_interval = None
+        self._thread = None
+        self._pid = None
+
+    def share(self, db_path, flush_interval=10):
+        """Keeps the totals in the SQLite database at db_path, added up across every process using it."""
+
+        self.db_path = db_path
+        self.flush_interval = flush_interval
+        with storage.connect(self.db_path) as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.executescript(_SCHEMA)
+
+    def _ensure_thread(self):
+        # Threads don't survive a fork, so each process starts its own. What was recorded
+        # before the fork is the parent's to add, so the child starts from nothing
+        if self.db_path is None or self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid != os.getpid():
+                self._histograms = {name: {} for name in self._histograms}
+                self._counters = {name: {} for name in self._counters}
+                self._thread = threading.Thread(target=self._flush_loop, name="metrics", daemon=True)
+                self._pid = os.getpid()
+                self._thread.start()
+
+    def _flush_loop(self):
+        while True:
+            time.sleep(self.flush_interval)
+            try:
+                self.flush()
+            except Exception:
+                logging.exception("Saving metrics failed")
+
+    def flush(self):
+        """Adds what this process recorded since the last flush to the shared totals."""
+
+        with self._lock:
+            histograms, counters = self._histograms, self._counters
+            self._histograms = {name: {} for name in histograms}
+            self._counters = {name: {} for name in counters}
+        rows = []
+        for name, series in histograms.items():
+            for labels, (counts, total, count) in series.items():
+                key = json.dumps(labels)
+                rows.extend((name, key, "le=" + _number(bound), c) for bound, c in zip(self.buckets, counts))
+                rows.extend([(name, key, "sum", total), (name, key, "count", count)])
+        for name, series in counters.items():
+            rows.extend((name, json.dumps(labels), "", value) for labels, value in series.items())
+        with storage.connect(self.db_path) as conn:
+            conn.executemany("INSERT OR IGNORE INTO metrics (name, labels, field, value) VALUES (?, ?, ?, 0)",
+                             [row[:3] for row in rows])
+            conn.executemany("UPDATE metrics SET value = value + ? WHERE name = ? AND labels = ? AND field = ?",
+                             [row[3:] + row[:3] for row in rows])
+
+    def _shared(self):
+        """Returns the shared totals, as (histograms, counters) like this process' own."""
+
+        self.flush()
+        with storage.connect(self.db_path) as conn:
+            rows = conn.execute("SELECT name, labels, field, value FROM metrics").fetchall()
+        bucket_index = {"le=" + _number(bound): i for i, bound in enumerate(self.buckets)}
+        with self._lock:
+            histograms = {name: {} for name in self._histograms}
+            counters = {name: {} for name in self._counters}
+        for row in rows:
+            labels = tuple(tuple(pair) for pair in json.loads(row["labels"]))
+            if row["field"] == "":
+                value = row["value"]  # Stored as REAL, but most counters count whole things
+                counters.setdefault(row["name"], {})[labels] = int(value) if value.is_integer() else value
+                continue
+            values = histograms.setdefault(row["name"], {}).setdefault(labels, [[0] * len(self.buckets), 0.0, 0])
+            if row["field"] == "sum":
+                values[1] = row["value"]
+            elif row["field"] == "count":
+                values[2] = int(row["value"])
+            elif row["field"] in bucket_index:
+                values[0][bucket_index[row["field"]]] = int(row["value"])
+        return histograms, counters
+
+    def describe(self, name, type, help):
+        """Declares a metric, so it's rendered with its type and help even before it's used."""
+
+        with self._lock:
+            self._help[name] = (type, help)
+            (self._histograms if type == "histogram" else self._counters).setdefault(name, {})
+
+    def observe(self, name, seconds, **labels):
+        self._ensure_thread()
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            series = self._histograms.setdefault(name, {})
+            values = series.get(key)
+            if values is None:
+                values = series[key] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if seconds <= bound:
+                    values[0][i] += 1
+            values[1] += seconds
+            values[2] += 1
+
+    def inc(self, name, amount=1, **labels):
+        self._ensure_thread()
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            series = self._counters.setdefault(name, {})
+            series[key] = series.get(key, 0) + amount
+
+    def observe_phase(self, phase, seconds):
+        """Records that phase took seconds, for the histogram and the current request."""
+
+        self.observe("admin_phase_seconds", seconds, phase=phase)
+        phases = getattr(self._request, "phases", None)
+        if phases is not None:
+            phases[phase] = phases.get(phase, 0.0) + seconds
+
+    @contextmanager
+    def timed(self, phase):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe_phase(phase, time.perf_counter() - start)
+
+    def start_request(self):
+        """Starts collecting the phases of the request this thread is handling."""
+
+        self._request.phases = {}
+
+    def finish_request(self):
+        """Stops collecting, and returns {phase: seconds} for the request."""
+
+        phases = getattr(self._request, "phases", None) or {}
+        self._request.phases = None
+        return phases
+
+    def render(self):
+        """Returns every metric in Prometheus' text exposition format, from every process if shared."""
+
+        if self.db_path is not None:
+            histograms, counters = self._shared()
+        else:
+            histograms, counters = self._histograms, self._counters
+
+        lines = []
+        with self._lock:
+            for name, series in sorted(histograms.items()):
+                self._header(lines, name, "histogram")
+                for labels, (counts, total, count) in sorted(series.items()):
+                    for bound, bucket_count in zip(self.buckets, counts):
+                        lines.append(name + "_bucket" + _label_text(labels + (("le", _number(bound)),)) + " "
+                                     + str(bucket_count))
+                    lines.append(name + "_sum" + _label_text(labels) + " " + _number(total))
+                    lines.append(name + "_count" + _label_text(labels) + " " + str(count))
+            for name, series in sorted(counters.items()):
+                self._header(lines, name, "counter")
+                for labels, value in sorted(series.items()):
+                    lines.append(name + _label_text(labels) + " " + _number(value))
+        return "\n".join(lines) + "\n"
+
+    def _header(self, lines, name, type):
+        if name in self._help:
+            lines.append("# HELP " + name + " " + self._help[name][1])
+        lines.append("# TYPE " + name + " " + type)
+
+
+registry = Metrics()
+registry.describe("admin_phase_seconds", "histogram", "Time spent in slow parts of requests and background jobs.")
+registry.describe("admin_request_seconds", "histogram", "Time to handle a request, by endpoint.")
+registry.describe("admin_requests_total", "counter", "Requests handled, by endpoint, method and status.")
+
+describe = registry.describe
+observe = registry.observe
+inc = registry.inc
+observe_phase = registry.observe_phase
+timed = registry.timed
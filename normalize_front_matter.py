@@ -0,0 +1,85 @@
+#!/usr/bin/python3
+
+"""Tool to fix legacy front matter in every post of the static site, in one pass.
+
+Posts without tags get "tags: []", and posts with a single string for tags
+(like "tags: featured") get a list instead. The dashboard only fixes these in
+memory, so run this once after importing old posts. The posts it changes are
+recorded in the admin site's publish journal, so they go out with its next
+update.
+"""
+
+import argparse
+import os
+import sys
+
+import yaml
+
+import front_matter
+import journal
+from catalog import SECTIONS
+
+STATIC_SITE_PATH = os.path.join("..", "static-site")
+
+
+def normalized(fm):
+    """Returns the normalized version of some front matter, or None if it's already fine."""
+
+    if isinstance(fm.get("tags"), list):
+        return None
+    fixed = dict(fm)
+    fixed["tags"] = front_matter.get_tags(fm)
+    return fixed
+
+
+def normalize(static_site_path, dry_run=False, change_journal=None):
+    """Normalizes every post, and returns (changed, bad) lists of paths. Changes are recorded in change_journal."""
+
+    changed = []
+    bad = []
+    for _, posts_dir in SECTIONS:
+        directory = os.path.join(static_site_path, posts_dir)
+        for filename in sorted(os.listdir(directory)):
+            path = os.path.join(directory, filename)
+            try:
+                fm = front_matter.read(path)
+                if not isinstance(fm, dict):
+                    raise ValueError("Front matter isn't a mapping")
+            except (OSError, ValueError, yaml.YAMLError) as e:
+                bad.append((path, e))
+                continue
+
+            fixed = normalized(fm)
+            if fixed is None:
+                continue
+            print(path + ": tags " + repr(fm.get("tags")) + " -> " + repr(fixed["tags"]))
+            if not dry_run:
+                # Normalized again from what's read under the lock, so an edit made since isn't undone
+                front_matter.update(path, normalized)
+                if change_journal is not None:
+                    change_journal.record("normalize front matter", path)
+            changed.append(path)
+
+    return changed, bad
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--static-site", default=STATIC_SITE_PATH, help="Path to the static site (default: %(default)s)")
+    parser.add_argument("--journal", default=journal.PATH, help="The admin site's publish journal (default: %(default)s)")
+    parser.add_argument("-n", "--dry-run", action="store_true", help="Only report what would be changed")
+    args = parser.parse_args()
+
+    change_journal = journal.ChangeJournal(args.journal, args.static_site)
+    changed, bad = normalize(args.static_site, dry_run=args.dry_run, change_journal=change_journal)
+    for path, e in bad:
+        print(path + ": skipped, bad front matter (" + str(e) + ")", file=sys.stderr)
+    if args.dry_run:
+        print(str(len(changed)) + " post(s) would be changed.")
+    else:
+        print(str(len(changed)) + " post(s) changed. They'll be published with the admin site's next update, "
+              "or run ./update_articles.sh to publish them now.")
+
+
+if __name__ == "__main__":
+    main()
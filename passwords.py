@@ -0,0 +1,73 @@
+"""Argon2 password hashing with parameters chosen for this server.
+
+Argon2 is meant to be slow and use a lot of memory, so verifying is done off
+the request thread: in eventlet's real OS thread pool when running under
+eventlet (so the hub keeps serving everyone else), or in a small thread pool
+otherwise. At most max_concurrent verifications run at once. The parameters
+come from argon2_params.json, written by gen_argon_pass.py --calibrate.
+"""
+
+import json
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import metrics
+
+PARAMS_PATH = "argon2_params.json"
+
+
+class TooBusy(Exception):
+    """Raised when a verification had to wait too long for a free slot."""
+
+
+def load_params(path=PARAMS_PATH):
+    """Returns the saved PasswordHasher parameters, or {} for argon2's defaults."""
+
+    try:
+        with open(path, "r") as f:
+            params = json.load(f)
+    except FileNotFoundError:
+        return {}
+    return {key: params[key] for key in ("time_cost", "memory_cost", "parallelism") if key in params}
+
+
+def _eventlet_patched():
+    try:
+        from eventlet import patcher
+    except ImportError:
+        return False
+    return patcher.is_monkey_patched("thread")
+
+
+class PasswordVerifier:
+    """Verifies and hashes passwords with hasher, without blocking the caller's event loop."""
+
+    def __init__(self, hasher, max_concurrent=2, wait_timeout=10):
+        self.hasher = hasher
+        self.wait_timeout = wait_timeout
+        self._slots = threading.BoundedSemaphore(max_concurrent)
+        self._executor = ThreadPoolExecutor(max_workers=max_concurrent, thread_name_prefix="argon2")
+
+    def _run(self, func, *args):
+        if not self._slots.acquire(timeout=self.wait_timeout):
+            raise TooBusy()
+        try:
+            if _eventlet_patched():
+                from eventlet import tpool
+                return tpool.execute(func, *args)
+            return self._executor.submit(func, *args).result()
+        finally:
+            self._slots.release()
+
+    def verify(self, hash, password):
+        """Verifies password against hash, and returns True if the hash should be redone.
+
+        Raises the same exceptions as PasswordHasher.verify, or TooBusy.
+        """
+
+        with metrics.timed("login_verify"):  # Including the wait for a slot
+            self._run(self.hasher.verify, hash, password)
+        return self.hasher.check_needs_rehash(hash)
+
+    def hash(self, password):
+        return self._run(self.hasher.hash, password)
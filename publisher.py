@@ -0,0 +1,201 @@
+"""Coalescing scheduler for updating the static site.
+
+Requests to publish are debounced: a burst of edits turns into one run of the
+update script once things have been quiet for `delay` seconds (or after
+`max_delay` at most, so constant edits can't hold it off forever). A request
+that comes in while the script is running always gets a run after it, so no
+change is left unpublished. A failed run is tried again, waiting twice as long
+after each failure in a row (up to max_backoff), unless a publish is forced.
+
+Runs are serialized across every process with an fcntl lock, which the kernel
+releases when its holder exits, so it can't go stale like a lock file.
+
+With a ChangeJournal, the script is only asked to stage the journaled paths,
+see update_articles.sh, and nothing is run while the journal is empty (like
+when another process already published those changes). Running the script
+with no arguments, which commits the whole static site, is left for manual runs.
+"""
+
+import fcntl
+import logging
+import os
+import subprocess
+import tempfile
+import threading
+import time
+
+import journal
+import metrics
+
+
+class PublishScheduler:
+    """Runs command in the background after publish requests, at most one run at a time.
+
+    If enabled is False, runs are only logged, for when not running in production.
+    env has extra environment variables for command.
+    """
+
+    def __init__(self, command, lock_path, delay=30, max_delay=300, enabled=True, change_journal=None, env=None,
+                 max_backoff=3600):
+        self.command = command
+        self.env = env or {}
+        self.change_journal = change_journal
+        self.lock_path = lock_path
+        self.delay = delay
+        self.max_delay = max_delay
+        self.enabled = enabled
+        self.max_backoff = max_backoff
+        self._cond = threading.Condition()
+        self._thread = None
+        self._pid = None
+        self._pending = False
+        self._now = False
+        self._first_request = None
+        self._last_request = None
+        self._running = False
+        self._last_run = {}
+        self._runs = 0
+        self._failures = 0  # In a row
+        self._retry_at = 0  # No run before this, after a failure
+
+    def request(self, now=False):
+        """Asks for a publish. With now=True it doesn't wait for more edits first."""
+
+        with self._cond:
+            self._ensure_thread()
+            current = time.monotonic()
+            if not self._pending:
+                self._first_request = current
+            self._pending = True
+            self._last_request = current
+            self._now = self._now or now
+            self._cond.notify()
+
+    def status(self):
+        """Returns a dictionary describing the scheduler and the last run."""
+
+        with self._cond:
+            status = {"pending": self._pending, "running": self._running, "runs": self._runs, "enabled": self.enabled,
+                      "failures": self._failures}
+            status.update(self._last_run)
+            return status
+
+    def _ensure_thread(self):
+        # Threads don't survive a fork, so each process starts its own
+        if self._thread is None or self._pid != os.getpid():
+            self._thread = threading.Thread(target=self._loop, name="publisher", daemon=True)
+            self._pid = os.getpid()
+            self._thread.start()
+
+    def _loop(self):
+        while True:
+            with self._cond:
+                while not self._pending:
+                    self._cond.wait()
+                # Wait for the edits to stop coming in, and for the backoff after a failure
+                while not self._now:
+                    wait = max(min(self._last_request + self.delay, self._first_request + self.max_delay),
+                               self._retry_at) - time.monotonic()
+                    if wait <= 0:
+                        break
+                    self._cond.wait(wait)
+                self._pending = False
+                self._now = False
+                self._running = True
+
+            try:
+                result = self._run()
+            except Exception as e:
+                logging.exception("Publishing failed")
+                result = {"last_returncode": None, "last_output": str(e)}
+            finally:
+                with self._cond:
+                    self._running = False
+
+            with self._cond:
+                self._runs += 1
+                self._last_run = result
+                if result["last_returncode"] == 0:
+                    self._failures = 0
+                    self._retry_at = 0
+                    continue
+                self._failures += 1
+                backoff = min(self.delay * 2 ** self._failures, self.max_backoff)
+                self._retry_at = time.monotonic() + backoff
+            logging.warning("Trying to update the static site again in " + str(backoff) + "s")
+            self.request()
+
+    def _run(self):
+        started = time.time()
+        with open(self.lock_path, "a") as lock:
+            # Blocks while another process is publishing, then publishes everything since
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                entries = self.change_journal.take() if self.change_journal is not None else []
+                if self.change_journal is not None and not entries:
+                    logging.info("Skipped updating because nothing changed since the last update")
+                    return {"last_run": started, "last_duration": 0.0, "last_returncode": 0,
+                            "last_output": "Nothing to publish", "last_paths": []}
+                try:
+                    if not self.enabled:
+                        logging.info("Skipped actually updating because not running in production")
+                        return {"last_run": started, "last_duration": 0.0, "last_returncode": 0,
+                                "last_output": "Skipped", "last_paths": journal.paths(entries)}
+
+                    arg_files = self._write_arg_files(entries) if entries else []  # Only without a journal
+                    try:
+                        start = time.monotonic()
+                        # Tell the script the lock is already held
+                        env = dict(os.environ, UPDATE_ARTICLES_LOCKED="1", **self.env)
+                        proc = subprocess.run(self.command + arg_files, stdout=subprocess.PIPE,
+                                              stderr=subprocess.STDOUT, env=env)
+                        duration = time.monotonic() - start
+                    finally:
+                        for path in arg_files:
+                            os.remove(path)
+                except BaseException:
+                    # The script couldn't even be run (missing, not executable, disk full), so nothing was published
+                    if entries:
+                        self.change_journal.put_back(entries)
+                    raise
+                if proc.returncode != 0 and entries:
+                    # Try those paths again next time
+                    self.change_journal.put_back(entries)
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+        metrics.observe_phase("publish", duration)
+        metrics.inc("admin_publishes_total", result="ok" if proc.returncode == 0 else "failed")
+        output = proc.stdout.decode("utf-8", "replace")
+        if proc.returncode == 0:
+            logging.info("Updated the static site in " + format(duration, ".1f") + "s")
+        else:
+            logging.error("Updating the static site failed with code " + str(proc.returncode) + ": " + output)
+        return {"last_run": started, "last_duration": duration, "last_returncode": proc.returncode,
+                "last_output": output[-2000:], "last_paths": journal.paths(entries)}
+
+    def _write_arg_files(self, entries):
+        """Writes the script's arguments for journaled changes to temp files, and returns their paths.
+
+        They are the NUL separated paths to add, the paths to remove, and the commit message.
+        """
+
+        static_site_path = self.change_journal.static_site_path
+        changed = journal.paths(entries)
+        existing = {p for p in changed if os.path.lexists(os.path.join(static_site_path, p))}
+        added = [p for p in changed if p in existing]
+        removed = [p for p in changed if p not in existing]
+        contents = ["\0".join(added), "\0".join(removed), journal.commit_message(entries)]
+
+        files = []
+        try:
+            for content in contents:
+                fd, path = tempfile.mkstemp(prefix="publish-")
+                files.append(os.path.abspath(path))
+                with os.fdopen(fd, "w") as f:
+                    f.write(content)
+        except BaseException:
+            for path in files:
+                os.remove(path)
+            raise
+        return files
@@ -5,4 +5,3 @@
 
 rm uploads/*
 touch uploads/.gitempty
-rm update_articles.lock
\ No newline at end of file
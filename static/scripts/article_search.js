@@ -0,0 +1,49 @@
+// Fills in the suggestions for each article search box from /api/articles as the user types.
+// The box's value is the article's filename, the suggestion shows the title.
+// Boxes with data-version-field also fill in that hidden field with the chosen article's version,
+// so the server can tell if someone else changed it in the meantime.
+
+document.querySelectorAll("input[data-article-search]").forEach(function (input) {
+    var list = document.getElementById(input.getAttribute("list"));
+    var timer = null;
+    var versions = {};
+    var versionField = input.dataset.versionField ? document.getElementById(input.dataset.versionField) : null;
+
+    function setVersion() {
+        if (versionField) {
+            versionField.value = versions[input.value] || "";
+        }
+    }
+
+    function search() {
+        var params = new URLSearchParams({q: input.value});
+        if (input.dataset.tag) {
+            params.set("tag", input.dataset.tag);
+        }
+        if (input.dataset.excludeTag) {
+            params.set("exclude_tag", input.dataset.excludeTag);
+        }
+        fetch(input.dataset.articleSearch + "?" + params, {credentials: "same-origin"})
+            .then(function (response) { return response.json(); })
+            .then(function (data) {
+                list.innerHTML = "";
+                data.articles.forEach(function (article) {
+                    versions[article.filename] = article.version;
+                    var option = document.createElement("option");
+                    option.value = article.filename;
+                    option.label = article.title + (article.section === "bear_air" ? " (Bear Air)" : "");
+                    list.appendChild(option);
+                });
+                setVersion();
+            });
+    }
+
+    input.addEventListener("focus", search);
+    input.addEventListener("change", setVersion);
+    input.addEventListener("input", function () {
+        setVersion();
+        // Wait for a pause in typing
+        clearTimeout(timer);
+        timer = setTimeout(search, 200);
+    });
+});
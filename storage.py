@@ -0,0 +1,75 @@
+"""SQLite connections and atomic file writes, shared by the stores and writers.
+
+Files the admin site writes in place (converted posts, image variants,
+cached conversions, the trash manifest, the author files) are written to a
+temp file next to them first, so it's on the same filesystem, and then
+swapped in with os.replace. Readers only ever see the old file or the whole
+new one. front_matter.update keeps its own, since it sets the temp file's
+mtime before the swap.
+"""
+
+import os
+import sqlite3
+import tempfile
+from contextlib import contextmanager
+
+
+@contextmanager
+def connect(db_path, foreign_keys=False):
+    """Yields a connection that commits on success and is always closed. Rows are sqlite3.Row."""
+
+    conn = sqlite3.connect(db_path, timeout=10)
+    conn.row_factory = sqlite3.Row
+    if foreign_keys:
+        conn.execute("PRAGMA foreign_keys=ON")
+    try:
+        with conn:
+            yield conn
+    finally:
+        conn.close()
+
+
+def _set_permissions(tmp_path, path, permissions):
+    # mkstemp makes files 0600. None keeps the permissions of the file being replaced
+    if permissions is None:
+        try:
+            permissions = os.stat(path).st_mode & 0o777
+        except FileNotFoundError:
+            permissions = 0o644
+    os.chmod(tmp_path, permissions)
+
+
+@contextmanager
+def replacing(path, mode="w", permissions=0o644):
+    """Yields a temp file next to path, which replaces path once the block is done.
+
+    If the block raises, the temp file is removed and path is left alone.
+    permissions is the new file's mode, or None to keep path's.
+    """
+
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path) or ".", prefix=".", suffix=".tmp")
+    try:
+        with os.fdopen(fd, mode) as f:
+            yield f
+        _set_permissions(tmp_path, path, permissions)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+
+def stage(path, content, permissions=None):
+    """Writes what path should contain to a temp file next to it, and returns the temp file's path.
+
+    For swapping in several files at once, after they've all been written.
+    """
+
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path) or ".", prefix=".", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "w") as f:
+            f.write(content)
+        _set_permissions(tmp_path, path, permissions)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+    return tmp_path
@@ -0,0 +1,117 @@
+"""Batched changes to article tags.
+
+Operations are grouped by article using the catalog's tag index, so changing a
+tag on a few articles only touches those, and every affected post is written
+exactly once no matter how many operations apply to it.
+
+An operation can carry the version of its article the user was looking at
+(see front_matter.version), and then the whole batch is refused with a
+VersionConflict if that article has changed since.
+"""
+
+import front_matter
+
+# Use this as the article of a "remove" operation to remove a tag from every article that has it
+ALL_ARTICLES = "*"
+
+
+def plan(snapshot, operations):
+    """Groups tag operations by the article they affect.
+
+    operations is a list of dictionaries like {"op": "add", "tag": "featured",
+    "article": "2020-01-01-post.md"}, where op is "add" or "remove", and
+    "version" is optional. Returns an
+    ordered dictionary of {filename: [(op, tag), ...]}, with the operations for
+    each article in the order they were given.
+
+    Raises ValueError if an operation is malformed or names an unknown article.
+    """
+
+    planned = {}
+    for operation in operations:
+        try:
+            op, tag, article = operation["op"], operation["tag"], operation["article"]
+        except (KeyError, TypeError):
+            raise ValueError("Operations need an op, a tag and an article")
+        if op not in ("add", "remove"):
+            raise ValueError("Unknown operation " + repr(op))
+        if not isinstance(tag, str) or tag == "":
+            raise ValueError("Bad tag " + repr(tag))
+        if operation.get("version") is not None and article == ALL_ARTICLES:
+            raise ValueError("A version needs a single article")
+
+        if article == ALL_ARTICLES:
+            if op != "remove":
+                raise ValueError("A tag can only be removed from all articles")
+            filenames = snapshot.tagged(tag)
+        elif article in snapshot:
+            filenames = [article]
+        else:
+            raise ValueError("Unknown article " + repr(article))
+
+        for filename in filenames:
+            planned.setdefault(filename, []).append((op, tag))
+    return planned
+
+
+def versions(operations):
+    """Returns {filename: version} for the operations that have a version.
+
+    Raises ValueError if one article is given two different versions.
+    """
+
+    found = {}
+    for operation in operations:
+        if isinstance(operation, dict) and operation.get("version") is not None:
+            article, version = operation.get("article"), str(operation["version"])
+            if found.setdefault(article, version) != version:
+                raise ValueError("Two versions of " + repr(article))
+    return found
+
+
+def apply(snapshot, operations):
+    """Applies tag operations, writing each affected post once.
+
+    Every affected post is locked first and the versions are checked before
+    anything is written, so a batch is either refused whole or applied whole.
+    Returns the list of filenames whose tags actually changed. Raises ValueError
+    if one of the posts was deleted since the snapshot.
+    """
+
+    planned = plan(snapshot, operations)
+    expected = versions(operations)
+    changed = []
+    with front_matter.lock(*[snapshot.get(filename).path for filename in planned]):
+        current = {}
+        for filename in planned:
+            try:
+                current[filename] = front_matter.version(snapshot.get(filename).path)
+            except FileNotFoundError:
+                raise ValueError("Unknown article " + repr(filename))  # Deleted since the snapshot
+        for filename, version in expected.items():
+            if current.get(filename, version) != version:
+                raise front_matter.VersionConflict(snapshot.get(filename).path, version, current[filename])
+
+        for filename, ops in planned.items():
+            article = snapshot.get(filename)
+            # Skip the write if it wouldn't change anything, when the snapshot is still what's on disk
+            fresh = current[filename] == front_matter.make_version(article.mtime, article.size)
+            if fresh and _apply_ops(list(article.tags), ops) == list(article.tags):
+                continue
+
+            def mutate(fm, ops=ops):
+                # Work from the tags on disk, not the snapshot, in case they changed since
+                fm["tags"] = _apply_ops(front_matter.get_tags(fm), ops)
+
+            front_matter.update(article.path, mutate)
+            changed.append(filename)
+    return changed
+
+
+def _apply_ops(tags, ops):
+    for op, tag in ops:
+        if op == "add" and tag not in tags:
+            tags.append(tag)  # Keep other tags
+        elif op == "remove" and tag in tags:
+            tags.remove(tag)
+    return tags
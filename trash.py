@@ -0,0 +1,177 @@
+"""Trash for deleted articles, so they can be brought back.
+
+Each deletion is filed under its own id, like 20201014T153000-3f9a1c, in a
+directory of the same name. The post and its images keep their paths inside
+the static site, so restoring just moves them back. manifest.json indexes every
+entry by id, with the original paths, who deleted it and its size, so nothing
+has to be searched for.
+
+Entries are purged by a background thread once they're older than max_age
+seconds, and the oldest go first while the trash is bigger than max_bytes.
+Every process shares the manifest through an fcntl lock.
+"""
+
+import fcntl
+import json
+import logging
+import os
+import secrets
+import shutil
+import threading
+import time
+from contextlib import contextmanager
+
+import front_matter
+import storage
+
+
+class TrashStore:
+    """Deleted articles in directory, with paths relative to static_site_path."""
+
+    def __init__(self, directory, static_site_path, max_age=90 * 24 * 60 * 60, max_bytes=1024 ** 3,
+                 purge_interval=60 * 60):
+        self.directory = directory
+        self.static_site_path = static_site_path
+        self.max_age = max_age
+        self.max_bytes = max_bytes
+        self.purge_interval = purge_interval
+        self.manifest_path = os.path.join(directory, "manifest.json")
+        self._lock = threading.Lock()
+        self._thread = None
+        self._pid = None
+        os.makedirs(directory, exist_ok=True)
+
+    @contextmanager
+    def _manifest(self):
+        """Yields the manifest dictionary under an exclusive lock, and saves it afterwards."""
+
+        with open(os.path.join(self.directory, ".lock"), "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                with open(self.manifest_path, "r") as f:
+                    manifest = json.load(f)
+            except FileNotFoundError:
+                manifest = {}
+            before = json.dumps(manifest, sort_keys=True)
+            yield manifest
+            if json.dumps(manifest, sort_keys=True) != before:
+                with storage.replacing(self.manifest_path, permissions=0o600) as f:  # Only the app reads it
+                    json.dump(manifest, f, indent=1, sort_keys=True)
+
+    def _move(self, src, dst):
+        os.makedirs(os.path.dirname(dst), exist_ok=True)
+        shutil.move(src, dst)
+
+    def delete(self, post_path, image_paths=(), user=None):
+        """Moves a post and its images into the trash, and returns the new entry.
+
+        The paths are inside the static site. Images that don't exist are skipped.
+        Raises FileNotFoundError if the post is already gone.
+        """
+
+        self.start()
+        entry_id = time.strftime("%Y%m%dT%H%M%S") + "-" + secrets.token_hex(3)
+        entry_dir = os.path.join(self.directory, entry_id)
+        files = []
+        size = 0
+        # Waits for front matter writes to the post, so one can't bring it back after it's moved
+        with front_matter.lock(post_path):
+            if not os.path.isfile(post_path):
+                raise FileNotFoundError(post_path)  # Deleted by someone else in the meantime
+            try:
+                for path in [post_path] + [p for p in image_paths if os.path.isfile(p)]:
+                    rel_path = os.path.relpath(path, self.static_site_path)
+                    size += os.path.getsize(path)
+                    self._move(path, os.path.join(entry_dir, rel_path))
+                    files.append(rel_path)
+            except BaseException:
+                # Put back what was already moved, so nothing is half deleted
+                for rel_path in files:
+                    self._move(os.path.join(entry_dir, rel_path), os.path.join(self.static_site_path, rel_path))
+                shutil.rmtree(entry_dir, ignore_errors=True)
+                raise
+
+        entry = {
+            "id": entry_id,
+            "filename": os.path.basename(post_path),
+            "post": files[0],
+            "section": files[0].split("/", 1)[0],
+            "images": files[1:],
+            "deleted": time.time(),
+            "user": user,
+            "size": size,
+        }
+        with self._manifest() as manifest:
+            manifest[entry_id] = entry
+        return entry
+
+    def get(self, entry_id):
+        with self._manifest() as manifest:
+            return manifest.get(entry_id)
+
+    def entries(self):
+        """Returns every entry, newest first."""
+
+        self.start()
+        with self._manifest() as manifest:
+            return sorted(manifest.values(), key=lambda e: e["deleted"], reverse=True)
+
+    def restore(self, entry_id):
+        """Moves an entry's files back where they were, and returns the entry.
+
+        Raises KeyError if there's no such entry, and FileExistsError (naming
+        the path) without moving anything if something has taken one of their
+        places since.
+        """
+
+        with self._manifest() as manifest:
+            entry = manifest[entry_id]
+            targets = [os.path.join(self.static_site_path, p) for p in [entry["post"]] + entry["images"]]
+            # Checked under the post's lock, so a post written there in the meantime isn't overwritten
+            with front_matter.lock(targets[0]):
+                for target in targets:
+                    if os.path.exists(target):
+                        raise FileExistsError(os.path.relpath(target, self.static_site_path))
+                entry_dir = os.path.join(self.directory, entry_id)
+                for rel_path, target in zip([entry["post"]] + entry["images"], targets):
+                    self._move(os.path.join(entry_dir, rel_path), target)
+            shutil.rmtree(entry_dir, ignore_errors=True)
+            del manifest[entry_id]
+        return entry
+
+    def purge(self, now=None):
+        """Permanently removes entries past max_age, then the oldest past max_bytes. Returns them."""
+
+        now = time.time() if now is None else now
+        purged = []
+        with self._manifest() as manifest:
+            oldest_first = sorted(manifest.values(), key=lambda e: e["deleted"])
+            total = sum(e["size"] for e in oldest_first)
+            for entry in oldest_first:
+                if now - entry["deleted"] <= self.max_age and total <= self.max_bytes:
+                    break
+                shutil.rmtree(os.path.join(self.directory, entry["id"]), ignore_errors=True)
+                del manifest[entry["id"]]
+                total -= entry["size"]
+                purged.append(entry)
+        return purged
+
+    def start(self):
+        """Starts the purge thread in this process, if it isn't running yet."""
+
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._thread is None or self._pid != os.getpid():
+                self._thread = threading.Thread(target=self._purge_loop, name="trash-purge", daemon=True)
+                self._pid = os.getpid()
+                self._thread.start()
+
+    def _purge_loop(self):
+        while True:
+            try:
+                for entry in self.purge():
+                    logging.info("Purged " + entry["filename"] + " from the trash (" + entry["id"] + ")")
+            except Exception:
+                logging.exception("Purging the trash failed")
+            time.sleep(self.purge_interval)
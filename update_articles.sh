@@ -1,21 +1,50 @@
 #!/usr/bin/env bash
 
+# Usage: ./update_articles.sh [ADD_PATHS REMOVE_PATHS MESSAGE]
+#
+# With no arguments, everything that changed in the static site is committed.
+# That's only for running it by hand, the admin site always passes three files
+# instead: NUL separated paths (relative to the static site) to stage, paths
+# that were removed, and the commit message. Then only those paths are staged.
+# They're passed through xargs rather than --pathspec-from-file, which needs
+# git 2.26 or newer, and taken literally, so names with * or ? in them are fine.
+#
+# The admin site also sets STATIC_SITE_PATH and UPDATE_ARTICLES_LOCK to the
+# paths in its config. By hand, they default to ../static-site and
+# update_articles.lock.
+
 set -e
 
 base="$(pwd)"
 
-if [ ! -f update_articles.lock ]; then
-    touch update_articles.lock
-    cd "../static-site"
-    if [[ "$(git status --porcelain)" ]]; then
-        git add .
-        git commit -m "Bot update"  # Change this
+# The admin site takes the lock itself before running this, and tells us with
+# UPDATE_ARTICLES_LOCKED. Otherwise take it here, flock releases it when this
+# script exits, even if it crashes.
+if [ -z "$UPDATE_ARTICLES_LOCKED" ]; then
+    exec 9>>"${UPDATE_ARTICLES_LOCK:-update_articles.lock}"
+    if ! flock -n 9; then
+        echo "Lock in use."
+        exit 1  # Wasn't able to update
+    fi
+fi
+
+cd "${STATIC_SITE_PATH:-../static-site}"
+if [ "$#" -eq 3 ]; then
+    export GIT_LITERAL_PATHSPECS=1
+    if [ -s "$1" ]; then
+        xargs -0 git add -A -- < "$1"
+    fi
+    if [ -s "$2" ]; then
+        xargs -0 git rm -q -r --cached --ignore-unmatch -- < "$2"
+    fi
+    if ! git diff --cached --quiet; then
+        git commit -q -F "$3"
         git push
     fi
-    cd "$base"
-    rm update_articles.lock
-    echo "Done."
-else
-    echo "Lock in use."
-    exit 1  # Wasn't able to update
+elif [[ "$(git status --porcelain)" ]]; then
+    git add .
+    git commit -m "Bot update"  # Change this
+    git push
 fi
+cd "$base"
+echo "Done."
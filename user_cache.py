@@ -0,0 +1,55 @@
+"""Cache of the users flask_login loads on every request."""
+
+import threading
+import time
+from collections import OrderedDict
+
+
+class UserCache:
+    """A least recently used cache of users, where each entry expires after ttl seconds.
+
+    loader is called with a username on a miss, and returns the user or None.
+    Missing users aren't cached. Call invalidate() when a user changes in this
+    process, changes made by other processes show up within ttl seconds.
+    A ttl of 0 turns the cache off.
+    """
+
+    def __init__(self, loader, ttl=60, max_size=256):
+        self.loader = loader
+        self.ttl = ttl
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        self._users = OrderedDict()  # username -> (expires, user)
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, username):
+        if self.ttl <= 0:
+            return self.loader(username)
+
+        now = time.monotonic()
+        with self._lock:
+            cached = self._users.get(username)
+            if cached is not None and cached[0] > now:
+                self._users.move_to_end(username)
+                self.hits += 1
+                return cached[1]
+            self.misses += 1
+
+        user = self.loader(username)
+        if user is not None:
+            with self._lock:
+                self._users[username] = (now + self.ttl, user)
+                self._users.move_to_end(username)
+                while len(self._users) > self.max_size:
+                    self._users.popitem(last=False)
+        return user
+
+    def invalidate(self, username=None):
+        """Forgets one user, or everyone if username is None."""
+
+        with self._lock:
+            if username is None:
+                self._users.clear()
+            else:
+                self._users.pop(username, None)